@@ -14,6 +14,8 @@ from datetime import datetime, timedelta
 
 from app.core.security import create_access_token, verify_telegram_auth, get_current_user
 from app.services.telegram import send_code_request, sign_in, sign_in_2fa, get_session_info
+from app.api.dialogs import retry_after_headers
+from app.services.flood import RetryAfterError
 from app.core.config import settings
 from app.models.auth import (
     Token, User, PhoneAuthRequest, SignInRequest, 
@@ -186,7 +188,19 @@ async def phone_auth(auth_data: PhoneAuthRequest):
         result = await send_code_request(auth_data.phone_number)
         
         return result
+    except RetryAfterError as e:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=str(e),
+            headers=retry_after_headers(e)
+        )
     except Exception as e:
+        if "Слишком много" in str(e):
+            # Исчерпан лимит отправок кода или незавершенных входов (см. pending_auth)
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail=str(e)
+            )
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=str(e)
@@ -215,6 +229,12 @@ async def code_auth(auth_data: CodeAuthRequest):
             "access_token": access_token,
             "user": user
         }
+    except RetryAfterError as e:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=str(e),
+            headers=retry_after_headers(e)
+        )
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -234,7 +254,19 @@ async def send_code(request: SendCodeRequest):
         result["message"] = f"Код подтверждения отправлен на номер {request.phone_number}"
         
         return result
+    except RetryAfterError as e:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=str(e),
+            headers=retry_after_headers(e)
+        )
     except Exception as e:
+        if "Слишком много" in str(e):
+            # Исчерпан лимит отправок кода или незавершенных входов (см. pending_auth)
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail=str(e)
+            )
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=str(e)
@@ -266,6 +298,12 @@ async def sign_in_with_code(request: SignInRequest):
             "token_type": "bearer",
             "user": user_data
         }
+    except RetryAfterError as e:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=str(e),
+            headers=retry_after_headers(e)
+        )
     except ValueError as e:
         if "Требуется пароль двухфакторной аутентификации" in str(e):
             raise HTTPException(
@@ -309,6 +347,12 @@ async def sign_in_with_2fa(request: SignIn2FARequest):
             "token_type": "bearer",
             "user": user_data
         }
+    except RetryAfterError as e:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=str(e),
+            headers=retry_after_headers(e)
+        )
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -0,0 +1,89 @@
+"""
+API для получения аватаров из дискового кэша
+"""
+
+import logging
+from typing import Optional
+from fastapi import APIRouter, HTTPException, Request, Response
+from fastapi.responses import FileResponse, RedirectResponse
+
+from app.core.security import verify_avatar_signature
+from app.services.avatars import (
+    AVATAR_CACHE_CONTROL, avatar_sources, get_avatar_path, get_avatar_url, get_photo_id, is_avatar_cached,
+    download_avatar, get_avatar_placeholder, load_avatar_source, register_avatar_source
+)
+from app.services.shards import owns
+from app.services.telegram import get_client
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Создаем роутер
+router = APIRouter()
+
+# Эндпоинт для получения аватара
+@router.get("/{peer_id}/{photo_id}")
+async def get_avatar(peer_id: int, photo_id: int, request: Request, sig: Optional[str] = None):
+    """
+    Отдает аватар по photo_id
+
+    URL аватара содержит photo_id, поэтому ответ неизменяем и может
+    кэшироваться браузером и прокси без повторной проверки. Заголовок
+    Authorization <img> не передает - вместо него URL подписан (sig),
+    и подписи выдаются только вместе со списком диалогов пользователя.
+    """
+    if not verify_avatar_signature(peer_id, photo_id, sig):
+        raise HTTPException(status_code=403, detail="Неверная подпись аватара")
+
+    etag = f'"{photo_id}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": AVATAR_CACHE_CONTROL
+    }
+
+    # Если у клиента уже есть этот аватар, тело не отправляем
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    if not is_avatar_cached(photo_id):
+        # Аватара нет на диске - скачиваем через пользователя, которому он был выдан
+        source = avatar_sources.get(photo_id)
+        remote = None
+        if not source:
+            # Аватар мог выдать другой воркер - источник берем из общего кэша
+            remote = await load_avatar_source(photo_id)
+            if not remote or remote[1] != peer_id or not owns(remote[0]):
+                # Пользователь, которому выдан аватар, живет в другом шарде -
+                # диспетчер спросит следующий (см. app.dispatcher)
+                raise HTTPException(status_code=404, detail="Аватар не найден")
+            source = (remote[0], None)
+
+        user_id, entity = source
+        downloaded = None
+        try:
+            client = await get_client(user_id)
+            if entity is None:
+                # Сущности с фото у этого воркера нет - получаем ее одним запросом
+                entity = await client.get_entity(remote[1])
+                register_avatar_source(user_id, entity)
+            if get_photo_id(entity) == photo_id:
+                downloaded = await download_avatar(client, entity)
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке аватара {photo_id} для диалога {peer_id}: {e}")
+
+        if entity is not None and get_photo_id(entity) != photo_id:
+            # Фото сменили или удалили после выдачи URL - отправляем к текущему
+            current_url = get_avatar_url(entity)
+            if not current_url:
+                raise HTTPException(status_code=404, detail="Аватар не найден")
+            return RedirectResponse(current_url, status_code=307, headers={"Cache-Control": "no-store"})
+
+        if not downloaded or not is_avatar_cached(photo_id):
+            # Отдаем размытую миниатюру из сущности, но не даем ее кэшировать
+            placeholder = get_avatar_placeholder(entity) if entity is not None else None
+            if not placeholder:
+                raise HTTPException(status_code=502, detail="Не удалось загрузить аватар")
+            return Response(content=placeholder, media_type="image/jpeg", headers={"Cache-Control": "no-store"})
+
+    return FileResponse(get_avatar_path(photo_id), media_type="image/jpeg", headers=headers)
@@ -3,15 +3,15 @@ API для работы с диалогами Telegram
 """
 
 import logging
-from typing import List, Dict, Any, Optional
-from fastapi import APIRouter, Depends, HTTPException, status, Query, Header
+from typing import List, Dict, Any, Optional, Union
+from fastapi import APIRouter, Depends, HTTPException, Query, Header, Response
 from pydantic import BaseModel
-import random
-from datetime import datetime, timedelta
-import os
+from datetime import datetime
 
-from app.core.security import verify_token, TokenData
-from app.services.telegram import get_dialogs, get_messages, send_message
+from app.core.security import verify_token
+from app.services.flood import RetryAfterError
+from app.services.telegram import get_dialogs_with_age, get_messages, send_message
+from app.services.session_store import session_db
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -60,14 +60,30 @@ def get_current_user(authorization: Optional[str] = Header(None)):
         logger.error(f"Ошибка при проверке токена: {e}")
         raise HTTPException(status_code=401, detail="Неверный токен авторизации")
 
+def stale_headers(age: float) -> Dict[str, str]:
+    """
+    Заголовки ответа с устаревшими данными из кэша
+    """
+    return {"Age": str(int(age)), "Warning": '110 - "Response is Stale"'}
+
+def retry_after_headers(error: RetryAfterError) -> Dict[str, str]:
+    """
+    Заголовок Retry-After для ответа 429 по сроку FloodWait
+    """
+    return {"Retry-After": str(error.seconds)}
+
 # Эндпоинт для получения списка диалогов
 @router.get("/", response_model=List[Dict[str, Any]])
 async def list_dialogs(
+    response: Response,
     force_refresh: bool = Query(False, description="Принудительно обновить кэш"),
     current_user = Depends(get_current_user)
 ):
     """
     Получает список диалогов пользователя
+    
+    Устаревший список из кэша отдается с заголовками Age и Warning,
+    пока в фоне загружается свежий.
     """
     try:
         user_id = current_user['id']
@@ -82,26 +98,28 @@ async def list_dialogs(
         
         # Получаем диалоги из Telegram
         try:
-            dialogs = await get_dialogs(user_id_int, force_refresh=force_refresh)
+            dialogs, stale_age = await get_dialogs_with_age(user_id_int, force_refresh=force_refresh)
             logger.info(f"Получено {len(dialogs)} диалогов для пользователя {user_id}")
+            if stale_age is not None:
+                response.headers.update(stale_headers(stale_age))
             return dialogs
+        except RetryAfterError as e:
+            # Превышен лимит запросов: срок FloodWait - в исключении
+            logger.warning(f"Ответ 429, Retry-After {e.seconds} с")
+            raise HTTPException(status_code=429, detail=str(e), headers=retry_after_headers(e))
         except ValueError as e:
             logger.error(f"Ошибка при получении диалогов: {e}")
             error_message = str(e)
             
-            if "Превышен лимит запросов к API Telegram" in error_message:
-                # Если превышен лимит запросов, возвращаем соответствующую ошибку
-                raise HTTPException(status_code=429, detail=error_message)
-            elif "Аккаунт заблокирован Telegram" in error_message:
+            if "Аккаунт заблокирован Telegram" in error_message:
                 # Если аккаунт заблокирован, возвращаем соответствующую ошибку
                 raise HTTPException(status_code=403, detail=error_message)
             elif "Сессия для пользователя" in error_message and "не найдена" in error_message:
                 # Добавляем подробную информацию о сессии
-                session_path = f"/app/backend/app/sessions/user_{user_id_int}.session"
-                session_exists = os.path.exists(session_path)
-                sessions_dir = "/app/backend/app/sessions"
-                sessions_dir_exists = os.path.exists(sessions_dir)
-                sessions_list = os.listdir(sessions_dir) if sessions_dir_exists else []
+                session_path = f"{session_db.path}#user_{user_id_int}"
+                session_exists = session_db.has_session(f"user_{user_id_int}")
+                sessions_dir_exists = session_db.dir_exists
+                sessions_list = session_db.list_sessions()
                 
                 detail = {
                     "message": "Требуется авторизация в Telegram",
@@ -120,6 +138,8 @@ async def list_dialogs(
             else:
                 # Возвращаем подробную информацию об ошибке
                 raise HTTPException(status_code=400, detail=error_message)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Ошибка при получении диалогов: {e}")
         # Возвращаем подробную информацию об ошибке
@@ -131,16 +151,20 @@ async def list_dialogs(
         raise HTTPException(status_code=500, detail=error_detail)
 
 # Эндпоинт для получения сообщений из диалога
-@router.get("/{dialog_id}/messages", response_model=List[Dict[str, Any]])
+@router.get("/{dialog_id}/messages", response_model=Union[List[Dict[str, Any]], Dict[str, Any]])
 async def list_messages(
     dialog_id: int,
     limit: int = Query(20, ge=1, le=100),
     offset_id: int = Query(0, ge=0),
     force_refresh: bool = Query(False, description="Принудительно обновить кэш"),
+    normalize: bool = Query(False, description="Вернуть отправителей отдельными таблицами users/chats"),
     current_user = Depends(get_current_user)
 ):
     """
     Получает сообщения из диалога
+    
+    С normalize=true возвращает {"messages": [...], "users": {...}, "chats": {...}},
+    где сообщения ссылаются на отправителя через sender_id.
     """
     try:
         user_id = current_user['id']
@@ -155,26 +179,26 @@ async def list_messages(
         
         # Получаем сообщения из Telegram
         try:
-            messages = await get_messages(user_id_int, dialog_id, limit, offset_id, force_refresh=force_refresh)
-            logger.info(f"Получено {len(messages)} сообщений из диалога {dialog_id}")
+            messages = await get_messages(user_id_int, dialog_id, limit, offset_id, force_refresh=force_refresh, normalize=normalize)
+            logger.info(f"Получено {len(messages['messages'] if normalize else messages)} сообщений из диалога {dialog_id}")
             return messages
+        except RetryAfterError as e:
+            # Превышен лимит запросов: срок FloodWait - в исключении
+            logger.warning(f"Ответ 429, Retry-After {e.seconds} с")
+            raise HTTPException(status_code=429, detail=str(e), headers=retry_after_headers(e))
         except ValueError as e:
             logger.error(f"Ошибка при получении сообщений: {e}")
             error_message = str(e)
             
-            if "Превышен лимит запросов к API Telegram" in error_message:
-                # Если превышен лимит запросов, возвращаем соответствующую ошибку
-                raise HTTPException(status_code=429, detail=error_message)
-            elif "Аккаунт заблокирован Telegram" in error_message:
+            if "Аккаунт заблокирован Telegram" in error_message:
                 # Если аккаунт заблокирован, возвращаем соответствующую ошибку
                 raise HTTPException(status_code=403, detail=error_message)
             elif "Сессия для пользователя" in error_message and "не найдена" in error_message:
                 # Добавляем подробную информацию о сессии
-                session_path = f"/app/backend/app/sessions/user_{user_id_int}.session"
-                session_exists = os.path.exists(session_path)
-                sessions_dir = "/app/backend/app/sessions"
-                sessions_dir_exists = os.path.exists(sessions_dir)
-                sessions_list = os.listdir(sessions_dir) if sessions_dir_exists else []
+                session_path = f"{session_db.path}#user_{user_id_int}"
+                session_exists = session_db.has_session(f"user_{user_id_int}")
+                sessions_dir_exists = session_db.dir_exists
+                sessions_list = session_db.list_sessions()
                 
                 detail = {
                     "message": "Требуется авторизация в Telegram",
@@ -191,6 +215,8 @@ async def list_messages(
             else:
                 # Возвращаем подробную информацию об ошибке
                 raise HTTPException(status_code=400, detail=error_message)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Ошибка при получении сообщений: {e}")
         # Возвращаем подробную информацию об ошибке
@@ -232,18 +258,21 @@ async def send_dialog_message(
             result = await send_message(user_id_int, dialog_id, message["text"], reply_to)
             logger.info(f"Сообщение успешно отправлено в диалог {dialog_id}")
             return result
+        except RetryAfterError as e:
+            # Превышен лимит запросов: срок FloodWait - в исключении
+            logger.warning(f"Ответ 429, Retry-After {e.seconds} с")
+            raise HTTPException(status_code=429, detail=str(e), headers=retry_after_headers(e))
         except ValueError as e:
             logger.error(f"Ошибка при отправке сообщения: {e}")
             error_message = str(e)
             
-            if "Превышен лимит запросов к API Telegram" in error_message:
-                # Если превышен лимит запросов, возвращаем соответствующую ошибку
-                raise HTTPException(status_code=429, detail=error_message)
-            elif "Аккаунт заблокирован Telegram" in error_message:
+            if "Аккаунт заблокирован Telegram" in error_message:
                 # Если аккаунт заблокирован, возвращаем соответствующую ошибку
                 raise HTTPException(status_code=403, detail=error_message)
             else:
                 raise HTTPException(status_code=400, detail=error_message)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Ошибка при отправке сообщения: {e}")
         raise HTTPException(status_code=500, detail=str(e))
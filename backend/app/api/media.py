@@ -0,0 +1,235 @@
+"""
+API для потоковой отдачи медиа из сообщений
+"""
+
+import os
+import asyncio
+import logging
+from typing import Optional, Tuple
+from urllib.parse import urlencode
+
+import anyio
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request
+from fastapi.responses import FileResponse, StreamingResponse
+
+from app.api.dialogs import get_current_user, retry_after_headers
+from app.core.config import settings
+from app.core.security import create_media_url_params, verify_media_signature
+from app.services.flood import RetryAfterError
+from app.services.telegram import get_client, resolve_peer
+from app.services.media import get_media_key, get_media_info, get_cached_media, iter_media, media_cache
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Создаем роутер
+router = APIRouter()
+
+
+def parse_range(range_header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    Разбирает заголовок Range с одним диапазоном
+
+    Args:
+        range_header: Значение заголовка Range
+        size: Размер файла
+
+    Returns:
+        Optional[Tuple[int, int]]: (первый байт, последний байт) или None, если заголовка нет
+            или он содержит несколько диапазонов (тогда отдается весь файл)
+
+    Raises:
+        HTTPException: 416, если диапазон не пересекается с файлом
+    """
+    if not range_header or not range_header.startswith("bytes=") or "," in range_header:
+        return None
+
+    start_str, _, end_str = range_header[len("bytes="):].strip().partition("-")
+    try:
+        if start_str:
+            start = int(start_str)
+            end = int(end_str) if end_str else size - 1
+        else:
+            # Суффиксный диапазон: последние N байт
+            start = max(size - int(end_str), 0)
+            end = size - 1
+    except ValueError:
+        return None
+
+    end = min(end, size - 1)
+    if start > end:
+        raise HTTPException(
+            status_code=416,
+            detail="Запрошенный диапазон недоступен",
+            headers={"Content-Range": f"bytes */{size}"}
+        )
+    return start, end
+
+
+class FileRangeResponse(FileResponse):
+    """
+    Отдача диапазона байт файла из кэша
+
+    Если ASGI-сервер поддерживает расширение http.response.zerocopysend,
+    файл отправляется через sendfile без копирования в пользовательское
+    пространство, иначе читается частями.
+    """
+
+    def __init__(self, path: str, start: int, end: int, size: int, **kwargs):
+        super().__init__(path, status_code=206, **kwargs)
+        self.start = start
+        self.end = end
+        self.headers["content-range"] = f"bytes {start}-{end}/{size}"
+        self.headers["content-length"] = str(end - start + 1)
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        count = self.end - self.start + 1
+
+        if "http.response.zerocopysend" in scope.get("extensions", {}):
+            async with await anyio.open_file(self.path, mode="rb") as f:
+                await send({
+                    "type": "http.response.zerocopysend",
+                    "file": f.wrapped.fileno(),
+                    "offset": self.start,
+                    "count": count,
+                    "more_body": False
+                })
+            return
+
+        async with await anyio.open_file(self.path, mode="rb") as f:
+            await f.seek(self.start)
+            while count > 0:
+                chunk = await f.read(min(self.chunk_size, count))
+                if not chunk:
+                    break
+                count -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": count > 0})
+        if count > 0:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+def get_media_user(
+    dialog_id: int,
+    msg_id: int,
+    authorization: Optional[str] = Header(None),
+    user: Optional[int] = Query(None),
+    expires: Optional[int] = Query(None),
+    sig: Optional[str] = Query(None)
+):
+    """
+    Получает пользователя по подписанной ссылке на медиа или по токену
+
+    <video> и <img> не могут передать заголовок Authorization, поэтому
+    медиа открывается по ссылке из /media/url.
+    """
+    if sig is None:
+        return get_current_user(authorization)
+
+    if user is None or expires is None or not verify_media_signature(user, dialog_id, msg_id, expires, sig):
+        logger.error(f"Недействительная ссылка на медиа {msg_id} из диалога {dialog_id}")
+        raise HTTPException(status_code=403, detail="Ссылка на медиа недействительна или истекла")
+    return {"id": user}
+
+
+# Эндпоинт для получения подписанной ссылки на медиа
+@router.get("/{dialog_id}/messages/{msg_id}/media/url")
+async def get_message_media_url(
+    dialog_id: int,
+    msg_id: int,
+    current_user = Depends(get_current_user)
+):
+    """
+    Возвращает ссылку на медиа сообщения для <video>/<img>
+
+    Ссылка подписана и действует MEDIA_URL_TTL секунд.
+    """
+    try:
+        user_id_int = int(current_user['id'])
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Неверный формат ID пользователя")
+
+    params = create_media_url_params(user_id_int, dialog_id, msg_id)
+    return {
+        "url": f"{settings.API_V1_STR}/dialogs/{dialog_id}/messages/{msg_id}/media?{urlencode(params)}",
+        "expires": int(params["expires"])
+    }
+
+
+# Эндпоинт для получения медиа из сообщения
+@router.get("/{dialog_id}/messages/{msg_id}/media")
+async def get_message_media(
+    dialog_id: int,
+    msg_id: int,
+    request: Request,
+    current_user = Depends(get_media_user)
+):
+    """
+    Потоково отдает медиа из сообщения с поддержкой Range
+
+    Принимает токен в заголовке или подписанную ссылку (см. /media/url).
+    Файлы, уже скачанные целиком, отдаются из LRU-кэша на диске.
+    """
+    try:
+        user_id_int = int(current_user['id'])
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Неверный формат ID пользователя")
+
+    key = get_media_key(user_id_int, dialog_id, msg_id)
+    range_header = request.headers.get("range")
+
+    # Попадание в кэш - отдаем файл с диска
+    cached = get_cached_media(key)
+    size = None
+    if cached:
+        try:
+            size = await asyncio.to_thread(os.path.getsize, cached[0])
+        except OSError:
+            # Файл удалили после проверки индекса - получаем заново
+            logger.warning(f"Файл медиа {key} пропал из кэша")
+            media_cache.drop(key)
+    if size is not None:
+        path, mime_type = cached
+        byte_range = parse_range(range_header, size)
+        headers = {"Accept-Ranges": "bytes", "Cache-Control": "private, max-age=86400"}
+        if byte_range:
+            return FileRangeResponse(path, byte_range[0], byte_range[1], size, media_type=mime_type, headers=headers)
+        return FileResponse(path, media_type=mime_type, headers=headers)
+
+    # Промах - получаем сообщение и проксируем файл из Telegram
+    try:
+        client = await get_client(user_id_int)
+        peer = await resolve_peer(client, user_id_int, dialog_id)
+        message = await client.get_messages(peer, ids=msg_id)
+    except RetryAfterError as e:
+        logger.warning(f"Ответ 429, Retry-After {e.seconds} с")
+        raise HTTPException(status_code=429, detail=str(e), headers=retry_after_headers(e))
+    except Exception as e:
+        logger.error(f"Ошибка при получении сообщения {msg_id} из диалога {dialog_id}: {e}")
+        raise HTTPException(status_code=400, detail=f"Ошибка при получении сообщения: {str(e)}")
+
+    info = get_media_info(message) if message else None
+    if not info:
+        raise HTTPException(status_code=404, detail="Медиа не найдено")
+
+    size = info["size"]
+    headers = {"Cache-Control": "private, max-age=86400"}
+    byte_range = parse_range(range_header, size) if size is not None else None
+    if size is not None:
+        headers["Accept-Ranges"] = "bytes"
+
+    if byte_range:
+        start, end = byte_range
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        headers["Content-Length"] = str(end - start + 1)
+        return StreamingResponse(
+            iter_media(client, message, key, start, end),
+            status_code=206,
+            media_type=info["mime_type"],
+            headers=headers
+        )
+
+    if size is not None:
+        headers["Content-Length"] = str(size)
+    return StreamingResponse(iter_media(client, message, key), media_type=info["mime_type"], headers=headers)
@@ -1,6 +1,6 @@
 import os
 import secrets
-from typing import List, Optional, Union, Any
+from typing import Dict, List, Optional, Union, Any
 
 from pydantic import AnyHttpUrl, BaseSettings, validator
 
@@ -38,6 +38,20 @@ class Settings(BaseSettings):
         # Если значение уже список или другой тип
         return v
     
+    @validator("FAIR_USER_WEIGHTS")
+    def check_fair_weights(cls, v: Dict[int, float]) -> Dict[int, float]:
+        # С весом 0 пользователь не накапливает кредит, и очередь зацикливается
+        for user_id, weight in v.items():
+            if weight <= 0:
+                raise ValueError(f"Вес пользователя {user_id} в FAIR_USER_WEIGHTS должен быть больше 0")
+        return v
+    
+    @validator("FAIR_OUTBOUND_QUANTUM", "FAIR_CPU_BATCH")
+    def check_fair_quantum(cls, v: float, field) -> float:
+        if v <= 0:
+            raise ValueError(f"{field.name} должен быть больше 0")
+        return v
+    
     # Настройки Telegram
     TELEGRAM_API_ID: int
     TELEGRAM_API_HASH: str
@@ -59,6 +73,69 @@ class Settings(BaseSettings):
     # Настройки сессий
     SESSIONS_DIR: str = os.path.join(os.path.dirname(os.path.dirname(__file__)), "sessions")
     
+    # Настройки пула клиентов Telegram
+    CLIENT_POOL_MAX_CLIENTS: int = 200  # Максимум одновременно подключенных клиентов
+    CLIENT_IDLE_TIMEOUT: float = 15 * 60.0  # Простаивающий клиент отключается через (в секундах)
+    CLIENT_REAP_INTERVAL: float = 60.0  # Период проверки простаивающих клиентов (в секундах)
+    CLIENT_HEALTH_CHECK_INTERVAL: float = 5 * 60.0  # Период проверки авторизации клиентов (в секундах)
+    
+    # Настройки входа по коду
+    AUTH_PENDING_TTL: float = 10 * 60.0  # Время жизни незавершенного входа (в секундах)
+    AUTH_MAX_PENDING: int = 100  # Максимум одновременных незавершенных входов
+    AUTH_MAX_CODES_PER_PHONE: int = 5  # Максимум отправок кода на один номер за AUTH_PENDING_TTL
+    AUTH_CODE_RESEND_INTERVAL: float = 60.0  # Повторный запрос кода раньше возвращает уже отправленный (в секундах)
+    AUTH_REAP_INTERVAL: float = 30.0  # Период удаления истекших входов (в секундах)
+    
+    # Ограничение частоты запросов MTProto (запросов в секунду)
+    RATE_LIMIT_READ: float = 10.0  # Чтение (диалоги, сообщения, сущности) на пользователя
+    RATE_LIMIT_SEND: float = 1.0  # Отправка и изменение сообщений на пользователя
+    RATE_LIMIT_DOWNLOAD: float = 30.0  # Части загружаемых файлов на пользователя
+    RATE_LIMIT_AUTH: float = 0.5  # Запросы входа на временного пользователя
+    RATE_LIMIT_GLOBAL: float = 300.0  # Всего на TELEGRAM_API_ID
+    RATE_LIMIT_BURST_SECONDS: float = 3.0  # Емкость корзины: столько секунд запросов можно выполнить подряд
+    FLOOD_RETRY_MAX_WAIT: float = 5.0  # FloodWait не длиннее этого выжидается и запрос повторяется (в секундах)
+    FLOOD_MAX_RETRIES: int = 2  # Максимум повторов запроса после FloodWait
+    PRIORITY_SLOTS_PER_USER: int = 8  # Одновременных запросов MTProto на одного пользователя
+    PRIORITY_RESERVED_INTERACTIVE: int = 2  # Из них не занимаются фоновыми запросами (аватары, обновление кэша)
+    FAIR_MAX_INFLIGHT: int = 64  # Одновременных запросов MTProto всех пользователей, сверх - очередь по кругу между пользователями
+    FAIR_OUTBOUND_QUANTUM: float = 4.0  # Запросов пользователя за один проход очереди
+    FAIR_CPU_BATCH: int = 100  # Элементов в одной части при преобразовании больших списков
+    FAIR_USER_WEIGHTS: Dict[int, float] = {}  # Веса пользователей в очереди (по умолчанию 1), JSON: {"user_id": вес}
+    
+    # Настройки загрузки аватаров
+    AVATAR_CONCURRENCY: int = 8  # Одновременных загрузок на одного пользователя
+    AVATAR_HYDRATION_TIMEOUT: float = 3.0  # Бюджет времени на аватары списка диалогов (в секундах)
+    AVATAR_SOURCES_TTL: float = 24 * 3600.0  # Сколько помнить, через какого пользователя скачивать аватар (в секундах)
+    AVATAR_SOURCES_MAX_BYTES: int = 32 * 1024 * 1024  # Лимит памяти источников аватаров (сущностей)
+    
+    # Настройки кэшей диалогов и сообщений в памяти
+    CACHE_MAX_BYTES: int = 256 * 1024 * 1024  # Общий лимит каждого кэша
+    CACHE_USER_MAX_BYTES: int = 32 * 1024 * 1024  # Лимит на одного пользователя
+    CACHE_EXPIRY_INTERVAL: float = 60.0  # Период фоновой очистки устаревших записей (в секундах)
+    DIALOGS_MAX_STALE: float = 24 * 3600.0  # Старше этого устаревший список диалогов не отдается, обновление синхронное
+    DIALOGS_FULL_SYNC_INTERVAL: float = 6 * 3600.0  # Период полного обхода диалогов (между ними синхронизация инкрементальная)
+    MESSAGES_MAX_AGE: float = 7 * 24 * 3600.0  # Отрезки сообщений старше этого загружаются заново (новые сообщения дозапрашиваются всегда)
+    LOCAL_STORE_MAX_BYTES: int = 1024 * 1024 * 1024  # Лимит сообщений в local_store.db, сверх - удаляются давно обновленные диалоги
+    LOCAL_STORE_PRUNE_INTERVAL: float = 3600.0  # Период очистки local_store.db от устаревших диалогов (в секундах)
+    
+    # Настройки общего кэша воркеров (Redis)
+    REDIS_URL: str = ""  # redis://host:6379/0; пусто - общий кэш выключен; memory://имя - Redis в памяти процесса
+    SHARED_CACHE_PREFIX: str = "tdv"  # Префикс ключей и канала инвалидаций
+    SHARED_CACHE_TTL: float = 24 * 3600.0  # Время жизни записей в Redis (в секундах)
+    SHARED_CACHE_FLUSH_INTERVAL: float = 1.0  # Период записи изменений, сделанных на месте (в секундах)
+    
+    # Настройки шардирования пользователей по процессам (python -m app.shards)
+    SHARD_COUNT: int = 0  # Число процессов-шардов; 0 - один процесс без диспетчера (в app.shards - по числу ядер)
+    SHARD_INDEX: int = 0  # Номер шарда этого процесса (задает app.shards)
+    SHARD_SOCKET_DIR: str = "/tmp/tdv-shards"  # Директория Unix-сокетов шардов
+    SHARD_VIRTUAL_NODES: int = 64  # Точек шарда на кольце согласованного хеширования
+    SHARD_FORWARD_TIMEOUT: float = 120.0  # Таймаут ответа шарда диспетчеру (в секундах)
+    
+    # Настройки кэша медиа
+    MEDIA_CACHE_MAX_BYTES: int = 1024 * 1024 * 1024  # 1 ГБ на диске
+    MEDIA_CACHE_MAX_FILE_BYTES: int = 200 * 1024 * 1024  # Файлы крупнее только проксируются
+    MEDIA_URL_TTL: float = 3600.0  # Срок действия подписанной ссылки на медиа для <video>/<img> (в секундах)
+    
     class Config:
         case_sensitive = True
         env_file = ".env"
@@ -107,6 +107,83 @@ def verify_token(token: str) -> Optional[TokenData]:
         return None
 
 
+def sign_avatar(peer_id: int, photo_id: int) -> str:
+    """
+    Подписывает пару peer_id/photo_id для URL аватара
+
+    <img> не передает заголовок Authorization, поэтому URL аватара выдается
+    только авторизованному пользователю вместе с подписью. Без подписи
+    эндпоинт не скачивает аватары из Telegram по произвольным peer_id.
+
+    Args:
+        peer_id: ID диалога
+        photo_id: ID фото
+
+    Returns:
+        str: Подпись для параметра sig
+    """
+    message = f"avatar:{peer_id}:{photo_id}".encode()
+    return hmac.new(settings.SECRET_KEY.encode(), message, hashlib.sha256).hexdigest()[:32]
+
+
+def verify_avatar_signature(peer_id: int, photo_id: int, signature: Optional[str]) -> bool:
+    """
+    Проверяет подпись URL аватара
+
+    Args:
+        peer_id: ID диалога
+        photo_id: ID фото
+        signature: Значение параметра sig
+
+    Returns:
+        bool: True, если подпись верна, иначе False
+    """
+    if not signature:
+        return False
+    return hmac.compare_digest(sign_avatar(peer_id, photo_id), signature)
+
+
+def sign_media(user_id: int, dialog_id: int, msg_id: int, expires: int) -> str:
+    """
+    Подписывает ссылку на медиа сообщения пользователя до срока expires
+    """
+    message = f"media:{user_id}:{dialog_id}:{msg_id}:{expires}".encode()
+    return hmac.new(settings.SECRET_KEY.encode(), message, hashlib.sha256).hexdigest()
+
+
+def create_media_url_params(user_id: int, dialog_id: int, msg_id: int) -> Dict[str, str]:
+    """
+    Параметры подписанной ссылки на медиа (user, expires, sig)
+
+    <video> и <img> не передают заголовок Authorization, поэтому медиа
+    открывается по ссылке с подписью. Ссылка действует MEDIA_URL_TTL секунд
+    и только для одного сообщения, поэтому ее утечка не дает доступа к
+    остальным данным пользователя.
+
+    Args:
+        user_id: ID пользователя
+        dialog_id: ID диалога
+        msg_id: ID сообщения
+
+    Returns:
+        Dict[str, str]: Параметры запроса
+    """
+    expires = int(time.time() + settings.MEDIA_URL_TTL)
+    return {"user": str(user_id), "expires": str(expires), "sig": sign_media(user_id, dialog_id, msg_id, expires)}
+
+
+def verify_media_signature(user_id: int, dialog_id: int, msg_id: int, expires: int, signature: str) -> bool:
+    """
+    Проверяет подпись и срок ссылки на медиа
+
+    Returns:
+        bool: True, если ссылка действительна, иначе False
+    """
+    if expires < time.time():
+        return False
+    return hmac.compare_digest(sign_media(user_id, dialog_id, msg_id, expires), signature)
+
+
 def verify_telegram_auth(data: Dict[str, Any]) -> bool:
     """
     Проверяет данные авторизации через Telegram
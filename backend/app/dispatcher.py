@@ -0,0 +1,282 @@
+"""
+Диспетчер шардов: передает запрос API процессу, в котором живет клиент пользователя
+
+Запускается через app.shards. Процессы-шарды (app.main) слушают
+Unix-сокеты в SHARD_SOCKET_DIR, диспетчер принимает HTTP-запросы и
+передает их как есть. Шард выбирается по кольцу согласованного
+хеширования (см. app.services.shards):
+
+- запрос с токеном - по user_id из токена;
+- медиа по подписанной ссылке (без заголовка Authorization) - по
+  параметру user, подпись проверяет шард;
+- вход по коду (/auth/*) - по номеру телефона, чтобы все шаги входа
+  попали на шард, где ждет клиент входа;
+- аватар - из общего дискового кэша, а если его там нет - у шардов по
+  очереди, пока один не ответит не 404;
+- остальное (вебхук бота, статика) - на шард 0.
+"""
+import json
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
+
+from app.core.config import settings
+from app.core.security import verify_avatar_signature, verify_token
+from app.services.avatars import AVATAR_CACHE_CONTROL, get_avatar_path, is_avatar_cached
+from app.services.shards import ShardRing, phone_key, socket_path, user_key
+
+logger = logging.getLogger(__name__)
+
+# Заголовки соединения, которые не передаются через прокси
+HOP_HEADERS = {
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "te", "trailer", "transfer-encoding", "upgrade"
+}
+
+# Заголовки ответа, которые сервер диспетчера добавляет сам
+SERVER_HEADERS = {"date", "server"}
+
+AUTH_PREFIX = f"{settings.API_V1_STR}/auth/"
+AVATARS_PREFIX = f"{settings.API_V1_STR}/avatars/"
+
+# Сколько последних найденных шардов аватаров помнить
+AVATAR_ROUTES = 10000
+
+
+class ShardDispatcher:
+    """
+    Пересылка запросов шардам через Unix-сокеты
+
+    Ответ шарда передается потоком, поэтому медиа с Range и большие
+    файлы не буферизуются в диспетчере.
+    """
+
+    def __init__(self, count: int, virtual_nodes: int, timeout: float):
+        self.ring = ShardRing(count, virtual_nodes)
+        self.timeout = timeout
+        self.clients: List[httpx.AsyncClient] = []
+        # photo_id -> шард, который отдал аватар
+        self.avatar_routes: "OrderedDict[int, int]" = OrderedDict()
+        self.forwarded: List[int] = [0] * self.ring.count
+        self.stats: Dict[str, int] = {
+            "requests": 0,
+            "by_token": 0,
+            "by_phone": 0,
+            "by_signed_url": 0,
+            "default": 0,
+            "avatars_from_disk": 0,
+            "avatar_probes": 0,
+            "unavailable": 0
+        }
+
+    def start(self) -> None:
+        self.clients = [
+            httpx.AsyncClient(
+                transport=httpx.AsyncHTTPTransport(uds=socket_path(shard)),
+                base_url=f"http://shard-{shard}",
+                timeout=httpx.Timeout(self.timeout, connect=5.0)
+            )
+            for shard in range(self.ring.count)
+        ]
+        logger.info(f"Диспетчер запущен: {self.ring.count} шардов, сокеты в {settings.SHARD_SOCKET_DIR}")
+
+    async def shutdown(self) -> None:
+        await asyncio.gather(*(client.aclose() for client in self.clients), return_exceptions=True)
+        self.clients = []
+
+    def route(self, request: Request, body: bytes) -> int:
+        """
+        Выбирает шард для запроса
+        """
+        scheme, _, token = request.headers.get("authorization", "").partition(" ")
+        if scheme.lower() == "bearer" and token:
+            token_data = verify_token(token)
+            if token_data is not None and str(token_data.user_id).isdigit():
+                self.stats["by_token"] += 1
+                return self.ring.shard_for(user_key(int(token_data.user_id)))
+
+        # <video>/<img> не передают токен: подписанная ссылка на медиа несет user
+        user = request.query_params.get("user", "")
+        if request.query_params.get("sig") and user.isdigit():
+            self.stats["by_signed_url"] += 1
+            return self.ring.shard_for(user_key(int(user)))
+
+        if request.url.path.startswith(AUTH_PREFIX) and body:
+            try:
+                data = json.loads(body)
+            except ValueError:
+                data = None
+            if isinstance(data, dict) and data.get("phone_number"):
+                self.stats["by_phone"] += 1
+                return self.ring.shard_for(phone_key(str(data["phone_number"])))
+
+        # Запросы без пользователя (вебхук, статика, проверки) и недействительные
+        # токены (шард ответит 401)
+        self.stats["default"] += 1
+        return 0
+
+    async def forward(self, shard: int, request: Request, body: bytes) -> Response:
+        """
+        Передает запрос шарду и отдает его ответ потоком
+        """
+        response = await self._send(shard, request, body)
+        if response is None:
+            return self._unavailable(shard)
+        return self._stream(shard, response)
+
+    async def avatar(self, request: Request, body: bytes) -> Response:
+        """
+        Отдает аватар из общего дискового кэша или находит шард, который может его скачать
+        """
+        try:
+            peer_id, photo_id = (int(part) for part in request.url.path.rstrip("/").rsplit("/", 2)[-2:])
+        except ValueError:
+            return await self.forward(0, request, body)
+
+        # Без подписи не отдаем файл и не будим шарды (см. app.api.avatars)
+        if not verify_avatar_signature(peer_id, photo_id, request.query_params.get("sig")):
+            return JSONResponse({"detail": "Неверная подпись аватара"}, status_code=403)
+
+        if is_avatar_cached(photo_id):
+            # Аватар уже скачал какой-то шард - отдаем файл сами, как эндпоинт аватара
+            self.stats["avatars_from_disk"] += 1
+            etag = f'"{photo_id}"'
+            headers = {"ETag": etag, "Cache-Control": AVATAR_CACHE_CONTROL}
+            if request.headers.get("if-none-match") == etag:
+                return Response(status_code=304, headers=headers)
+            return FileResponse(get_avatar_path(photo_id), media_type="image/jpeg", headers=headers)
+
+        # Источник аватара есть только у шарда пользователя, которому выдан
+        # диалог: начинаем с запомненного, остальные отвечают 404
+        known = self.avatar_routes.get(photo_id)
+        order = list(range(self.ring.count))
+        if known is not None:
+            order.remove(known)
+            order.insert(0, known)
+
+        last: Optional[Tuple[int, httpx.Response]] = None
+        for shard in order:
+            self.stats["avatar_probes"] += 1
+            response = await self._send(shard, request, body)
+            if response is None:
+                continue
+            if response.status_code != 404:
+                self._remember_avatar(photo_id, shard)
+                if last is not None:
+                    await last[1].aclose()
+                return self._stream(shard, response)
+            if last is not None:
+                await last[1].aclose()
+            last = (shard, response)
+
+        if last is None:
+            return self._unavailable(order[0])
+        return self._stream(*last)
+
+    async def get_stats(self) -> Dict[str, Any]:
+        """
+        Счетчики диспетчера и /stats каждого шарда
+        """
+        async def shard_stats(client: httpx.AsyncClient) -> Any:
+            try:
+                response = await client.get("/stats")
+                return response.json()
+            except Exception as e:
+                return {"error": str(e)}
+
+        shards = await asyncio.gather(*(shard_stats(client) for client in self.clients))
+        return {
+            "dispatcher": dict(self.stats, shards=self.ring.count, forwarded=self.forwarded),
+            "shards": shards
+        }
+
+    async def _send(self, shard: int, request: Request, body: bytes) -> Optional[httpx.Response]:
+        headers = [
+            (name, value) for name, value in request.headers.raw
+            if name.decode("latin-1").lower() not in HOP_HEADERS
+        ]
+        if request.client is not None:
+            headers.append((b"x-forwarded-for", request.client.host.encode("latin-1")))
+
+        client = self.clients[shard]
+        outgoing = client.build_request(
+            request.method,
+            httpx.URL(path=request.url.path, query=request.url.query.encode("utf-8")),
+            headers=headers,
+            content=body
+        )
+        try:
+            response = await client.send(outgoing, stream=True)
+        except httpx.TransportError as e:
+            self.stats["unavailable"] += 1
+            logger.error(f"Шард {shard} недоступен: {e}")
+            return None
+        self.forwarded[shard] += 1
+        return response
+
+    def _stream(self, shard: int, response: httpx.Response) -> Response:
+        result = StreamingResponse(
+            response.aiter_raw(),
+            status_code=response.status_code,
+            background=BackgroundTask(response.aclose)
+        )
+        result.raw_headers = [
+            (name.encode("latin-1"), value.encode("latin-1"))
+            for name, value in response.headers.multi_items()
+            if name.lower() not in HOP_HEADERS and name.lower() not in SERVER_HEADERS
+        ] + [(b"x-shard", str(shard).encode("latin-1"))]
+        return result
+
+    def _unavailable(self, shard: int) -> Response:
+        return JSONResponse(
+            {"detail": f"Шард {shard} недоступен, повторите запрос позже"},
+            status_code=503,
+            headers={"Retry-After": "1"}
+        )
+
+    def _remember_avatar(self, photo_id: int, shard: int) -> None:
+        self.avatar_routes[photo_id] = shard
+        self.avatar_routes.move_to_end(photo_id)
+        while len(self.avatar_routes) > AVATAR_ROUTES:
+            self.avatar_routes.popitem(last=False)
+
+
+dispatcher = ShardDispatcher(settings.SHARD_COUNT, settings.SHARD_VIRTUAL_NODES, settings.SHARD_FORWARD_TIMEOUT)
+
+app = FastAPI(title=f"{settings.APP_NAME} (диспетчер шардов)", docs_url=None, redoc_url=None, openapi_url=None)
+
+
+@app.on_event("startup")
+async def on_startup():
+    dispatcher.start()
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await dispatcher.shutdown()
+
+
+@app.get("/stats")
+async def stats():
+    """
+    Статистика диспетчера и всех шардов
+    """
+    return await dispatcher.get_stats()
+
+
+@app.api_route("/{path:path}", methods=["GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"])
+async def proxy(request: Request):
+    """
+    Передает любой другой запрос шарду
+    """
+    dispatcher.stats["requests"] += 1
+    body = await request.body()
+    if request.method in ("GET", "HEAD") and request.url.path.startswith(AVATARS_PREFIX):
+        return await dispatcher.avatar(request, body)
+    return await dispatcher.forward(dispatcher.route(request, body), request, body)
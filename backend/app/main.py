@@ -1,16 +1,18 @@
 import os
 import logging
 import json
+import asyncio
 import httpx
 from fastapi import FastAPI, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, FileResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse
 from datetime import datetime
 
 from app.core.config import settings
-from app.api import auth, dialogs
+from app.api import auth, dialogs, avatars, media
 from app.core.security import verify_token
+from app.services.flood import RetryAfterError
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -29,6 +31,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Age", "Warning"],  # Признак устаревшего списка диалогов
 )
 
 # Подключаем роутеры
@@ -42,6 +45,16 @@ app.include_router(
     prefix=f"{settings.API_V1_STR}/dialogs",
     tags=["dialogs"]
 )
+app.include_router(
+    media.router,
+    prefix=f"{settings.API_V1_STR}/dialogs",
+    tags=["media"]
+)
+app.include_router(
+    avatars.router,
+    prefix=f"{settings.API_V1_STR}/avatars",
+    tags=["avatars"]
+)
 
 # Проверяем, существует ли директория для статических файлов
 static_dir = os.path.join(os.path.dirname(__file__), "static")
@@ -215,6 +228,45 @@ async def on_startup():
     """
     logger.info("Запуск приложения...")
     
+    # Запускаем фоновую очистку кэшей
+    from app.services.cache import start_expiry
+    start_expiry()
+    
+    # Подключаемся к общему кэшу воркеров (если задан REDIS_URL)
+    from app.services.shared_cache import shared_cache
+    await shared_cache.start()
+    
+    # Проверяем директорию сессий и переносим старые файлы сессий в общую базу
+    # (шарды делят базу, ее обслуживает app.shards до их запуска)
+    from app.services.session_store import session_db
+    from app.services.shards import is_sharded
+    await session_db.start(maintenance=not is_sharded())
+    if shared_cache.enabled and not is_sharded():
+        # Общий кэш обычно означает uvicorn --workers, а клиента каждый воркер подключает свой
+        logger.warning(
+            "Общий кэш включен без шардов: при нескольких воркерах у пользователя будет по клиенту "
+            "Telegram в каждом воркере, а незавершенные входы живут в памяти воркера - запросы "
+            "входа по коду должны попадать на один воркер (sticky-маршрутизация). "
+            "Один клиент на пользователя дает запуск через app.shards"
+        )
+    
+    # Запускаем очистку локального хранилища от устаревших диалогов
+    from app.services.local_store import local_store
+    from app.services.telegram import messages_cache
+    local_store.start(settings.LOCAL_STORE_PRUNE_INTERVAL, lambda: set(messages_cache.entries))
+    
+    # Запускаем удаление истекших незавершенных входов
+    from app.services.pending_auth import pending_auth
+    pending_auth.start(settings.AUTH_REAP_INTERVAL)
+    
+    # Запускаем отключение простаивающих клиентов Telegram и проверку их авторизации
+    from app.services.client_pool import client_pool
+    client_pool.start(settings.CLIENT_REAP_INTERVAL, settings.CLIENT_HEALTH_CHECK_INTERVAL)
+    
+    # Вебхук бота общий для всех шардов - его устанавливает шард 0
+    if is_sharded() and settings.SHARD_INDEX != 0:
+        return
+    
     # Проверяем токен бота
     try:
         me_url = f"{TELEGRAM_API_URL}/getMe"
@@ -251,6 +303,28 @@ async def on_shutdown():
     """
     logger.info("Остановка приложения...")
     
+    # Останавливаем фоновую очистку кэшей
+    from app.services.cache import stop_expiry
+    await stop_expiry()
+    
+    # Одновременно отключаем все клиенты Telegram
+    from app.services.client_pool import client_pool
+    await client_pool.shutdown()
+    from app.services.pending_auth import pending_auth
+    await pending_auth.shutdown()
+    
+    # Дописываем изменения в общий кэш воркеров
+    from app.services.shared_cache import shared_cache
+    await shared_cache.shutdown()
+    
+    # Дописываем очередь записи в локальное хранилище
+    from app.services.local_store import local_store
+    await local_store.shutdown()
+    
+    # Закрываем общую базу сессий
+    from app.services.session_store import session_db
+    await asyncio.to_thread(session_db.close)
+    
     # Удаляем вебхук
     await delete_telegram_webhook()
     
@@ -281,6 +355,42 @@ async def health():
     """
     return {"status": "ok"}
 
+@app.get("/stats")
+async def stats():
+    """
+    Внутренняя статистика кэшей и загрузок
+    """
+    from app.services.avatars import avatar_stats
+    from app.services.media import media_cache
+    from app.services.cache import caches
+    from app.services.inflight import coalescing_stats, inflight
+    from app.services.telegram import update_stats, dialog_sync_stats, peer_cache_stats, input_peers
+    from app.services.local_store import local_store
+    from app.services.client_pool import client_pool
+    from app.services.pending_auth import pending_auth
+    from app.services.rate_limit import rate_limiter
+    from app.services.flood import flood_control
+    from app.services.priority import priority_scheduler
+    from app.services.fair import outbound_scheduler, cpu_scheduler
+    from app.services.shared_cache import shared_cache
+    return {
+        "caches": {name: cache.get_stats() for name, cache in caches.items()},
+        "shared_cache": shared_cache.get_stats(),
+        "client_pool": client_pool.get_stats(),
+        "pending_auth": pending_auth.get_stats(),
+        "rate_limit": rate_limiter.get_stats(),
+        "flood_wait": flood_control.get_stats(),
+        "priority": priority_scheduler.get_stats(),
+        "fair": {"outbound": outbound_scheduler.get_stats(), "cpu": cpu_scheduler.get_stats()},
+        "coalescing": {"operations": coalescing_stats, "inflight": len(inflight)},
+        "updates": update_stats,
+        "dialog_sync": dialog_sync_stats,
+        "peer_cache": dict(peer_cache_stats, peers=sum(len(p) for p in input_peers.values())),
+        "local_store": local_store.stats,
+        "avatars": avatar_stats,
+        "media_cache": dict(media_cache.stats, files=len(media_cache.entries), bytes=media_cache.total_bytes)
+    }
+
 @app.get("/bot-info")
 async def bot_info():
     """
@@ -471,38 +581,39 @@ async def get_dialogs_direct(request: Request):
         
         # Получаем диалоги из Telegram
         try:
-            from app.services.telegram import get_dialogs
+            from app.services.telegram import get_dialogs_with_age
+            from app.api.dialogs import stale_headers, retry_after_headers
             logger.info(f"Вызов функции get_dialogs для пользователя {user_id_int}")
-            dialogs = await get_dialogs(user_id_int, force_refresh=force_refresh)
+            dialogs, stale_age = await get_dialogs_with_age(user_id_int, force_refresh=force_refresh)
             logger.info(f"Получено {len(dialogs)} диалогов для пользователя {user_id}")
-            return JSONResponse(dialogs)
+            return JSONResponse(dialogs, headers=stale_headers(stale_age) if stale_age is not None else None)
+        except RetryAfterError as e:
+            # Превышен лимит запросов: срок FloodWait - в исключении
+            logger.warning(f"Ответ 429, Retry-After {e.seconds} с")
+            return JSONResponse({"detail": str(e)}, status_code=429, headers=retry_after_headers(e))
         except ValueError as e:
             logger.error(f"Ошибка при получении диалогов: {e}")
             error_message = str(e)
             
-            if "Превышен лимит запросов к API Telegram" in error_message:
-                # Если превышен лимит запросов, возвращаем соответствующую ошибку
-                return JSONResponse({"detail": error_message}, status_code=429)
-            elif "Аккаунт заблокирован Telegram" in error_message:
+            if "Аккаунт заблокирован Telegram" in error_message:
                 # Если аккаунт заблокирован, возвращаем соответствующую ошибку
                 return JSONResponse({"detail": error_message}, status_code=403)
             elif "Сессия для пользователя" in error_message and "не найдена" in error_message:
                 # Если сессия не найдена, возвращаем подробную информацию о сессии
-                import os
                 from app.core.config import settings
+                from app.services.session_store import session_db
                 
                 # Собираем информацию о сессии
-                session_path = os.path.join(settings.SESSIONS_DIR, f"user_{user_id_int}.session")
-                session_exists = os.path.exists(session_path)
-                sessions_dir_exists = os.path.exists(settings.SESSIONS_DIR)
+                session_path = f"{session_db.path}#user_{user_id_int}"
+                session_exists = session_db.has_session(f"user_{user_id_int}")
+                sessions_dir_exists = session_db.dir_exists
                 
-                # Получаем список файлов в директории сессий
+                # Получаем список сессий в общей базе
                 sessions_list = []
-                if sessions_dir_exists:
-                    try:
-                        sessions_list = [f for f in os.listdir(settings.SESSIONS_DIR) if f.endswith('.session')]
-                    except Exception as list_error:
-                        logger.error(f"Ошибка при получении списка сессий: {list_error}")
+                try:
+                    sessions_list = session_db.list_sessions()
+                except Exception as list_error:
+                    logger.error(f"Ошибка при получении списка сессий: {list_error}")
                 
                 # Формируем подробную информацию об ошибке
                 session_info = {
@@ -574,7 +685,8 @@ async def get_messages_direct(dialog_id: str, request: Request):
         limit = int(request.query_params.get("limit", "50"))
         offset = int(request.query_params.get("offset", "0"))
         force_refresh = request.query_params.get("force_refresh", "false").lower() == "true"
-        logger.info(f"Параметры: limit={limit}, offset={offset}, force_refresh={force_refresh}")
+        normalize = request.query_params.get("normalize", "false").lower() == "true"
+        logger.info(f"Параметры: limit={limit}, offset={offset}, force_refresh={force_refresh}, normalize={normalize}")
         
         # Преобразуем ID пользователя в целое число
         try:
@@ -587,37 +699,38 @@ async def get_messages_direct(dialog_id: str, request: Request):
         # Получаем сообщения из Telegram
         try:
             from app.services.telegram import get_messages
+            from app.api.dialogs import retry_after_headers
             logger.info(f"Вызов функции get_messages для пользователя {user_id_int} и диалога {dialog_id}")
-            messages = await get_messages(user_id_int, dialog_id, limit=limit, offset=offset, force_refresh=force_refresh)
-            logger.info(f"Получено {len(messages)} сообщений для диалога {dialog_id}")
+            messages = await get_messages(user_id_int, dialog_id, limit=limit, offset=offset, force_refresh=force_refresh, normalize=normalize)
+            logger.info(f"Получено {len(messages['messages'] if normalize else messages)} сообщений для диалога {dialog_id}")
             return JSONResponse(messages)
+        except RetryAfterError as e:
+            # Превышен лимит запросов: срок FloodWait - в исключении
+            logger.warning(f"Ответ 429, Retry-After {e.seconds} с")
+            return JSONResponse({"detail": str(e)}, status_code=429, headers=retry_after_headers(e))
         except ValueError as e:
             logger.error(f"Ошибка при получении сообщений: {e}")
             error_message = str(e)
             
-            if "Превышен лимит запросов к API Telegram" in error_message:
-                # Если превышен лимит запросов, возвращаем соответствующую ошибку
-                return JSONResponse({"detail": error_message}, status_code=429)
-            elif "Аккаунт заблокирован Telegram" in error_message:
+            if "Аккаунт заблокирован Telegram" in error_message:
                 # Если аккаунт заблокирован, возвращаем соответствующую ошибку
                 return JSONResponse({"detail": error_message}, status_code=403)
             elif "Сессия для пользователя" in error_message and "не найдена" in error_message:
                 # Если сессия не найдена, возвращаем подробную информацию о сессии
-                import os
                 from app.core.config import settings
+                from app.services.session_store import session_db
                 
                 # Собираем информацию о сессии
-                session_path = os.path.join(settings.SESSIONS_DIR, f"user_{user_id_int}.session")
-                session_exists = os.path.exists(session_path)
-                sessions_dir_exists = os.path.exists(settings.SESSIONS_DIR)
+                session_path = f"{session_db.path}#user_{user_id_int}"
+                session_exists = session_db.has_session(f"user_{user_id_int}")
+                sessions_dir_exists = session_db.dir_exists
                 
-                # Получаем список файлов в директории сессий
+                # Получаем список сессий в общей базе
                 sessions_list = []
-                if sessions_dir_exists:
-                    try:
-                        sessions_list = [f for f in os.listdir(settings.SESSIONS_DIR) if f.endswith('.session')]
-                    except Exception as list_error:
-                        logger.error(f"Ошибка при получении списка сессий: {list_error}")
+                try:
+                    sessions_list = session_db.list_sessions()
+                except Exception as list_error:
+                    logger.error(f"Ошибка при получении списка сессий: {list_error}")
                 
                 # Формируем подробную информацию об ошибке
                 session_info = {
@@ -0,0 +1,218 @@
+"""
+Дисковый кэш аватаров, адресуемый по photo_id Telegram
+"""
+import os
+import json
+import asyncio
+import logging
+import tempfile
+from typing import Dict, Optional, Tuple
+
+from telethon import utils
+
+from app.core.config import settings
+from app.core.security import sign_avatar
+from app.services.cache import BoundedCache
+from app.services.inflight import coalesce
+from app.services.shared_cache import shared_cache
+
+logger = logging.getLogger(__name__)
+
+# Директория для кэша аватаров (на том же volume, что и сессии)
+AVATARS_DIR = os.path.join(settings.SESSIONS_DIR, "avatars")
+
+# Аватар с данным photo_id никогда не меняется, поэтому кэшируем его навсегда
+AVATAR_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Источники аватаров: photo_id -> (user_id, entity)
+# Нужны эндпоинту, чтобы скачать аватар, которого еще нет на диске
+avatar_sources = BoundedCache(
+    "avatar_sources", settings.AVATAR_SOURCES_TTL, settings.AVATAR_SOURCES_MAX_BYTES, settings.AVATAR_SOURCES_MAX_BYTES
+)
+
+# Статистика загрузок аватаров
+avatar_stats: Dict[str, int] = {
+    "downloads": 0,
+    "bytes": 0,
+    "cache_hits": 0,
+    "placeholders": 0
+}
+
+os.makedirs(AVATARS_DIR, exist_ok=True)
+
+
+def get_photo_id(entity) -> Optional[int]:
+    """
+    Получает photo_id текущего фото профиля сущности
+
+    Args:
+        entity: Сущность (пользователь, чат, канал)
+
+    Returns:
+        Optional[int]: photo_id или None, если фото отсутствует
+    """
+    photo = getattr(entity, 'photo', None)
+    return getattr(photo, 'photo_id', None) if photo else None
+
+
+def get_avatar_url(entity) -> Optional[str]:
+    """
+    Формирует URL аватара сущности
+
+    Args:
+        entity: Сущность (пользователь, чат, канал)
+
+    Returns:
+        Optional[str]: URL аватара или None, если фото отсутствует
+    """
+    photo_id = get_photo_id(entity)
+    if photo_id is None:
+        return None
+
+    peer_id = utils.get_peer_id(entity)
+    return f"{settings.API_V1_STR}/avatars/{peer_id}/{photo_id}?sig={sign_avatar(peer_id, photo_id)}"
+
+
+def get_avatar_path(photo_id: int) -> str:
+    """
+    Возвращает путь к файлу аватара в кэше
+
+    Args:
+        photo_id: ID фото профиля
+
+    Returns:
+        str: Путь к файлу
+    """
+    return os.path.join(AVATARS_DIR, f"{photo_id}.jpg")
+
+
+def is_avatar_cached(photo_id: int) -> bool:
+    """
+    Проверяет, есть ли аватар в дисковом кэше
+    """
+    return os.path.exists(get_avatar_path(photo_id))
+
+
+def register_avatar_source(user_id: int, entity) -> Optional[int]:
+    """
+    Запоминает, через какого пользователя можно скачать аватар сущности
+
+    Args:
+        user_id: ID пользователя, которому доступна сущность
+        entity: Сущность (пользователь, чат, канал)
+
+    Returns:
+        Optional[int]: photo_id или None, если фото отсутствует
+    """
+    photo_id = get_photo_id(entity)
+    if photo_id is not None:
+        if photo_id not in avatar_sources:
+            # Эндпоинт аватара может быть вызван на другом воркере
+            source = {"user_id": user_id, "peer_id": utils.get_peer_id(entity)}
+            shared_cache.put("avatar", photo_id, json.dumps(source), wake=False)
+        avatar_sources.set(photo_id, (user_id, entity), user_id)
+    return photo_id
+
+
+async def load_avatar_source(photo_id: int) -> Optional[Tuple[int, int]]:
+    """
+    Ищет в общем кэше источник аватара, выданного другим воркером
+
+    Returns:
+        Optional[Tuple[int, int]]: (user_id, peer_id) или None
+    """
+    source = await shared_cache.get("avatar", photo_id)
+    return (source["user_id"], source["peer_id"]) if source else None
+
+
+def store_avatar(photo_id: int, data: bytes) -> str:
+    """
+    Атомарно сохраняет аватар в дисковый кэш
+
+    Директория общая для шардов, поэтому временный файл у каждой записи
+    свой. Если аватар уже сохранил другой процесс, файл не перезаписывается
+    (содержимое photo_id не меняется).
+
+    Args:
+        photo_id: ID фото профиля
+        data: Содержимое файла
+
+    Returns:
+        str: Путь к файлу
+    """
+    path = get_avatar_path(photo_id)
+    if os.path.exists(path):
+        return path
+    fd, tmp_path = tempfile.mkstemp(dir=AVATARS_DIR, prefix=f"{photo_id}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return path
+
+
+async def download_avatar(client, entity) -> Optional[str]:
+    """
+    Скачивает аватар сущности в дисковый кэш, если его там еще нет
+
+    Args:
+        client: Клиент Telegram
+        entity: Сущность (пользователь, чат, канал)
+
+    Returns:
+        Optional[str]: Путь к файлу или None, если фото отсутствует
+    """
+    photo_id = get_photo_id(entity)
+    if photo_id is None:
+        return None
+
+    path = get_avatar_path(photo_id)
+    if os.path.exists(path):
+        avatar_stats["cache_hits"] += 1
+        return path
+
+    # Если этот аватар уже скачивается, ждем ту же загрузку
+    return await coalesce("avatar", (photo_id,), lambda: _fetch_avatar(client, entity, photo_id))
+
+
+async def _fetch_avatar(client, entity, photo_id: int) -> Optional[str]:
+    """
+    Скачивает маленькую версию фото профиля и сохраняет ее в кэш
+    """
+    # Скачиваем маленькую версию фото профиля (photo_small) одним запросом,
+    # без отдельного photos.getUserPhotos и без полноразмерного фото
+    photo_data = await client.download_profile_photo(entity, file=bytes, download_big=False)
+    if not photo_data:
+        return None
+
+    avatar_stats["downloads"] += 1
+    avatar_stats["bytes"] += len(photo_data)
+    # Запись файла - в потоке, чтобы не останавливать цикл событий
+    path = await asyncio.to_thread(store_avatar, photo_id, photo_data)
+    logger.info(f"Аватар {photo_id} сохранен в кэш ({len(photo_data)} байт)")
+    return path
+
+
+def get_avatar_placeholder(entity) -> Optional[bytes]:
+    """
+    Разворачивает встроенную в сущность миниатюру (stripped_thumb) в JPEG
+
+    Миниатюра приходит вместе с сущностью, поэтому заглушка доступна
+    мгновенно, без запросов к Telegram.
+
+    Args:
+        entity: Сущность (пользователь, чат, канал)
+
+    Returns:
+        Optional[bytes]: JPEG-миниатюра или None, если ее нет
+    """
+    photo = getattr(entity, 'photo', None)
+    stripped_thumb = getattr(photo, 'stripped_thumb', None) if photo else None
+    if not stripped_thumb:
+        return None
+
+    avatar_stats["placeholders"] += 1
+    return utils.stripped_photo_to_jpg(stripped_thumb)
@@ -0,0 +1,263 @@
+"""
+Ограниченный по памяти LRU-кэш с TTL для данных Telegram
+"""
+import sys
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Все созданные кэши: имя -> кэш (для статистики и фоновой очистки)
+caches: Dict[str, "BoundedCache"] = {}
+
+# Задача фоновой очистки устаревших записей
+expiry_task: Optional[asyncio.Task] = None
+
+
+def estimate_size(value: Any) -> int:
+    """
+    Оценивает объем памяти, занимаемый значением (рекурсивно по dict/list/tuple и атрибутам объектов)
+
+    Args:
+        value: Значение
+
+    Returns:
+        int: Примерный размер в байтах
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for k, v in value.items():
+            size += estimate_size(k) + estimate_size(v)
+    elif isinstance(value, (list, tuple, set)):
+        for item in value:
+            size += estimate_size(item)
+    elif hasattr(value, '__dict__'):
+        size += estimate_size(vars(value))
+    return size
+
+
+class CacheEntry:
+    """
+    Запись кэша
+    """
+    __slots__ = ("value", "user_id", "size", "created_at")
+
+    def __init__(self, value: Any, user_id: int, size: int):
+        self.value = value
+        self.user_id = user_id
+        self.size = size
+        self.created_at = time.time()
+
+    @property
+    def age(self) -> float:
+        """
+        Возраст записи в секундах
+        """
+        return time.time() - self.created_at
+
+
+class BoundedCache:
+    """
+    LRU-кэш с TTL, общим лимитом памяти и лимитом памяти на пользователя
+
+    Каждая запись принадлежит пользователю. При превышении лимита
+    пользователя вытесняются его самые старые записи, при превышении
+    общего лимита - самые старые записи всего кэша. Устаревшие записи
+    удаляются при чтении и фоновой задачей (см. start_expiry).
+    """
+
+    def __init__(self, name: str, ttl: float, max_bytes: int, max_user_bytes: int):
+        self.name = name
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_user_bytes = max_user_bytes
+        self.total_bytes = 0
+        self.entries: "OrderedDict[Hashable, CacheEntry]" = OrderedDict()
+        self.user_keys: Dict[int, "OrderedDict[Hashable, None]"] = {}
+        self.user_bytes: Dict[int, int] = {}
+        self.stats: Dict[str, int] = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+        caches[name] = self
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get_entry(key) is not None
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get_entry(self, key: Hashable) -> Optional[CacheEntry]:
+        """
+        Возвращает запись (без учета статистики), удаляя ее, если она устарела
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry.age >= self.ttl:
+            self._remove(key)
+            self.stats["expirations"] += 1
+            return None
+        return entry
+
+    def lookup(self, key: Hashable) -> Optional[CacheEntry]:
+        """
+        Возвращает запись и помечает ее как недавно использованную
+
+        Args:
+            key: Ключ
+
+        Returns:
+            Optional[CacheEntry]: Запись или None, если записи нет или она устарела
+        """
+        entry = self.get_entry(key)
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+        self.entries.move_to_end(key)
+        self.user_keys[entry.user_id].move_to_end(key)
+        self.stats["hits"] += 1
+        return entry
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """
+        Возвращает значение и помечает запись как недавно использованную
+
+        Args:
+            key: Ключ
+
+        Returns:
+            Optional[Any]: Значение или None, если записи нет или она устарела
+        """
+        entry = self.lookup(key)
+        return entry.value if entry is not None else None
+
+    def set(self, key: Hashable, value: Any, user_id: int, size: Optional[int] = None) -> None:
+        """
+        Сохраняет значение и вытесняет старые записи при превышении лимитов
+
+        Args:
+            key: Ключ
+            value: Значение
+            user_id: ID пользователя, которому принадлежит запись
+            size: Размер значения, если его ведет само значение (иначе оценивается
+                обходом всего значения - для больших значений это дорого)
+        """
+        if key in self.entries:
+            self._remove(key)
+
+        entry = CacheEntry(value, user_id, estimate_size(value) if size is None else size)
+        self.entries[key] = entry
+        self.user_keys.setdefault(user_id, OrderedDict())[key] = None
+        self.user_bytes[user_id] = self.user_bytes.get(user_id, 0) + entry.size
+        self.total_bytes += entry.size
+
+        # Сначала укладываемся в лимит пользователя, затем в общий лимит
+        while self.user_bytes.get(user_id, 0) > self.max_user_bytes and len(self.user_keys[user_id]) > 1:
+            self._evict(next(iter(self.user_keys[user_id])))
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            self._evict(next(iter(self.entries)))
+
+    def resize(self, key: Hashable, size: int) -> None:
+        """
+        Обновляет учтенный размер записи, измененной на месте (возраст и место в LRU не меняются)
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return
+        self.total_bytes += size - entry.size
+        self.user_bytes[entry.user_id] += size - entry.size
+        entry.size = size
+
+    def make_stale(self, key: Hashable, age: float) -> None:
+        """
+        Состаривает запись не меньше чем до age секунд (данные больше не считаются свежими)
+        """
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry.created_at = min(entry.created_at, time.time() - age)
+
+    def delete(self, key: Hashable) -> bool:
+        """
+        Удаляет запись
+
+        Returns:
+            bool: True, если запись была в кэше
+        """
+        if key not in self.entries:
+            return False
+        self._remove(key)
+        return True
+
+    def expire(self) -> int:
+        """
+        Удаляет все устаревшие записи
+
+        Returns:
+            int: Количество удаленных записей
+        """
+        expired = [key for key, entry in self.entries.items() if entry.age >= self.ttl]
+        for key in expired:
+            self._remove(key)
+        self.stats["expirations"] += len(expired)
+        return len(expired)
+
+    def get_stats(self) -> Dict[str, int]:
+        """
+        Счетчики и текущий размер кэша
+        """
+        return dict(self.stats, entries=len(self.entries), bytes=self.total_bytes, users=len(self.user_keys))
+
+    def _evict(self, key: Hashable) -> None:
+        self._remove(key)
+        self.stats["evictions"] += 1
+
+    def _remove(self, key: Hashable) -> None:
+        entry = self.entries.pop(key)
+        self.total_bytes -= entry.size
+        self.user_bytes[entry.user_id] -= entry.size
+        user_keys = self.user_keys[entry.user_id]
+        del user_keys[key]
+        if not user_keys:
+            del self.user_keys[entry.user_id]
+            del self.user_bytes[entry.user_id]
+
+
+async def _expiry_loop(interval: float) -> None:
+    """
+    Периодически удаляет устаревшие записи из всех кэшей
+    """
+    while True:
+        await asyncio.sleep(interval)
+        for cache in list(caches.values()):
+            try:
+                expired = cache.expire()
+                if expired:
+                    logger.info(f"Кэш {cache.name}: удалено устаревших записей: {expired}")
+            except Exception as e:
+                logger.error(f"Ошибка при очистке кэша {cache.name}: {e}")
+
+
+def start_expiry() -> None:
+    """
+    Запускает фоновую очистку устаревших записей (вызывается при старте приложения)
+    """
+    global expiry_task
+    if expiry_task is None or expiry_task.done():
+        expiry_task = asyncio.ensure_future(_expiry_loop(settings.CACHE_EXPIRY_INTERVAL))
+
+
+async def stop_expiry() -> None:
+    """
+    Останавливает фоновую очистку
+    """
+    global expiry_task
+    if expiry_task is not None:
+        expiry_task.cancel()
+        try:
+            await expiry_task
+        except asyncio.CancelledError:
+            pass
+        expiry_task = None
@@ -0,0 +1,219 @@
+"""
+Пул подключенных клиентов Telegram
+"""
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+from telethon import TelegramClient, functions, errors
+
+from app.core.config import settings
+from app.services.priority import MAINTENANCE, lane
+
+logger = logging.getLogger(__name__)
+
+
+class ClientPool:
+    """
+    Пул клиентов Telegram: не больше max_clients подключенных клиентов
+
+    Клиенты упорядочены по времени последнего использования. При
+    превышении лимита отключается самый давно использованный клиент,
+    простаивающие дольше idle_timeout отключаются фоновой задачей.
+    Создание клиента выполняется под блокировкой пользователя (см. lock),
+    чтобы одновременные запросы не подключили два клиента.
+
+    Авторизация клиента проверяется один раз при создании, а затем только
+    фоновой проверкой (check_health) и при ошибках авторизации (invalidate).
+    """
+
+    def __init__(self, max_clients: int, idle_timeout: float):
+        self.max_clients = max_clients
+        self.idle_timeout = idle_timeout
+        self.clients: "OrderedDict[int, TelegramClient]" = OrderedDict()
+        self.last_used: Dict[int, float] = {}
+        self.locks: Dict[int, asyncio.Lock] = {}
+        self.reaper_task: Optional[asyncio.Task] = None
+        self.last_health_check = time.time()
+        # Вызывается с user_id, когда клиент пользователя убран из пула
+        self.on_remove: Optional[Callable[[int], None]] = None
+        self.stats: Dict[str, int] = {
+            "created": 0,
+            "evictions": 0,
+            "idle_disconnects": 0,
+            "health_checks": 0,
+            "auth_failures": 0
+        }
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self.clients
+
+    def __len__(self) -> int:
+        return len(self.clients)
+
+    def get(self, user_id: int) -> Optional[TelegramClient]:
+        """
+        Возвращает клиент пользователя и помечает его как недавно использованный
+        """
+        client = self.clients.get(user_id)
+        if client is not None:
+            self.clients.move_to_end(user_id)
+            self.last_used[user_id] = time.time()
+        return client
+
+    def lock(self, user_id: int) -> asyncio.Lock:
+        """
+        Блокировка создания клиента пользователя
+        """
+        lock = self.locks.get(user_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self.locks[user_id] = lock
+        return lock
+
+    async def add(self, user_id: int, client: TelegramClient) -> None:
+        """
+        Добавляет подключенный клиент и отключает лишние по LRU
+
+        Args:
+            user_id: ID пользователя
+            client: Подключенный клиент
+        """
+        previous = self.clients.pop(user_id, None)
+        self.clients[user_id] = client
+        self.last_used[user_id] = time.time()
+        self.stats["created"] += 1
+
+        to_disconnect = [previous] if previous is not None and previous is not client else []
+        while len(self.clients) > self.max_clients:
+            victim_id = next(iter(self.clients))
+            logger.info(f"Пул клиентов заполнен, отключаем клиент пользователя {victim_id}")
+            to_disconnect.append(self._detach(victim_id))
+            self.stats["evictions"] += 1
+        await self._disconnect_all(to_disconnect)
+
+    async def remove(self, user_id: int) -> None:
+        """
+        Убирает клиент пользователя из пула и отключает его
+        """
+        if user_id in self.clients:
+            await self._disconnect_all([self._detach(user_id)])
+
+    async def invalidate(self, user_id: int) -> None:
+        """
+        Убирает клиент с недействительной авторизацией: следующий запрос создаст
+        клиент заново и проверит сессию
+        """
+        if user_id in self.clients:
+            logger.warning(f"Авторизация клиента пользователя {user_id} недействительна, отключаем его")
+            self.stats["auth_failures"] += 1
+            await self.remove(user_id)
+
+    async def check_health(self) -> int:
+        """
+        Проверяет авторизацию подключенных клиентов реальным запросом
+
+        is_user_authorized кэширует результат внутри клиента, поэтому для
+        проверки используется updates.getState.
+
+        Returns:
+            int: Количество убранных клиентов
+        """
+        checked = [(user_id, client) for user_id, client in self.clients.items() if client.is_connected()]
+        results = await asyncio.gather(*(self._is_authorized(client) for _, client in checked))
+        self.stats["health_checks"] += 1
+        invalid = 0
+        for (user_id, client), authorized in zip(checked, results):
+            # Клиент мог быть заменен, пока шла проверка
+            if not authorized and self.clients.get(user_id) is client:
+                await self.invalidate(user_id)
+                invalid += 1
+        return invalid
+
+    async def disconnect_idle(self) -> int:
+        """
+        Отключает клиенты, не использовавшиеся дольше idle_timeout
+
+        Returns:
+            int: Количество отключенных клиентов
+        """
+        now = time.time()
+        idle = [user_id for user_id in self.clients if now - self.last_used.get(user_id, 0) >= self.idle_timeout]
+        if idle:
+            logger.info(f"Отключаем простаивающие клиенты: {idle}")
+            await self._disconnect_all([self._detach(user_id) for user_id in idle])
+            self.stats["idle_disconnects"] += len(idle)
+        return len(idle)
+
+    def start(self, interval: float, health_check_interval: float) -> None:
+        """
+        Запускает фоновое отключение простаивающих клиентов и проверку авторизации
+        """
+        if self.reaper_task is None or self.reaper_task.done():
+            self.reaper_task = asyncio.ensure_future(self._reap_loop(interval, health_check_interval))
+
+    async def shutdown(self) -> None:
+        """
+        Останавливает фоновую задачу и одновременно отключает все клиенты
+        """
+        if self.reaper_task is not None:
+            self.reaper_task.cancel()
+            try:
+                await self.reaper_task
+            except asyncio.CancelledError:
+                pass
+            self.reaper_task = None
+        await self._disconnect_all([self._detach(user_id) for user_id in list(self.clients)])
+
+    def get_stats(self) -> Dict[str, int]:
+        """
+        Счетчики и текущий размер пула
+        """
+        return dict(self.stats, connected=len(self.clients))
+
+    def _detach(self, user_id: int) -> TelegramClient:
+        client = self.clients.pop(user_id)
+        self.last_used.pop(user_id, None)
+        lock = self.locks.get(user_id)
+        if lock is not None and not lock.locked():
+            del self.locks[user_id]
+        if self.on_remove is not None:
+            try:
+                self.on_remove(user_id)
+            except Exception as e:
+                logger.error(f"Ошибка при обработке отключения клиента пользователя {user_id}: {e}")
+        return client
+
+    async def _disconnect_all(self, clients: List[TelegramClient]) -> None:
+        results = await asyncio.gather(*(client.disconnect() for client in clients), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.warning(f"Ошибка при отключении клиента: {result}")
+
+    async def _is_authorized(self, client: TelegramClient) -> bool:
+        try:
+            with lane(MAINTENANCE):
+                await client(functions.updates.GetStateRequest())
+            return True
+        except (errors.UnauthorizedError, errors.AuthKeyError):
+            return False
+        except Exception as e:
+            # Сетевые ошибки не означают потерю авторизации
+            logger.warning(f"Ошибка при проверке авторизации клиента: {e}")
+            return True
+
+    async def _reap_loop(self, interval: float, health_check_interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.disconnect_idle()
+                if time.time() - self.last_health_check >= health_check_interval:
+                    self.last_health_check = time.time()
+                    await self.check_health()
+            except Exception as e:
+                logger.error(f"Ошибка при обслуживании пула клиентов: {e}")
+
+
+client_pool = ClientPool(settings.CLIENT_POOL_MAX_CLIENTS, settings.CLIENT_IDLE_TIMEOUT)
@@ -0,0 +1,201 @@
+"""
+Справедливое распределение работы между пользователями (deficit round robin)
+"""
+import time
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+from typing import Any, Callable, Deque, Dict, Hashable, List, Optional, Sequence, Tuple
+
+from telethon import TelegramClient, utils
+
+from app.core.config import settings
+from app.services.priority import SAMPLES, percentile
+
+logger = logging.getLogger(__name__)
+
+
+class FairScheduler:
+    """
+    Общий ресурс на capacity единиц работы, распределяемый по пользователям
+
+    Пока ресурс свободен, работа выполняется сразу. Когда он занят,
+    ожидающие выстраиваются в очереди по пользователям, а освободившиеся
+    единицы раздаются по кругу (deficit round robin): за проход пользователь
+    получает quantum * вес единиц и выполняет работу, пока хватает
+    накопленного кредита. Пользователь с тысячами запросов в очереди
+    получает ту же долю, что и пользователь с одним, и не задерживает его
+    дольше, чем на один проход.
+    """
+
+    def __init__(self, name: str, capacity: int, quantum: float, weights: Dict[int, float]):
+        # Без положительного кредита за проход _dispatch никогда не выдал бы единицу
+        if quantum <= 0 or any(weight <= 0 for weight in weights.values()):
+            raise ValueError(f"Квант и веса очереди {name} должны быть больше 0")
+        self.name = name
+        self.capacity = capacity
+        self.quantum = quantum
+        self.weights = weights
+        self.enabled = True
+        self.active = 0
+        # Задача, которая занимает единицу в install: ее вложенные запросы идут без очереди
+        self.holder: ContextVar[Optional["asyncio.Task[Any]"]] = ContextVar(f"fair_{name}_holder", default=None)
+        # Пользователи с ожидающей работой в порядке обхода
+        self.queues: "OrderedDict[Hashable, Deque[Tuple[asyncio.Future, float]]]" = OrderedDict()
+        self.deficits: Dict[Hashable, float] = {}
+        self.waits: Deque[float] = deque(maxlen=SAMPLES)
+        self.stats: Dict[str, float] = {"calls": 0, "delayed": 0, "queued": 0, "max_queued": 0, "rounds": 0}
+
+    async def acquire(self, user_id: Hashable, cost: float = 1.0) -> float:
+        """
+        Ждет своей очереди на cost единиц работы
+
+        Returns:
+            float: Время ожидания (в секундах)
+        """
+        self.stats["calls"] += 1
+        if self.active < self.capacity and not self.queues:
+            self.active += 1
+            self.waits.append(0.0)
+            return 0.0
+
+        started = time.monotonic()
+        waiter = asyncio.get_running_loop().create_future()
+        self.queues.setdefault(user_id, deque()).append((waiter, cost))
+        self.stats["delayed"] += 1
+        self.stats["queued"] += 1
+        self.stats["max_queued"] = max(self.stats["max_queued"], self.stats["queued"])
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Единица уже выдана - возвращаем ее следующему
+                self.release()
+            else:
+                self._remove(user_id, waiter)
+            raise
+        finally:
+            self.stats["queued"] -= 1
+
+        wait = time.monotonic() - started
+        self.waits.append(wait)
+        return wait
+
+    def release(self) -> None:
+        """
+        Освобождает единицу и раздает свободные единицы ожидающим
+        """
+        self.active -= 1
+        self._dispatch()
+
+    def install(self, client: TelegramClient) -> None:
+        """
+        Пропускает запросы клиента через справедливую очередь
+
+        Устанавливается первым, под ограничителем частоты (rate_limiter.install)
+        и учетом FloodWait: слот занимается, когда запрос уже дождался токенов
+        и истечения FloodWait, и не простаивает на время этих ожиданий. Полосы
+        пользователя (priority_scheduler.install) решают, какой запрос
+        пользователя идет следующим, а этот планировщик - чей запрос получит
+        общий слот. Вложенные запросы Telethon той же задачи (например,
+        получение конфигурации при переходе в другой DC) выполняются в уже
+        занятом слоте: ожидание второго слота при занятых всех могло бы не
+        закончиться никогда.
+        """
+        call = client._call
+
+        async def fair_call(sender, request, *args, **kwargs):
+            task = asyncio.current_task()
+            if not self.enabled or self.holder.get() is task:
+                return await call(sender, request, *args, **kwargs)
+            cost = len(request) if utils.is_list_like(request) else 1
+            await self.acquire(client.owner_user_id, cost)
+            token = self.holder.set(task)
+            try:
+                return await call(sender, request, *args, **kwargs)
+            finally:
+                self.holder.reset(token)
+                self.release()
+
+        client._call = fair_call
+
+    async def map(self, user_id: Hashable, items: Sequence[Any], fn: Callable[[Any], Any], batch: int) -> List[Any]:
+        """
+        Применяет fn к элементам частями по batch, каждая часть - в свою очередь
+
+        Для работы на процессоре (capacity=1): очередь удерживается до
+        следующего прохода цикла событий, чтобы ожидающие части других
+        пользователей успели встать в очередь и выполнились раньше
+        следующей части этого пользователя.
+        """
+        if not self.enabled:
+            return [fn(item) for item in items]
+
+        result: List[Any] = []
+        for start in range(0, len(items), batch):
+            chunk = items[start:start + batch]
+            await self.acquire(user_id, len(chunk))
+            try:
+                result.extend(fn(item) for item in chunk)
+                await asyncio.sleep(0)
+            finally:
+                self.release()
+        return result
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        Счетчики, занятые единицы, ожидающие пользователи и перцентили ожидания
+        """
+        return dict(
+            self.stats,
+            active=self.active,
+            users_waiting=len(self.queues),
+            wait_p50=round(percentile(self.waits, 0.5), 4),
+            wait_p99=round(percentile(self.waits, 0.99), 4)
+        )
+
+    def _dispatch(self) -> None:
+        while self.active < self.capacity and self.queues:
+            user_id, queue = next(iter(self.queues.items()))
+            waiter, cost = queue[0]
+            deficit = self.deficits.get(user_id, 0.0)
+            if deficit < cost:
+                # Кредит исчерпан - пополняем и переходим к следующему пользователю
+                self.deficits[user_id] = deficit + self.quantum * self.weights.get(user_id, 1.0)
+                self.queues.move_to_end(user_id)
+                self.stats["rounds"] += 1
+                continue
+
+            self.deficits[user_id] = deficit - cost
+            queue.popleft()
+            self.active += 1
+            waiter.set_result(None)
+            self._drop_if_empty(user_id, queue)
+
+    def _remove(self, user_id: Hashable, waiter: asyncio.Future) -> None:
+        queue = self.queues.get(user_id)
+        if queue is None:
+            return
+        for entry in queue:
+            if entry[0] is waiter:
+                queue.remove(entry)
+                break
+        self._drop_if_empty(user_id, queue)
+        # Отмененный запрос мог быть первым в очереди при свободных единицах
+        self._dispatch()
+
+    def _drop_if_empty(self, user_id: Hashable, queue: Deque[Tuple[asyncio.Future, float]]) -> None:
+        if not queue:
+            # Пользователь без очереди не копит кредит
+            del self.queues[user_id]
+            self.deficits.pop(user_id, None)
+
+
+# Исходящие запросы MTProto всех пользователей
+outbound_scheduler = FairScheduler(
+    "outbound", settings.FAIR_MAX_INFLIGHT, settings.FAIR_OUTBOUND_QUANTUM, settings.FAIR_USER_WEIGHTS
+)
+
+# Работа на процессоре (преобразование и сериализация больших списков): одна часть за раз
+cpu_scheduler = FairScheduler("cpu", 1, settings.FAIR_CPU_BATCH, settings.FAIR_USER_WEIGHTS)
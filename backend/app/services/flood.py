@@ -0,0 +1,138 @@
+"""
+Учет FloodWait от Telegram: сроки ожидания по пользователю и методу
+"""
+import math
+import time
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+from telethon import TelegramClient, utils
+from telethon.errors import FloodWaitError
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class RetryAfterError(ValueError):
+    """
+    Метод заблокирован FloodWait: повторить запрос можно через seconds секунд
+
+    Эндпоинты ловят это исключение до ValueError и отвечают 429 с
+    Retry-After (см. app.api.dialogs.retry_after_headers).
+    """
+
+    def __init__(self, seconds: int):
+        self.seconds = seconds
+        super().__init__(
+            f"Превышен лимит запросов к API Telegram. Пожалуйста, подождите {seconds} секунд и попробуйте снова."
+        )
+
+
+class FloodControl:
+    """
+    Сроки FloodWait по (пользователь, метод)
+
+    Получив FloodWaitError, запоминаем срок для метода пользователя. Пока
+    срок не истек, запросы этого метода не уходят в Telegram: короткое
+    ожидание (до retry_max_wait) выжидается и запрос повторяется, при
+    длинном сразу выбрасывается RetryAfterError с оставшимся временем.
+    """
+
+    def __init__(self, retry_max_wait: float, max_retries: int):
+        self.retry_max_wait = retry_max_wait
+        self.max_retries = max_retries
+        self.deadlines: Dict[Tuple[Hashable, str], float] = {}
+        # Число FloodWait по методам
+        self.events: Dict[str, int] = {}
+        self.stats: Dict[str, int] = {"retried": 0, "failed_fast": 0, "rejected": 0}
+
+    def remaining(self, user_id: Hashable, method: str) -> float:
+        """
+        Сколько секунд метод пользователя еще заблокирован
+        """
+        key = (user_id, method)
+        deadline = self.deadlines.get(key)
+        if deadline is None:
+            return 0.0
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            del self.deadlines[key]
+            return 0.0
+        return remaining
+
+    def record(self, user_id: Hashable, method: str, seconds: int) -> None:
+        """
+        Запоминает срок FloodWait
+        """
+        self.deadlines[(user_id, method)] = time.monotonic() + seconds
+        self.events[method] = self.events.get(method, 0) + 1
+        logger.warning(f"FloodWait {seconds} с для метода {method} пользователя {user_id}")
+
+    async def call(self, user_id: Hashable, method: str, send: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Выполняет запрос с учетом сроков FloodWait
+
+        Args:
+            user_id: ID пользователя
+            method: Название метода (класс запроса)
+            send: Функция, выполняющая запрос
+
+        Raises:
+            RetryAfterError: Если ожидание дольше retry_max_wait
+        """
+        for attempt in range(self.max_retries + 1):
+            remaining = self.remaining(user_id, method)
+            if remaining > self.retry_max_wait:
+                self.stats["failed_fast"] += 1
+                raise RetryAfterError(math.ceil(remaining))
+            if remaining > 0:
+                await asyncio.sleep(remaining)
+
+            try:
+                return await send()
+            except FloodWaitError as e:
+                self.record(user_id, method, e.seconds)
+                if e.seconds > self.retry_max_wait or attempt == self.max_retries:
+                    self.stats["rejected"] += 1
+                    raise RetryAfterError(e.seconds) from e
+                self.stats["retried"] += 1
+                logger.info(f"Повторяем {method} пользователя {user_id} через {e.seconds} с")
+
+    def install(self, client: TelegramClient) -> None:
+        """
+        Пропускает запросы клиента через учет FloodWait
+
+        Telethon сам выжидает FloodWait до flood_sleep_threshold секунд,
+        блокируя запрос; порог обнуляется, чтобы ожиданием управлял этот класс.
+        Устанавливается поверх ограничителя частоты (rate_limiter.install).
+        """
+        client.flood_sleep_threshold = 0
+        call = client._call
+
+        async def flood_aware_call(sender, request, *args, **kwargs):
+            first = request[0] if utils.is_list_like(request) else request
+            return await self.call(
+                client.owner_user_id,
+                type(first).__name__,
+                lambda: call(sender, request, *args, **kwargs)
+            )
+
+        client._call = flood_aware_call
+
+    def forget(self, user_id: Hashable) -> None:
+        """
+        Удаляет истекшие сроки пользователя
+        """
+        for key in [k for k in self.deadlines if k[0] == user_id]:
+            self.remaining(*key)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        Счетчики FloodWait по методам и число действующих сроков
+        """
+        return dict(self.stats, events=self.events, active=len(self.deadlines))
+
+
+flood_control = FloodControl(settings.FLOOD_RETRY_MAX_WAIT, settings.FLOOD_MAX_RETRIES)
@@ -0,0 +1,82 @@
+"""
+Объединение одновременных одинаковых запросов (single-flight)
+"""
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+from app.services.priority import LANES, current_lane, holding_slot
+
+logger = logging.getLogger(__name__)
+
+# Выполняющиеся операции: (операция, *параметры) -> задача
+inflight: Dict[Tuple[Hashable, ...], asyncio.Task] = {}
+
+# Полоса приоритета, в которой выполняется задача операции
+inflight_lanes: Dict[Tuple[Hashable, ...], str] = {}
+
+# Статистика по операциям: операция -> {calls, executions, coalesced, promoted}
+coalescing_stats: Dict[str, Dict[str, int]] = {}
+
+
+async def coalesce(operation: str, key: Tuple[Hashable, ...], factory: Callable[[], Awaitable[Any]]) -> Any:
+    """
+    Выполняет операцию или присоединяется к уже выполняющейся с тем же ключом
+
+    Все одновременные вызовы с одинаковыми (operation, key) ждут одну и ту
+    же задачу и получают один результат или одно исключение. Отмена одного
+    из ожидающих (например, при обрыве соединения) не прерывает задачу для
+    остальных.
+
+    Задача выполняется в полосе приоритета вызова, который ее запустил.
+    Вызов более приоритетной полосы (интерактивный запрос к уже идущей
+    фоновой загрузке) не ждет за ней в очереди, а запускает операцию
+    заново в своей полосе, и следующие вызовы присоединяются к ней.
+
+    Args:
+        operation: Название операции (для ключа и статистики)
+        key: Параметры операции, обычно начиная с user_id
+        factory: Функция, создающая корутину операции
+
+    Returns:
+        Any: Результат операции
+    """
+    full_key = (operation,) + tuple(key)
+    stats = coalescing_stats.setdefault(operation, {"calls": 0, "executions": 0, "coalesced": 0, "promoted": 0})
+    stats["calls"] += 1
+
+    name = current_lane.get()
+    task = inflight.get(full_key)
+    if task is not None and LANES.index(name) < LANES.index(inflight_lanes[full_key]):
+        stats["promoted"] += 1
+        logger.info(f"Запрос {full_key} в полосе {name} не ждет задачу полосы {inflight_lanes[full_key]}")
+        task = None
+    if task is None:
+        stats["executions"] += 1
+        task = asyncio.ensure_future(_run(factory))
+        inflight[full_key] = task
+        inflight_lanes[full_key] = name
+        task.add_done_callback(lambda t: _finish(full_key, t))
+    else:
+        stats["coalesced"] += 1
+        logger.info(f"Запрос {full_key} присоединен к уже выполняющемуся")
+
+    return await asyncio.shield(task)
+
+
+async def _run(factory: Callable[[], Awaitable[Any]]) -> Any:
+    # Задача наследует контекст запустившего вызова, но его слот ей не принадлежит
+    holding_slot.set(None)
+    return await factory()
+
+
+def _finish(full_key: Tuple[Hashable, ...], task: asyncio.Task) -> None:
+    """
+    Убирает завершенную задачу из реестра
+    """
+    if inflight.get(full_key) is task:
+        del inflight[full_key]
+        del inflight_lanes[full_key]
+    # Забираем исключение, чтобы не было предупреждения, если все ожидающие отменены
+    if not task.cancelled():
+        task.exception()
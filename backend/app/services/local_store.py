@@ -0,0 +1,382 @@
+"""
+Постоянное локальное хранилище диалогов и сообщений (SQLite в режиме WAL)
+"""
+import os
+import json
+import time
+import asyncio
+import sqlite3
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from app.core.config import settings
+from app.services.message_store import MessageStore, Segment
+from app.services.shards import owns, share_of
+
+logger = logging.getLogger(__name__)
+
+# База лежит на том же volume, что и сессии, и переживает перезапуск
+LOCAL_STORE_PATH = os.path.join(settings.SESSIONS_DIR, "local_store.db")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dialogs (
+    user_id INTEGER PRIMARY KEY,
+    data TEXT NOT NULL,
+    fetched_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS segments (
+    user_id INTEGER NOT NULL,
+    dialog_id INTEGER NOT NULL,
+    low INTEGER NOT NULL,
+    high INTEGER NOT NULL,
+    bottom INTEGER NOT NULL,
+    fetched_at REAL NOT NULL,
+    PRIMARY KEY (user_id, dialog_id, low)
+);
+CREATE TABLE IF NOT EXISTS messages (
+    user_id INTEGER NOT NULL,
+    dialog_id INTEGER NOT NULL,
+    id INTEGER NOT NULL,
+    sender_id INTEGER,
+    data TEXT NOT NULL,
+    PRIMARY KEY (user_id, dialog_id, id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS senders (
+    user_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (user_id, kind, id)
+) WITHOUT ROWID;
+"""
+
+# Поля, которые имеют смысл только в рамках текущего процесса
+TRANSIENT_FIELDS = ("photo_pending",)
+
+
+def _dump(value: Dict[str, Any]) -> str:
+    return json.dumps({k: v for k, v in value.items() if k not in TRANSIENT_FIELDS}, ensure_ascii=False)
+
+
+class LocalStore:
+    """
+    Хранилище на SQLite с одним потоком-исполнителем
+
+    Все операции выполняются по очереди в одном потоке, поэтому запись,
+    поставленная раньше чтения, всегда видна этому чтению. Запись не
+    блокирует запрос: данные сериализуются в момент вызова, а в базу
+    попадают в фоне.
+
+    Данные удаляются целыми диалогами: при выходе пользователя (delete_user)
+    и фоновой очисткой (prune) - устаревшие и самые старые сверх лимита.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conn: Optional[sqlite3.Connection] = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="local-store")
+        self.prune_task: Optional[asyncio.Task] = None
+        self.stats: Dict[str, int] = {
+            "reads": 0, "writes": 0, "errors": 0, "dialogs_loaded": 0, "stores_loaded": 0, "pruned_dialogs": 0
+        }
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self.conn = conn
+        return self.conn
+
+    async def _read(self, fn: Callable[..., Any], *args) -> Any:
+        """
+        Выполняет чтение в потоке хранилища; при ошибке возвращает None
+        """
+        def run():
+            try:
+                result = fn(self._connect(), *args)
+                self.stats["reads"] += 1
+                return result
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.error(f"Ошибка при чтении из локального хранилища: {e}")
+                return None
+
+        return await asyncio.get_running_loop().run_in_executor(self.executor, run)
+
+    def _write(self, fn: Callable[..., None], *args) -> "Future[None]":
+        """
+        Ставит запись в очередь потока хранилища (в одной транзакции)
+        """
+        def run():
+            try:
+                conn = self._connect()
+                with conn:
+                    fn(conn, *args)
+                self.stats["writes"] += 1
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.error(f"Ошибка при записи в локальное хранилище: {e}")
+
+        return self.executor.submit(run)
+
+    async def load_dialogs(self, user_id: int) -> Optional[Tuple[List[Dict[str, Any]], float]]:
+        """
+        Загружает сохраненный список диалогов
+
+        Returns:
+            Optional[Tuple[List[Dict[str, Any]], float]]: Диалоги и время их загрузки из Telegram
+        """
+        def read(conn):
+            return conn.execute("SELECT data, fetched_at FROM dialogs WHERE user_id = ?", (user_id,)).fetchone()
+
+        row = await self._read(read)
+        if row is None:
+            return None
+        self.stats["dialogs_loaded"] += 1
+        return json.loads(row[0]), row[1]
+
+    # Сериализация записи (для сериализации частями вне хранилища)
+    dump = staticmethod(_dump)
+
+    def save_dialogs(self, user_id: int, dialogs: List[Dict[str, Any]], dumped: Optional[List[str]] = None) -> None:
+        """
+        Сохраняет список диалогов
+
+        Args:
+            user_id: ID пользователя
+            dialogs: Диалоги
+            dumped: Диалоги, уже сериализованные через dump
+        """
+        data = "[" + ",".join(dumped if dumped is not None else (_dump(d) for d in dialogs)) + "]"
+        fetched_at = time.time()
+
+        def write(conn):
+            conn.execute(
+                "INSERT OR REPLACE INTO dialogs (user_id, data, fetched_at) VALUES (?, ?, ?)",
+                (user_id, data, fetched_at)
+            )
+
+        self._write(write)
+
+    async def load_messages(self, user_id: int, dialog_id: int) -> Optional[MessageStore]:
+        """
+        Загружает сохраненные отрезки сообщений диалога
+
+        Ни один отрезок не помечается верхним: пока процесс не получал
+        обновления, в диалоге могли появиться новые сообщения. Их дозапросит
+        get_messages с min_id, равным самому большому сохраненному id.
+
+        Returns:
+            Optional[MessageStore]: Хранилище или None, если диалог не сохранен
+        """
+        def read(conn):
+            segments = conn.execute(
+                "SELECT low, high, bottom, fetched_at FROM segments WHERE user_id = ? AND dialog_id = ?",
+                (user_id, dialog_id)
+            ).fetchall()
+            if not segments:
+                return None
+            messages = conn.execute(
+                "SELECT id, data FROM messages WHERE user_id = ? AND dialog_id = ?",
+                (user_id, dialog_id)
+            ).fetchall()
+            senders = conn.execute(
+                "SELECT kind, id, data FROM senders WHERE user_id = ? AND id IN "
+                "(SELECT DISTINCT sender_id FROM messages WHERE user_id = ? AND dialog_id = ?)",
+                (user_id, user_id, dialog_id)
+            ).fetchall()
+            return segments, messages, senders
+
+        rows = await self._read(read)
+        if rows is None:
+            return None
+        segment_rows, message_rows, sender_rows = rows
+
+        store = MessageStore()
+        for low, high, bottom, fetched_at in segment_rows:
+            segment = Segment(low, high, bottom=bool(bottom))
+            segment.fetched_at = fetched_at
+            store.segments.append(segment)
+        for message_id, data in message_rows:
+            for segment in store.segments:
+                if segment.low <= message_id <= segment.high:
+                    segment.messages[message_id] = json.loads(data)
+                    break
+        for kind, sender_id, data in sender_rows:
+            table = store.users if kind == "user" else store.chats
+            table[sender_id] = json.loads(data)
+        store.recount()
+
+        self.stats["stores_loaded"] += 1
+        return store
+
+    def save_messages(
+        self,
+        user_id: int,
+        dialog_id: int,
+        store: MessageStore,
+        messages: List[Dict[str, Any]],
+        replace: bool = False
+    ) -> None:
+        """
+        Сохраняет сообщения и текущие отрезки диалога
+
+        Args:
+            user_id: ID пользователя
+            dialog_id: ID диалога
+            store: Хранилище сообщений диалога (берутся отрезки и отправители)
+            messages: Новые или измененные сообщения
+            replace: Заменить все сохраненное по диалогу содержимым store
+                (после принудительного обновления или удаления устаревших отрезков)
+        """
+        if replace:
+            messages = [m for s in store.segments for m in s.messages.values()]
+        segments = [(s.low, s.high, int(s.bottom), s.fetched_at) for s in store.segments]
+        message_rows = [(user_id, dialog_id, m["id"], m.get("sender_id"), _dump(m)) for m in messages]
+        sender_ids = {m.get("sender_id") for m in messages}
+        sender_rows = [(user_id, "user", i, _dump(u)) for i, u in store.users.items() if i in sender_ids]
+        sender_rows += [(user_id, "chat", i, _dump(c)) for i, c in store.chats.items() if i in sender_ids]
+
+        def write(conn):
+            conn.execute("DELETE FROM segments WHERE user_id = ? AND dialog_id = ?", (user_id, dialog_id))
+            if replace:
+                conn.execute("DELETE FROM messages WHERE user_id = ? AND dialog_id = ?", (user_id, dialog_id))
+            conn.executemany(
+                "INSERT INTO segments (user_id, dialog_id, low, high, bottom, fetched_at) VALUES (?, ?, ?, ?, ?, ?)",
+                [(user_id, dialog_id) + s for s in segments]
+            )
+            conn.executemany("INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?)", message_rows)
+            conn.executemany("INSERT OR REPLACE INTO senders VALUES (?, ?, ?, ?)", sender_rows)
+
+        self._write(write)
+
+    def delete_messages(self, user_id: int, dialog_id: Optional[int], ids: List[int]) -> None:
+        """
+        Удаляет сообщения (dialog_id=None - из всех личных чатов и групп пользователя)
+        """
+        ids = list(ids)
+
+        def write(conn):
+            placeholders = ",".join("?" * len(ids))
+            if dialog_id is not None:
+                conn.execute(
+                    f"DELETE FROM messages WHERE user_id = ? AND dialog_id = ? AND id IN ({placeholders})",
+                    [user_id, dialog_id] + ids
+                )
+            else:
+                # Каналы и супергруппы (id вида -100...) сообщают диалог сами
+                conn.execute(
+                    f"DELETE FROM messages WHERE user_id = ? AND dialog_id > -1000000000000 AND id IN ({placeholders})",
+                    [user_id] + ids
+                )
+
+        if ids:
+            self._write(write)
+
+    def delete_user(self, user_id: int) -> None:
+        """
+        Удаляет все сохраненные данные пользователя (после выхода из аккаунта)
+        """
+        def write(conn):
+            for table in ("dialogs", "segments", "messages", "senders"):
+                conn.execute(f"DELETE FROM {table} WHERE user_id = ?", (user_id,))
+
+        self._write(write)
+
+    async def prune(self, max_age: float, max_bytes: int, live: Set[Tuple[int, int]]) -> int:
+        """
+        Удаляет диалоги, не обновлявшиеся дольше max_age, и самые давно
+        обновленные диалоги, пока сообщения не уместятся в max_bytes
+
+        Диалоги из live (хранилища в памяти) не трогаются: следующая запись
+        такого диалога вернула бы отрезки без удаленных сообщений. Шард
+        очищает только своих пользователей и держит свою долю лимита.
+
+        Returns:
+            int: Количество удаленных диалогов
+        """
+        cutoff = time.time() - max_age
+        limit = share_of(max_bytes)
+        removed = []
+
+        def write(conn):
+            rows = conn.execute(
+                "SELECT s.user_id, s.dialog_id, MAX(s.fetched_at), "
+                "(SELECT COALESCE(SUM(length(m.data)), 0) FROM messages m "
+                "WHERE m.user_id = s.user_id AND m.dialog_id = s.dialog_id) "
+                "FROM segments s GROUP BY s.user_id, s.dialog_id ORDER BY 3"
+            ).fetchall()
+            rows = [row for row in rows if owns(row[0])]
+            total = sum(row[3] for row in rows)
+            for user_id, dialog_id, fetched_at, size in rows:
+                if fetched_at >= cutoff and total <= limit:
+                    break
+                if (user_id, dialog_id) in live:
+                    continue
+                conn.execute("DELETE FROM segments WHERE user_id = ? AND dialog_id = ?", (user_id, dialog_id))
+                conn.execute("DELETE FROM messages WHERE user_id = ? AND dialog_id = ?", (user_id, dialog_id))
+                total -= size
+                removed.append((user_id, dialog_id))
+            if removed:
+                # Отправители, на которых больше не ссылается ни одно сообщение
+                conn.execute(
+                    "DELETE FROM senders WHERE NOT EXISTS (SELECT 1 FROM messages m "
+                    "WHERE m.user_id = senders.user_id AND m.sender_id = senders.id)"
+                )
+            conn.execute("DELETE FROM dialogs WHERE fetched_at < ?", (cutoff,))
+
+        await asyncio.wrap_future(self._write(write))
+        if removed:
+            self.stats["pruned_dialogs"] += len(removed)
+            logger.info(f"Из локального хранилища удалено диалогов: {len(removed)}")
+        return len(removed)
+
+    def start(self, interval: float, live: Callable[[], Set[Tuple[int, int]]]) -> None:
+        """
+        Запускает фоновую очистку (см. prune)
+
+        Args:
+            interval: Период очистки (в секундах)
+            live: Возвращает ключи (user_id, dialog_id) хранилищ сообщений в памяти
+        """
+        if self.prune_task is None or self.prune_task.done():
+            self.prune_task = asyncio.ensure_future(self._prune_loop(interval, live))
+
+    async def shutdown(self) -> None:
+        """
+        Останавливает фоновую очистку, дописывает очередь записи и закрывает базу
+        """
+        if self.prune_task is not None:
+            self.prune_task.cancel()
+            try:
+                await self.prune_task
+            except asyncio.CancelledError:
+                pass
+            self.prune_task = None
+        await asyncio.to_thread(self.close)
+
+    async def _prune_loop(self, interval: float, live: Callable[[], Set[Tuple[int, int]]]) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.prune(settings.MESSAGES_MAX_AGE, settings.LOCAL_STORE_MAX_BYTES, live())
+            except Exception as e:
+                logger.error(f"Ошибка при очистке локального хранилища: {e}")
+
+    def close(self) -> None:
+        """
+        Дожидается записи очереди и закрывает базу
+        """
+        def run():
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+        self.executor.submit(run)
+        self.executor.shutdown(wait=True)
+
+
+local_store = LocalStore(LOCAL_STORE_PATH)
@@ -0,0 +1,340 @@
+"""
+Потоковая отдача медиа из сообщений и LRU-кэш медиа на диске
+"""
+import os
+import asyncio
+import logging
+import secrets
+import mimetypes
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple, AsyncIterator
+
+from app.core.config import settings
+from app.services.priority import PREFETCH, current_lane, holding_slot
+
+logger = logging.getLogger(__name__)
+
+# Директория для кэша медиа (на том же volume, что и сессии)
+MEDIA_DIR = os.path.join(settings.SESSIONS_DIR, "media")
+
+# Индекс LRU у каждого процесса свой, поэтому шарды (см. app.shards) делят
+# объем кэша и не видят файлов друг друга
+MEDIA_MAX_BYTES = settings.MEDIA_CACHE_MAX_BYTES
+if settings.SHARD_COUNT > 1:
+    MEDIA_DIR = f"{MEDIA_DIR}_shard_{settings.SHARD_INDEX}"
+    MEDIA_MAX_BYTES //= settings.SHARD_COUNT
+
+# Размер запроса к Telegram при потоковой загрузке (максимум для upload.getFile)
+MEDIA_CHUNK_SIZE = 512 * 1024
+
+
+class MediaCache:
+    """
+    LRU-кэш файлов медиа на диске с ограничением по суммарному размеру
+
+    Индекс (ключ -> (путь, размер)) хранится в памяти, поэтому проверка
+    попадания не обращается к файловой системе.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.entries: "OrderedDict[str, Tuple[str, int]]" = OrderedDict()
+        self.stats: Dict[str, int] = {"hits": 0, "misses": 0, "evictions": 0}
+        self._load()
+
+    def _load(self):
+        """
+        Восстанавливает индекс по содержимому директории (от старых к новым)
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        files = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            # Недокачанные файлы от прошлого запуска удаляем
+            if name.endswith(".tmp"):
+                os.remove(path)
+                continue
+            stat_result = os.stat(path)
+            files.append((stat_result.st_mtime, name, path, stat_result.st_size))
+
+        for _, name, path, size in sorted(files):
+            key = os.path.splitext(name)[0]
+            self.entries[key] = (path, size)
+            self.total_bytes += size
+        _remove_files(self._evict())
+        logger.info(f"Кэш медиа: {len(self.entries)} файлов, {self.total_bytes} байт")
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Возвращает путь к файлу из кэша и помечает его как недавно использованный
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+        self.entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return entry[0]
+
+    def drop(self, key: str) -> None:
+        """
+        Убирает из индекса файл, которого больше нет на диске
+        """
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry[1]
+
+    def temp_path(self, key: str) -> str:
+        """
+        Уникальный путь для недокачанного файла (один файл могут качать несколько запросов)
+        """
+        return os.path.join(self.directory, f"{key}.{secrets.token_hex(4)}.tmp")
+
+    async def put(self, key: str, ext: str, tmp_path: str) -> str:
+        """
+        Атомарно переносит докачанный файл в кэш и вытесняет старые файлы
+
+        Операции с диском идут в потоке, индекс обновляется в цикле событий.
+        """
+        path = os.path.join(self.directory, f"{key}{ext}")
+        size = await asyncio.to_thread(_move_file, tmp_path, path)
+        if key in self.entries:
+            self.total_bytes -= self.entries.pop(key)[1]
+        self.entries[key] = (path, size)
+        self.total_bytes += size
+        evicted = self._evict()
+        if evicted:
+            await asyncio.to_thread(_remove_files, evicted)
+        return path
+
+    def _evict(self) -> List[str]:
+        """
+        Вытесняет из индекса давно не использованные файлы, пока кэш не уложится в лимит
+
+        Returns:
+            List[str]: Пути вытесненных файлов, которые нужно удалить
+        """
+        evicted = []
+        while self.total_bytes > self.max_bytes and self.entries:
+            key, (path, size) = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            self.stats["evictions"] += 1
+            evicted.append(path)
+        return evicted
+
+
+def _move_file(tmp_path: str, path: str) -> int:
+    """
+    Переносит файл на место и возвращает его размер (выполняется в потоке)
+    """
+    os.replace(tmp_path, path)
+    return os.path.getsize(path)
+
+
+def _remove_files(paths: List[str]) -> None:
+    """
+    Удаляет файлы, которых может уже не быть (выполняется в потоке)
+    """
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Ошибка при удалении файла медиа из кэша {path}: {e}")
+
+
+media_cache = MediaCache(MEDIA_DIR, MEDIA_MAX_BYTES)
+
+# Фоновые загрузки в кэш: ключ -> задача
+media_downloads: Dict[str, asyncio.Task] = {}
+
+
+def get_media_key(user_id: int, dialog_id: int, msg_id: int) -> str:
+    """
+    Ключ медиа в кэше (id сообщений уникальны только в пределах аккаунта)
+    """
+    return f"{user_id}_{dialog_id}_{msg_id}"
+
+
+def get_media_info(message) -> Optional[Dict[str, object]]:
+    """
+    Возвращает размер, MIME-тип и расширение медиа сообщения
+
+    Args:
+        message: Сообщение Telegram
+
+    Returns:
+        Optional[Dict[str, object]]: Информация о файле или None, если медиа нельзя скачать
+    """
+    file = getattr(message, 'file', None)
+    if file is None:
+        return None
+
+    mime_type = file.mime_type or "application/octet-stream"
+    ext = file.ext or mimetypes.guess_extension(mime_type) or ""
+    return {
+        "size": file.size,
+        "mime_type": mime_type,
+        "ext": ext,
+    }
+
+
+def get_cached_media(key: str) -> Optional[Tuple[str, str]]:
+    """
+    Возвращает (путь, MIME-тип) медиа из кэша
+
+    Args:
+        key: Ключ медиа
+
+    Returns:
+        Optional[Tuple[str, str]]: Путь и MIME-тип или None при промахе
+    """
+    path = media_cache.get(key)
+    if path is None:
+        return None
+    mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    return path, mime_type
+
+
+def cache_limit() -> int:
+    """
+    Максимальный размер файла, который сохраняется в кэш
+
+    Файлы крупнее MEDIA_CACHE_MAX_FILE_BYTES (и крупнее всего кэша) только
+    проксируются: иначе ради одного файла кэш вытеснил бы все остальные.
+    """
+    return min(settings.MEDIA_CACHE_MAX_FILE_BYTES, media_cache.max_bytes)
+
+
+async def iter_media(client, message, key: str, start: int = 0, end: Optional[int] = None) -> AsyncIterator[bytes]:
+    """
+    Потоково отдает медиа сообщения через iter_download
+
+    Целиком запрошенный файл параллельно пишется во временный файл и после
+    успешной загрузки попадает в кэш. Для частичного запроса (Range) в кэш
+    в фоне докачивается весь файл, чтобы следующие перемотки шли с диска.
+    Файлы крупнее cache_limit() отдаются без записи на диск.
+
+    Args:
+        client: Клиент Telegram
+        message: Сообщение с медиа
+        key: Ключ медиа в кэше
+        start: Первый байт
+        end: Последний байт (включительно) или None - до конца файла
+
+    Yields:
+        bytes: Части файла
+    """
+    info = get_media_info(message)
+    size = info["size"]
+    if end is None and size is not None:
+        end = size - 1
+
+    is_full = start == 0 and (size is None or end == size - 1)
+    if not is_full:
+        ensure_media_cached(client, message, key)
+        async for chunk in _iter_range(client, message, start, end):
+            yield chunk
+        return
+
+    limit = cache_limit()
+    if size is not None and size > limit:
+        # Файл не поместится в кэш - только проксируем
+        async for chunk in client.iter_download(message.media, request_size=MEDIA_CHUNK_SIZE):
+            yield bytes(chunk)
+        return
+
+    # Качаем весь файл: отдаем клиенту и одновременно пишем в кэш
+    tmp_path = media_cache.temp_path(key)
+    completed = False
+    written = 0
+    f = await asyncio.to_thread(open, tmp_path, 'wb')
+    try:
+        async for chunk in client.iter_download(message.media, request_size=MEDIA_CHUNK_SIZE):
+            if f is not None:
+                written += len(chunk)
+                if written > limit:
+                    # Размер не был известен заранее и оказался больше лимита
+                    await asyncio.to_thread(f.close)
+                    f = None
+                    await asyncio.to_thread(_remove_files, [tmp_path])
+                else:
+                    await asyncio.to_thread(f.write, chunk)
+            yield bytes(chunk)
+        completed = True
+    finally:
+        if f is not None:
+            await asyncio.to_thread(f.close)
+            if completed:
+                await media_cache.put(key, info["ext"], tmp_path)
+            else:
+                # Клиент оборвал загрузку - недокачанный файл не нужен
+                await asyncio.to_thread(_remove_files, [tmp_path])
+
+
+async def _iter_range(client, message, start: int, end: int) -> AsyncIterator[bytes]:
+    """
+    Отдает диапазон байт [start, end] медиа сообщения
+    """
+    remaining = end - start + 1
+    # Смещение выравниваем по границе запроса, лишнее в начале отрезаем
+    aligned = start - start % MEDIA_CHUNK_SIZE
+    skip = start - aligned
+    async for chunk in client.iter_download(message.media, offset=aligned, request_size=MEDIA_CHUNK_SIZE):
+        chunk = bytes(chunk)
+        if skip:
+            chunk = chunk[skip:]
+            skip = 0
+        if len(chunk) >= remaining:
+            yield chunk[:remaining]
+            return
+        remaining -= len(chunk)
+        yield chunk
+
+
+def ensure_media_cached(client, message, key: str) -> None:
+    """
+    Запускает фоновую загрузку медиа в кэш, если ее еще нет
+    """
+    if key in media_downloads or key in media_cache.entries:
+        return
+
+    info = get_media_info(message)
+    limit = cache_limit()
+    if info["size"] is not None and info["size"] > limit:
+        return
+
+    async def download():
+        # Загрузка в кэш живет дольше запроса, который ее запустил: идет в полосе
+        # PREFETCH и без его слота (у задачи своя копия контекста)
+        current_lane.set(PREFETCH)
+        holding_slot.set(None)
+        tmp_path = media_cache.temp_path(key)
+        written = 0
+        stored = False
+        try:
+            f = await asyncio.to_thread(open, tmp_path, 'wb')
+            try:
+                async for chunk in client.iter_download(message.media, request_size=MEDIA_CHUNK_SIZE):
+                    written += len(chunk)
+                    if written > limit:
+                        logger.info(f"Медиа {key} больше {limit} байт, в кэш не сохраняется")
+                        return
+                    await asyncio.to_thread(f.write, chunk)
+            finally:
+                await asyncio.to_thread(f.close)
+            await media_cache.put(key, info["ext"], tmp_path)
+            stored = True
+            logger.info(f"Медиа {key} сохранено в кэш")
+        except Exception as e:
+            logger.warning(f"Ошибка при фоновой загрузке медиа {key}: {e}")
+        finally:
+            if not stored:
+                await asyncio.to_thread(_remove_files, [tmp_path])
+
+    task = asyncio.ensure_future(download())
+    media_downloads[key] = task
+    task.add_done_callback(lambda _: media_downloads.pop(key, None))
@@ -0,0 +1,286 @@
+"""
+Хранилище сообщений диалога в виде непрерывных отрезков по id
+"""
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.services.cache import estimate_size
+
+
+class Segment:
+    """
+    Отрезок [low, high] id сообщений, для которого известны все сообщения
+
+    top - выше high сообщений нет (отрезок получен от самого нового сообщения),
+    bottom - ниже low сообщений нет (достигнуто начало истории).
+    """
+
+    def __init__(self, low: int, high: int, top: bool = False, bottom: bool = False):
+        self.low = low
+        self.high = high
+        self.top = top
+        self.bottom = bottom
+        self.messages: Dict[int, Dict[str, Any]] = {}
+        self.fetched_at = time.time()
+
+    def ids_below(self, cursor: int) -> List[int]:
+        """
+        id сообщений отрезка меньше cursor (0 - все), от новых к старым
+        """
+        return sorted((i for i in self.messages if not cursor or i < cursor), reverse=True)
+
+
+class MessageStore:
+    """
+    Сообщения одного диалога: отрезки плюс таблицы отправителей users/chats
+
+    Отрезки не пересекаются и не соприкасаются: соседние отрезки сразу
+    сливаются. Страница внутри известного отрезка отдается локально, а из
+    Telegram запрашиваются только промежутки между отрезками.
+
+    size - примерный объем сообщений и отправителей в памяти. Он меняется
+    на размер добавленных и удаленных записей, поэтому кэш учитывает
+    хранилище без обхода всех его сообщений (см. BoundedCache.set).
+    """
+
+    def __init__(self):
+        self.segments: List[Segment] = []
+        self.users: Dict[int, Dict[str, Any]] = {}
+        self.chats: Dict[int, Dict[str, Any]] = {}
+        self.size = 0
+
+    def find(self, cursor: int) -> Optional[Segment]:
+        """
+        Отрезок, из которого можно отдать сообщения с id < cursor (0 - самые новые)
+        """
+        for segment in self.segments:
+            if segment.top and (not cursor or cursor > segment.high):
+                return segment
+            if cursor and segment.low <= cursor - 1 <= segment.high:
+                return segment
+        return None
+
+    def next_below(self, cursor: int) -> Optional[Segment]:
+        """
+        Ближайший отрезок целиком ниже cursor (0 - самый верхний отрезок)
+        """
+        below = [s for s in self.segments if not cursor or s.high < cursor]
+        return max(below, key=lambda s: s.high) if below else None
+
+    def add(self, messages: List[Dict[str, Any]], cursor: int, min_id: int, complete: bool) -> Segment:
+        """
+        Добавляет результат запроса истории с offset_id=cursor и min_id=min_id
+
+        Args:
+            messages: Сообщения, полученные из Telegram
+            cursor: offset_id запроса (0 - от самого нового сообщения)
+            min_id: min_id запроса (0 - без нижней границы)
+            complete: Telegram вернул меньше запрошенного, т.е. промежуток закрыт целиком
+
+        Returns:
+            Segment: Отрезок, в который попали сообщения
+        """
+        ids = [m["id"] for m in messages]
+        if cursor:
+            high = cursor - 1
+        else:
+            high = max(ids) if ids else min_id
+        low = min_id + 1 if complete else min(ids)
+
+        segment = Segment(low, high, top=not cursor, bottom=complete and not min_id)
+        for message in messages:
+            segment.messages[message["id"]] = message
+            self.size += estimate_size(message)
+        self.segments.append(segment)
+        return self._merge(segment)
+
+    def add_sender(self, sender_id: int, sender: Dict[str, Any], is_user: bool) -> Dict[str, Any]:
+        """
+        Заносит отправителя в таблицу users или chats
+
+        Returns:
+            Dict[str, Any]: Словарь отправителя в таблице
+        """
+        table = self.users if is_user else self.chats
+        if sender_id in table:
+            self.size -= estimate_size(table[sender_id])
+        self.size += estimate_size(sender)
+        table[sender_id] = sender
+        return sender
+
+    def patch(self, message: Dict[str, Any]) -> None:
+        """
+        Добавляет новое сообщение (например, только что отправленное)
+
+        Если сообщение продолжает верхний отрезок, тот расширяется. Иначе
+        между ними мог появиться промежуток: верхний отрезок перестает быть
+        top, а сообщение образует новый верхний отрезок. Промежуток будет
+        дозапрошен при следующем чтении.
+        """
+        self.size += estimate_size(message)
+        top = self.find(0)
+        if top and message["id"] <= top.high:
+            self._replace(top, message)
+            return
+        if top and message["id"] == top.high + 1:
+            top.messages[message["id"]] = message
+            top.high = message["id"]
+            return
+        if top:
+            top.top = False
+        segment = Segment(message["id"], message["id"], top=True)
+        segment.messages[message["id"]] = message
+        self.segments.append(segment)
+        self._merge(segment)
+
+    def update(self, message: Dict[str, Any]) -> bool:
+        """
+        Заменяет уже известное сообщение (например, после редактирования)
+
+        Returns:
+            bool: True, если сообщение было в хранилище
+        """
+        for segment in self.segments:
+            if message["id"] in segment.messages:
+                self.size += estimate_size(message)
+                self._replace(segment, message)
+                return True
+        return False
+
+    def remove(self, ids: List[int]) -> int:
+        """
+        Удаляет сообщения; границы отрезков не меняются, т.к. удаленных сообщений в них больше нет
+
+        Returns:
+            int: Количество удаленных сообщений
+        """
+        removed = 0
+        for segment in self.segments:
+            for message_id in ids:
+                message = segment.messages.pop(message_id, None)
+                if message is not None:
+                    self.size -= estimate_size(message)
+                    removed += 1
+        return removed
+
+    def to_dict(self, exclude: Tuple[str, ...] = ()) -> Dict[str, Any]:
+        """
+        Представление для сериализации в JSON (поля exclude из сообщений и отправителей убираются)
+        """
+        def clean(value: Dict[str, Any]) -> Dict[str, Any]:
+            return {k: v for k, v in value.items() if k not in exclude}
+
+        return {
+            "segments": [
+                {
+                    "low": s.low,
+                    "high": s.high,
+                    "bottom": s.bottom,
+                    "fetched_at": s.fetched_at,
+                    "messages": [clean(m) for m in s.messages.values()],
+                }
+                for s in self.segments
+            ],
+            "users": [clean(u) for u in self.users.values()],
+            "chats": [clean(c) for c in self.chats.values()],
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "MessageStore":
+        """
+        Восстанавливает хранилище из to_dict
+
+        Флаг top не сохраняется: у процесса, загрузившего хранилище, не было
+        обновлений, поэтому новые сообщения дозапрашиваются с min_id.
+        """
+        store = cls()
+        for item in data["segments"]:
+            segment = Segment(item["low"], item["high"], bottom=item["bottom"])
+            segment.fetched_at = item["fetched_at"]
+            segment.messages = {m["id"]: m for m in item["messages"]}
+            store.segments.append(segment)
+        store.users = {u["id"]: u for u in data["users"]}
+        store.chats = {c["id"]: c for c in data["chats"]}
+        store.recount()
+        return store
+
+    def recount(self) -> int:
+        """
+        Заново оценивает size по всем сообщениям и отправителям (после загрузки хранилища целиком)
+        """
+        self.size = sum(estimate_size(m) for s in self.segments for m in s.messages.values())
+        self.size += sum(estimate_size(u) for table in (self.users, self.chats) for u in table.values())
+        return self.size
+
+    def mark_outdated(self) -> None:
+        """
+        Снимает флаг top со всех отрезков: пока обновления не приходили,
+        выше могли появиться новые сообщения
+        """
+        for segment in self.segments:
+            segment.top = False
+
+    def page(self, ids: List[int]) -> Dict[str, Any]:
+        """
+        Собирает нормализованную страницу из сообщений с данными id
+        """
+        messages = []
+        for message_id in ids:
+            for segment in self.segments:
+                if message_id in segment.messages:
+                    messages.append(segment.messages[message_id])
+                    break
+        sender_ids = {m.get("sender_id") for m in messages}
+        return {
+            "messages": messages,
+            "users": {i: u for i, u in self.users.items() if i in sender_ids},
+            "chats": {i: c for i, c in self.chats.items() if i in sender_ids},
+        }
+
+    def drop_stale(self, ttl: float) -> bool:
+        """
+        Удаляет отрезки старше ttl и отправителей, на которых больше никто не ссылается
+
+        Returns:
+            bool: True, если что-то было удалено
+        """
+        now = time.time()
+        fresh = [s for s in self.segments if now - s.fetched_at < ttl]
+        if len(fresh) == len(self.segments):
+            return False
+        for segment in self.segments:
+            if now - segment.fetched_at >= ttl:
+                self.size -= sum(estimate_size(m) for m in segment.messages.values())
+        self.segments = fresh
+        sender_ids = {m.get("sender_id") for s in fresh for m in s.messages.values()}
+        for table in (self.users, self.chats):
+            for sender_id in [i for i in table if i not in sender_ids]:
+                self.size -= estimate_size(table.pop(sender_id))
+        return True
+
+    def _merge(self, segment: Segment) -> Segment:
+        """
+        Сливает отрезок с пересекающимися и соседними отрезками
+        """
+        for other in list(self.segments):
+            if other is segment:
+                continue
+            if other.low <= segment.high + 1 and segment.low <= other.high + 1:
+                segment.low = min(segment.low, other.low)
+                segment.high = max(segment.high, other.high)
+                segment.top = segment.top or other.top
+                segment.bottom = segment.bottom or other.bottom
+                segment.fetched_at = min(segment.fetched_at, other.fetched_at)
+                # Более свежие данные нового отрезка перекрывают старые
+                for message_id in other.messages.keys() & segment.messages.keys():
+                    self.size -= estimate_size(other.messages[message_id])
+                segment.messages = {**other.messages, **segment.messages}
+                self.segments.remove(other)
+        return segment
+
+    def _replace(self, segment: Segment, message: Dict[str, Any]) -> None:
+        # Размер новой версии уже учтен вызывающим, вычитаем старую
+        previous = segment.messages.get(message["id"])
+        if previous is not None:
+            self.size -= estimate_size(previous)
+        segment.messages[message["id"]] = message
@@ -0,0 +1,241 @@
+"""
+Реестр незавершенных входов по коду (клиенты, ожидающие ввода кода)
+"""
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+from telethon import TelegramClient
+
+from app.core.config import settings
+from app.services.session_store import session_db
+from app.services.rate_limit import rate_limiter
+
+logger = logging.getLogger(__name__)
+
+
+class PendingAuth:
+    """
+    Вход, ожидающий ввода кода: подключенный клиент с временной сессией
+    """
+
+    def __init__(self, temp_user_id: int, phone_number: str, client: TelegramClient, phone_code_hash: str):
+        self.temp_user_id = temp_user_id
+        self.phone_number = phone_number
+        self.client = client
+        self.phone_code_hash = phone_code_hash
+        self.created_at = time.time()
+        self.code_sent_at = self.created_at
+
+    @property
+    def session_key(self) -> str:
+        return f"temp_user_{self.temp_user_id}"
+
+    def expired(self, ttl: float, now: Optional[float] = None) -> bool:
+        return (now or time.time()) - self.created_at >= ttl
+
+    def to_dict(self) -> Dict[str, object]:
+        return {
+            "temp_user_id": self.temp_user_id,
+            "phone_code_hash": self.phone_code_hash,
+            "phone_number": self.phone_number
+        }
+
+
+class PendingAuthRegistry:
+    """
+    Незавершенные входы с ограниченным временем жизни
+
+    Вход живет ttl секунд с первой отправки кода; истекшие входы фоновая
+    задача отключает и удаляет их временные сессии. Число одновременных
+    входов ограничено max_pending, число отправок кода на один номер за
+    ttl - max_codes_per_phone.
+    """
+
+    def __init__(self, ttl: float, max_pending: int, max_codes_per_phone: int):
+        self.ttl = ttl
+        self.max_pending = max_pending
+        self.max_codes_per_phone = max_codes_per_phone
+        self.entries: Dict[int, PendingAuth] = {}
+        self.by_phone: Dict[str, int] = {}
+        # Время отправок кода по номеру за последние ttl секунд
+        self.codes_sent: Dict[str, Deque[float]] = {}
+        self.reaper_task: Optional[asyncio.Task] = None
+        self.stats: Dict[str, int] = {
+            "created": 0,
+            "resent": 0,
+            "deduplicated": 0,
+            "rejected": 0,
+            "completed": 0,
+            "expired": 0
+        }
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, temp_user_id: int) -> Optional[PendingAuth]:
+        """
+        Возвращает незавершенный вход, если он не истек
+        """
+        entry = self.entries.get(temp_user_id)
+        if entry is None or entry.expired(self.ttl):
+            return None
+        return entry
+
+    def find(self, phone_number: str) -> Optional[PendingAuth]:
+        """
+        Возвращает незавершенный вход для номера, если он не истек
+        """
+        temp_user_id = self.by_phone.get(phone_number)
+        return self.get(temp_user_id) if temp_user_id is not None else None
+
+    def check_limits(self, phone_number: str, new_entry: bool) -> None:
+        """
+        Проверяет ограничения перед отправкой кода
+
+        Args:
+            phone_number: Номер телефона
+            new_entry: Для отправки нужен новый клиент
+
+        Raises:
+            ValueError: Если ограничение превышено
+        """
+        if self._recent_codes(phone_number) >= self.max_codes_per_phone:
+            self.stats["rejected"] += 1
+            logger.warning(f"Слишком много запросов кода для номера {phone_number}")
+            raise ValueError("Слишком много запросов кода для этого номера. Пожалуйста, попробуйте позже.")
+        if new_entry and len(self.entries) >= self.max_pending:
+            self.stats["rejected"] += 1
+            logger.warning(f"Слишком много незавершенных входов: {len(self.entries)}")
+            raise ValueError("Слишком много незавершенных входов. Пожалуйста, попробуйте позже.")
+
+    def record_code_sent(self, entry: PendingAuth) -> None:
+        """
+        Учитывает отправку кода на номер входа
+        """
+        entry.code_sent_at = time.time()
+        self.codes_sent.setdefault(entry.phone_number, deque()).append(entry.code_sent_at)
+
+    def add(self, entry: PendingAuth) -> None:
+        """
+        Регистрирует новый вход (предыдущий вход для того же номера заменяется)
+        """
+        self.entries[entry.temp_user_id] = entry
+        previous = self.by_phone.get(entry.phone_number)
+        self.by_phone[entry.phone_number] = entry.temp_user_id
+        self.record_code_sent(entry)
+        self.stats["created"] += 1
+        if previous is not None and previous != entry.temp_user_id:
+            self._spawn_discard(previous)
+
+    def complete(self, temp_user_id: int) -> None:
+        """
+        Убирает завершенный вход; клиент при этом не отключается (он перешел в пул)
+        """
+        entry = self._detach(temp_user_id)
+        if entry is not None:
+            self.stats["completed"] += 1
+
+    async def discard(self, temp_user_id: int) -> None:
+        """
+        Убирает вход, отключает его клиент и удаляет временную сессию
+        """
+        entry = self._detach(temp_user_id)
+        if entry is not None:
+            await self._close(entry)
+
+    async def reap_expired(self) -> int:
+        """
+        Отключает истекшие входы и удаляет их временные сессии
+
+        Returns:
+            int: Количество удаленных входов
+        """
+        now = time.time()
+        expired = [entry for entry in self.entries.values() if entry.expired(self.ttl, now)]
+        for entry in expired:
+            self._detach(entry.temp_user_id)
+        if expired:
+            logger.info(f"Удаляем истекшие входы: {[entry.temp_user_id for entry in expired]}")
+            await asyncio.gather(*(self._close(entry) for entry in expired))
+            self.stats["expired"] += len(expired)
+        for phone_number in list(self.codes_sent):
+            self._recent_codes(phone_number, now)
+        return len(expired)
+
+    def start(self, interval: float) -> None:
+        """
+        Запускает фоновое удаление истекших входов
+        """
+        if self.reaper_task is None or self.reaper_task.done():
+            self.reaper_task = asyncio.ensure_future(self._reap_loop(interval))
+
+    async def shutdown(self) -> None:
+        """
+        Останавливает фоновую задачу и отключает клиенты всех незавершенных входов
+        """
+        if self.reaper_task is not None:
+            self.reaper_task.cancel()
+            try:
+                await self.reaper_task
+            except asyncio.CancelledError:
+                pass
+            self.reaper_task = None
+        entries: List[PendingAuth] = [self._detach(temp_user_id) for temp_user_id in list(self.entries)]
+        await asyncio.gather(*(self._close(entry) for entry in entries))
+
+    def get_stats(self) -> Dict[str, int]:
+        """
+        Счетчики и текущее количество незавершенных входов
+        """
+        return dict(self.stats, pending=len(self.entries))
+
+    def _recent_codes(self, phone_number: str, now: Optional[float] = None) -> int:
+        sent = self.codes_sent.get(phone_number)
+        if sent is None:
+            return 0
+        now = now or time.time()
+        while sent and now - sent[0] >= self.ttl:
+            sent.popleft()
+        if not sent:
+            del self.codes_sent[phone_number]
+            return 0
+        return len(sent)
+
+    def _detach(self, temp_user_id: int) -> Optional[PendingAuth]:
+        entry = self.entries.pop(temp_user_id, None)
+        if entry is not None and self.by_phone.get(entry.phone_number) == temp_user_id:
+            del self.by_phone[entry.phone_number]
+        return entry
+
+    def _spawn_discard(self, temp_user_id: int) -> None:
+        task = asyncio.ensure_future(self.discard(temp_user_id))
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    async def _close(self, entry: PendingAuth) -> None:
+        try:
+            await entry.client.disconnect()
+        except Exception as e:
+            logger.warning(f"Ошибка при отключении клиента входа {entry.temp_user_id}: {e}")
+        try:
+            await session_db.run(session_db.delete, entry.session_key)
+        except Exception as e:
+            logger.error(f"Ошибка при удалении временной сессии {entry.session_key}: {e}")
+        rate_limiter.forget(entry.temp_user_id)
+
+    async def _reap_loop(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.reap_expired()
+            except Exception as e:
+                logger.error(f"Ошибка при удалении истекших входов: {e}")
+
+
+pending_auth = PendingAuthRegistry(
+    settings.AUTH_PENDING_TTL,
+    settings.AUTH_MAX_PENDING,
+    settings.AUTH_MAX_CODES_PER_PHONE
+)
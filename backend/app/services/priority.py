@@ -0,0 +1,244 @@
+"""
+Полосы приоритета запросов MTProto: интерактивные запросы идут раньше фоновых
+"""
+import time
+import asyncio
+import logging
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, Iterator, List, Optional
+
+from telethon import TelegramClient
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Полосы в порядке убывания приоритета
+INTERACTIVE = "interactive"  # Запрос, ответа на который ждет пользователь
+PREFETCH = "prefetch"  # Догрузка к уже отданному ответу (аватары)
+MAINTENANCE = "maintenance"  # Фоновые обновления кэша и проверки клиентов
+LANES = (INTERACTIVE, PREFETCH, MAINTENANCE)
+
+# Полоса текущей задачи; задачи, созданные внутри, наследуют ее
+current_lane: ContextVar[str] = ContextVar("telegram_lane", default=INTERACTIVE)
+
+# Задача, которая занимает слот: ее вложенные запросы Telethon (например, разрешение
+# сущностей) идут без очереди. Хранится сама задача, а не флаг: задачи, созданные
+# во время запроса, наследуют значение, но слот им не принадлежит
+holding_slot: ContextVar[Optional["asyncio.Task[Any]"]] = ContextVar("telegram_holding_slot", default=None)
+
+# Фоновые циклы, которые Telethon запускает при подключении клиента
+CLIENT_LOOPS = ("_update_loop", "_keepalive_loop")
+
+# Сколько последних замеров хранится для перцентилей
+SAMPLES = 1000
+
+
+@contextmanager
+def lane(name: str) -> Iterator[None]:
+    """
+    Выполняет запросы блока (и созданных в нем задач) в полосе name
+    """
+    token = current_lane.set(name)
+    try:
+        yield
+    finally:
+        current_lane.reset(token)
+
+
+def in_background(fn: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+    """
+    Выполняет корутину fn в полосе MAINTENANCE без унаследованного слота
+
+    Для циклов, которые живут дольше запроса, в котором были созданы: иначе
+    они и запущенные ими задачи (обработчики обновлений) навсегда остались
+    бы в полосе этого запроса.
+    """
+    async def run(*args, **kwargs):
+        # У задачи своя копия контекста - восстанавливать значения не нужно
+        current_lane.set(MAINTENANCE)
+        holding_slot.set(None)
+        return await fn(*args, **kwargs)
+
+    return run
+
+
+def percentile(samples: Deque[float], fraction: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class UserQueue:
+    """
+    Занятые слоты и очереди ожидающих запросов одного пользователя
+    """
+
+    def __init__(self):
+        self.active = 0
+        self.waiters: Dict[str, Deque[asyncio.Future]] = {name: deque() for name in LANES}
+
+    def queued(self) -> int:
+        return sum(len(waiters) for waiters in self.waiters.values())
+
+
+class PriorityScheduler:
+    """
+    Очередь запросов пользователя с полосами приоритета
+
+    Одновременно у пользователя выполняется не больше slots запросов.
+    Освободившийся слот достается первому ожидающему из самой приоритетной
+    непустой полосы, так что интерактивный запрос обгоняет уже стоящие в
+    очереди загрузки аватаров и фоновые обновления. Фоновые полосы занимают
+    не больше slots - reserved слотов: даже при полной загрузке фоновой
+    работой интерактивному запросу не приходится ждать, пока она закончится.
+    Уже отправленные запросы не прерываются.
+    """
+
+    def __init__(self, slots: int, reserved: int):
+        self.slots = slots
+        self.reserved = min(reserved, slots - 1)
+        self.enabled = True
+        self.queues: Dict[Hashable, UserQueue] = {}
+        self.stats: Dict[str, Dict[str, float]] = {}
+        self.waits: Dict[str, Deque[float]] = {name: deque(maxlen=SAMPLES) for name in LANES}
+        self.latencies: Dict[str, Deque[float]] = {name: deque(maxlen=SAMPLES) for name in LANES}
+
+    def limit(self, name: str) -> int:
+        """
+        Сколько слотов пользователя может быть занято, чтобы запрос полосы name получил слот
+        """
+        return self.slots if name == INTERACTIVE else self.slots - self.reserved
+
+    async def acquire(self, user_id: Hashable, name: str) -> float:
+        """
+        Ждет слот пользователя для запроса полосы name
+
+        Returns:
+            float: Время ожидания (в секундах)
+        """
+        stats = self._stats(name)
+        stats["calls"] += 1
+        queue = self.queues.get(user_id)
+        if queue is None:
+            queue = self.queues[user_id] = UserQueue()
+
+        ahead = LANES[:LANES.index(name) + 1]
+        if queue.active < self.limit(name) and not any(queue.waiters[other] for other in ahead):
+            self._grant(queue, name)
+            self.waits[name].append(0.0)
+            return 0.0
+
+        started = time.monotonic()
+        waiter = asyncio.get_running_loop().create_future()
+        queue.waiters[name].append(waiter)
+        stats["queued"] += 1
+        stats["max_queued"] = max(stats["max_queued"], stats["queued"])
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Слот уже выдан - возвращаем его следующему
+                self.release(user_id)
+            elif waiter in queue.waiters[name]:
+                queue.waiters[name].remove(waiter)
+            raise
+        finally:
+            stats["queued"] -= 1
+
+        wait = time.monotonic() - started
+        stats["wait_total"] += wait
+        stats["wait_max"] = max(stats["wait_max"], wait)
+        self.waits[name].append(wait)
+        return wait
+
+    def release(self, user_id: Hashable) -> None:
+        """
+        Освобождает слот и передает его ожидающим по приоритету
+        """
+        queue = self.queues[user_id]
+        queue.active -= 1
+        for name in LANES:
+            waiters = queue.waiters[name]
+            while waiters and queue.active < self.limit(name):
+                waiter = waiters.popleft()
+                if not waiter.done():
+                    self._grant(queue, name)
+                    waiter.set_result(None)
+            if waiters:
+                # Полоса не получила слот - нижние полосы ждут за ней
+                break
+        if queue.active == 0 and not queue.queued():
+            del self.queues[user_id]
+
+    def install(self, client: TelegramClient) -> None:
+        """
+        Пропускает запросы клиента через очередь с приоритетами
+
+        Устанавливается поверх учета FloodWait (flood_control.install), чтобы
+        фоновые запросы не занимали очередь ограничителя частоты раньше
+        интерактивных. Циклы обновлений и keepalive клиента выполняются в
+        полосе MAINTENANCE, в каком бы запросе клиент ни подключился.
+        """
+        call = client._call
+
+        async def prioritized_call(sender, request, *args, **kwargs):
+            task = asyncio.current_task()
+            if not self.enabled or holding_slot.get() is task:
+                return await call(sender, request, *args, **kwargs)
+
+            user_id = client.owner_user_id
+            name = current_lane.get()
+            await self.acquire(user_id, name)
+            token = holding_slot.set(task)
+            started = time.monotonic()
+            try:
+                return await call(sender, request, *args, **kwargs)
+            finally:
+                self.latencies[name].append(time.monotonic() - started)
+                holding_slot.reset(token)
+                self.release(user_id)
+
+        client._call = prioritized_call
+        for loop_name in CLIENT_LOOPS:
+            setattr(client, loop_name, in_background(getattr(client, loop_name)))
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        Счетчики, ожидание в очереди и время выполнения по полосам
+        """
+        lanes: Dict[str, Dict[str, float]] = {}
+        for name, stats in self.stats.items():
+            waits = self.waits[name]
+            latencies = self.latencies[name]
+            lanes[name] = dict(
+                stats,
+                wait_total=round(stats["wait_total"], 3),
+                wait_max=round(stats["wait_max"], 3),
+                wait_p50=round(percentile(waits, 0.5), 3),
+                wait_p95=round(percentile(waits, 0.95), 3),
+                latency_p50=round(percentile(latencies, 0.5), 3),
+                latency_p95=round(percentile(latencies, 0.95), 3)
+            )
+        active: List[int] = [queue.active for queue in self.queues.values()]
+        return {"slots": self.slots, "reserved": self.reserved, "lanes": lanes, "active": sum(active)}
+
+    def _grant(self, queue: UserQueue, name: str) -> None:
+        queue.active += 1
+        # Слот получен раньше ожидающих запросов нижних полос
+        below = LANES[LANES.index(name) + 1:]
+        if any(queue.waiters[other] for other in below):
+            self.stats[name]["preempted"] += 1
+
+    def _stats(self, name: str) -> Dict[str, float]:
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = {"calls": 0, "queued": 0, "max_queued": 0, "preempted": 0, "wait_total": 0.0, "wait_max": 0.0}
+            self.stats[name] = stats
+        return stats
+
+
+priority_scheduler = PriorityScheduler(settings.PRIORITY_SLOTS_PER_USER, settings.PRIORITY_RESERVED_INTERACTIVE)
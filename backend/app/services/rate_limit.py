@@ -0,0 +1,209 @@
+"""
+Ограничение частоты запросов MTProto: корзины токенов по пользователю и классу метода
+"""
+import time
+import asyncio
+import logging
+from typing import Any, Dict, Hashable, List, Tuple
+
+from telethon import TelegramClient, utils
+
+from app.core.config import settings
+from app.services.shards import share_of
+
+logger = logging.getLogger(__name__)
+
+# Запросы, изменяющие данные (у Telegram для них самые строгие лимиты)
+SEND_REQUESTS = {
+    "SendMessageRequest",
+    "SendMediaRequest",
+    "SendMultiMediaRequest",
+    "ForwardMessagesRequest",
+    "EditMessageRequest",
+    "DeleteMessagesRequest",
+}
+
+
+def classify(request) -> str:
+    """
+    Класс метода запроса: auth, send, download или read
+    """
+    namespace = type(request).__module__.rsplit(".", 1)[-1]
+    if namespace == "auth":
+        return "auth"
+    if namespace == "upload":
+        return "download"
+    if type(request).__name__ in SEND_REQUESTS:
+        return "send"
+    return "read"
+
+
+class TokenBucket:
+    """
+    Корзина токенов с резервированием
+
+    reserve сразу забирает токен (баланс может уйти в минус) и возвращает,
+    сколько ждать до его появления. Между проверкой и списанием нет await,
+    поэтому одновременные корутины не проходят проверку вместе, а ждут
+    каждая своей очереди в порядке вызова.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, count: float, now: float) -> float:
+        """
+        Резервирует count токенов
+
+        Returns:
+            float: Время ожидания (в секундах)
+        """
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= count
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def refund(self, count: float) -> None:
+        """
+        Возвращает токены ожидавшего запроса, который был отменен
+        """
+        self.tokens = min(self.capacity, self.tokens + count)
+
+    def idle(self, now: float) -> bool:
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+class RateLimiter:
+    """
+    Ограничитель запросов клиентов Telegram
+
+    Каждый запрос клиента (включая страницы iter_dialogs и части загрузок)
+    получает токен из корзины пользователя для своего класса метода и из
+    общей корзины API_ID. Если токенов нет, запрос ждет; ожидающие
+    запросы составляют очередь, глубина и время ожидания которой видны в
+    статистике.
+    """
+
+    def __init__(self, rates: Dict[str, float], burst_seconds: float, global_rate: float, api_id: int):
+        self.rates = rates
+        self.burst_seconds = burst_seconds
+        self.enabled = True
+        self.buckets: Dict[Tuple[Hashable, str], TokenBucket] = {}
+        self.api_id = api_id
+        self.global_bucket = TokenBucket(global_rate, max(1.0, global_rate * burst_seconds))
+        self.stats: Dict[str, Dict[str, float]] = {}
+
+    def bucket(self, user_id: Hashable, method_class: str) -> TokenBucket:
+        key = (user_id, method_class)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            rate = self.rates.get(method_class, self.rates["read"])
+            bucket = TokenBucket(rate, max(1.0, rate * self.burst_seconds))
+            self.buckets[key] = bucket
+        return bucket
+
+    async def acquire(self, user_id: Hashable, method_class: str, count: int = 1) -> float:
+        """
+        Ждет токены для count запросов пользователя
+
+        Returns:
+            float: Время ожидания (в секундах)
+        """
+        stats = self._stats(method_class)
+        stats["calls"] += count
+        if not self.enabled:
+            return 0.0
+
+        # Время берется после создания корзины: иначе новая корзина начинала бы с долга
+        buckets = [self.bucket(user_id, method_class), self.global_bucket]
+        now = time.monotonic()
+        delay = max([bucket.reserve(count, now) for bucket in buckets])
+        if delay <= 0:
+            return 0.0
+
+        stats["delayed"] += count
+        stats["queued"] += 1
+        stats["max_queued"] = max(stats["max_queued"], stats["queued"])
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            for bucket in buckets:
+                bucket.refund(count)
+            raise
+        finally:
+            stats["queued"] -= 1
+        stats["wait_total"] += delay
+        stats["wait_max"] = max(stats["wait_max"], delay)
+        return delay
+
+    def install(self, client: TelegramClient, user_id: Hashable) -> None:
+        """
+        Пропускает все запросы клиента через ограничитель
+
+        Args:
+            client: Клиент Telegram
+            user_id: Владелец корзин (для временных клиентов входа - temp_user_id)
+        """
+        client.owner_user_id = user_id
+        call = client._call
+
+        async def limited_call(sender, request, *args, **kwargs):
+            requests = request if utils.is_list_like(request) else (request,)
+            await self.acquire(client.owner_user_id, classify(requests[0]), len(requests))
+            return await call(sender, request, *args, **kwargs)
+
+        client._call = limited_call
+
+    def reassign(self, client: TelegramClient, user_id: Hashable) -> None:
+        """
+        Переводит запросы клиента на корзины другого пользователя (после входа)
+        """
+        client.owner_user_id = user_id
+
+    def forget(self, user_id: Hashable) -> None:
+        """
+        Удаляет заполненные корзины пользователя (клиент убран из пула)
+        """
+        now = time.monotonic()
+        for key in [k for k, bucket in self.buckets.items() if k[0] == user_id and bucket.idle(now)]:
+            del self.buckets[key]
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        Счетчики по классам методов, текущая очередь и число корзин
+        """
+        classes: Dict[str, Dict[str, float]] = {}
+        for method_class, stats in self.stats.items():
+            delayed = stats["delayed"]
+            classes[method_class] = dict(
+                stats,
+                wait_total=round(stats["wait_total"], 3),
+                wait_max=round(stats["wait_max"], 3),
+                wait_avg=round(stats["wait_total"] / delayed, 3) if delayed else 0.0
+            )
+        queued: List[float] = [stats["queued"] for stats in self.stats.values()]
+        return {"api_id": self.api_id, "classes": classes, "queued": sum(queued), "buckets": len(self.buckets)}
+
+    def _stats(self, method_class: str) -> Dict[str, float]:
+        stats = self.stats.get(method_class)
+        if stats is None:
+            stats = {"calls": 0, "delayed": 0, "queued": 0, "max_queued": 0, "wait_total": 0.0, "wait_max": 0.0}
+            self.stats[method_class] = stats
+        return stats
+
+
+rate_limiter = RateLimiter(
+    {
+        "read": settings.RATE_LIMIT_READ,
+        "send": settings.RATE_LIMIT_SEND,
+        "download": settings.RATE_LIMIT_DOWNLOAD,
+        "auth": settings.RATE_LIMIT_AUTH,
+    },
+    settings.RATE_LIMIT_BURST_SECONDS,
+    # Лимит на TELEGRAM_API_ID делится между шардами (см. app.shards)
+    share_of(settings.RATE_LIMIT_GLOBAL),
+    settings.TELEGRAM_API_ID
+)
@@ -0,0 +1,646 @@
+"""
+Общее хранилище сессий Telethon всех пользователей в одной базе SQLite
+"""
+import os
+import time
+import asyncio
+import sqlite3
+import logging
+import datetime
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set
+
+from telethon import utils
+from telethon.crypto import AuthKey
+from telethon.sessions.memory import MemorySession, _SentFileType
+from telethon.tl import types
+from telethon.tl.types import InputPhoto, InputDocument, PeerUser, PeerChat, PeerChannel
+
+from app.core.config import settings
+
+try:
+    import fcntl
+except ImportError:  # Windows: процесс с базой всегда один
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# База сессий лежит на volume рядом со старыми файлами .session
+SESSIONS_DB_PATH = os.path.join(settings.SESSIONS_DIR, "sessions.db")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    key TEXT PRIMARY KEY,
+    dc_id INTEGER,
+    server_address TEXT,
+    port INTEGER,
+    auth_key BLOB,
+    takeout_id INTEGER,
+    updated_at REAL
+);
+CREATE TABLE IF NOT EXISTS entities (
+    key TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    hash INTEGER NOT NULL,
+    username TEXT,
+    phone INTEGER,
+    name TEXT,
+    date INTEGER,
+    PRIMARY KEY (key, id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS entities_username ON entities (key, username);
+CREATE INDEX IF NOT EXISTS entities_phone ON entities (key, phone);
+CREATE INDEX IF NOT EXISTS entities_name ON entities (key, name);
+CREATE TABLE IF NOT EXISTS sent_files (
+    key TEXT NOT NULL,
+    md5_digest BLOB,
+    file_size INTEGER,
+    type INTEGER,
+    id INTEGER,
+    hash INTEGER,
+    PRIMARY KEY (key, md5_digest, file_size, type)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS update_state (
+    key TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    pts INTEGER,
+    qts INTEGER,
+    date INTEGER,
+    seq INTEGER,
+    PRIMARY KEY (key, id)
+) WITHOUT ROWID;
+"""
+
+# Таблицы, строки которых принадлежат сессии (по колонке key)
+SESSION_TABLES = ("sessions", "entities", "sent_files", "update_state")
+
+
+class SessionDatabase:
+    """
+    База сессий всех пользователей процесса
+
+    Сессия адресуется ключом (user_{id} или temp_user_{id}) - тем же
+    именем, что было у файла .session.
+
+    Соединений два. Читающее (conn) используется из цикла событий: в
+    режиме WAL чтение не ждет записей, в том числе записей других шардов.
+    Пишущее (writer) принадлежит потоку хранилища: все записи выполняются
+    в нем по очереди (см. submit и run), поэтому ожидание блокировки
+    записи общей базы не останавливает цикл событий.
+
+    Соединения работают в режиме автофиксации: каждая запись сразу
+    фиксируется, а несколько связанных записей выполняются в короткой явной
+    транзакции (см. transaction). Открытая между вызовами транзакция
+    держала бы блокировку записи общей базы, и шарды (см. app.shards)
+    получали бы "database is locked".
+
+    Ключи сессий с авторизацией хранятся в памяти (known) и обновляются
+    при входе и удалении сессии, поэтому has_session не обращается ни к
+    базе, ни к файловой системе, а find_session ищет в базе только
+    неизвестный ключ и только в потоке хранилища. Проверка директории и перенос старых
+    файлов .session выполняются один раз при запуске (см. start) в потоке
+    хранилища; туда же уходят переносы и удаления сессий из обработчиков
+    запросов (см. run).
+    """
+
+    def __init__(self, path: str, legacy_dir: str):
+        self.path = path
+        self.legacy_dir = legacy_dir
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="session-store")
+        self.writer = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.writer.execute("PRAGMA journal_mode=WAL")
+        self.writer.execute("PRAGMA synchronous=NORMAL")
+        self.writer.executescript(SCHEMA)
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.known: Set[str] = {
+            row[0] for row in self.conn.execute("SELECT key FROM sessions WHERE length(auth_key) > 0")
+        }
+        # Состояние директории сессий (заполняется в start)
+        self.dir_exists: Optional[bool] = None
+        self.dir_writable: Optional[bool] = None
+        # Файл блокировки обслуживания, держится открытым до закрытия базы
+        self.maintenance_lock = None
+
+    def execute(self, statement: str, *values) -> Optional[tuple]:
+        """
+        Выполняет чтение и возвращает первую строку результата (из цикла событий)
+        """
+        return self.conn.execute(statement, values).fetchone()
+
+    def fetchall(self, statement: str, *values) -> List[tuple]:
+        return self.conn.execute(statement, values).fetchall()
+
+    def executemany(self, statement: str, rows: List[tuple]) -> None:
+        """
+        Выполняет запись для всех строк в одной транзакции (в потоке хранилища)
+        """
+        with self.transaction() as conn:
+            conn.executemany(statement, rows)
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """
+        Выполняет записи блока в одной транзакции и сразу фиксирует ее (в потоке хранилища)
+        """
+        self.writer.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.writer
+        except BaseException:
+            self.writer.execute("ROLLBACK")
+            raise
+        self.writer.execute("COMMIT")
+
+    async def run(self, fn: Callable[..., Any], *args) -> Any:
+        """
+        Выполняет операцию с базой или файлами в потоке хранилища
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    def submit(self, fn: Callable[..., Any], *args) -> None:
+        """
+        Ставит запись в очередь потока хранилища, не дожидаясь ее выполнения
+        """
+        self.executor.submit(self._apply, fn, *args)
+
+    def _apply(self, fn: Callable[..., Any], *args) -> None:
+        try:
+            fn(*args)
+        except Exception as e:
+            logger.error(f"Ошибка записи в базу сессий: {e}")
+
+    async def start(self, maintenance: bool = True) -> None:
+        """
+        Проверяет директорию сессий, переносит старые файлы .session в базу
+        и удаляет временные сессии незавершенных входов прошлого запуска
+
+        Args:
+            maintenance: Переносить и удалять сессии. Шарды (см. app.shards) этого
+                не делают: база у них общая, и временные сессии другого шарда
+                могут принадлежать идущим входам. Обслуживание выполняет app.shards
+                до запуска шардов. Воркеры uvicorn обслуживают базу только
+                первым из них (см. claim_maintenance).
+        """
+        await self.run(self.check_directory)
+        if maintenance and self.claim_maintenance():
+            await self.run(self.migrate_legacy)
+            await self.run(self.purge_temporary)
+
+    def claim_maintenance(self) -> bool:
+        """
+        Берет блокировку обслуживания базы на все время работы процесса
+
+        При uvicorn --workers каждый воркер запускает start, и удаление
+        временных сессий в каждом из них стирало бы входы, уже начатые на
+        других воркерах. Блокировку получает один процесс, а перезапущенный
+        воркер не получает ее, пока жив держащий.
+
+        Returns:
+            bool: True, если этот процесс обслуживает базу
+        """
+        if fcntl is None:
+            return True
+        lock = open(f"{self.path}.maintenance.lock", "a")
+        try:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()
+            logger.info("База сессий уже обслуживается другим процессом")
+            return False
+        self.maintenance_lock = lock
+        return True
+
+    def has_session(self, key: str) -> bool:
+        """
+        Проверяет по реестру в памяти, есть ли сессия с ключом авторизации
+
+        Не обращается к базе и подходит для диагностики в обработчиках
+        ошибок. Перед созданием клиента используется find_session.
+        """
+        return key in self.known
+
+    async def find_session(self, key: str) -> bool:
+        """
+        Проверяет, есть ли сессия с ключом авторизации
+
+        Вход мог завершить другой процесс с той же базой (шард или воркер
+        uvicorn), поэтому ключ, которого нет в памяти, ищется в базе - в
+        потоке хранилища, чтобы не блокировать цикл событий.
+        """
+        if key in self.known:
+            return True
+        if await self.run(self._find_session, key):
+            self.known.add(key)
+            return True
+        return False
+
+    def _find_session(self, key: str) -> bool:
+        return self.writer.execute(
+            "SELECT 1 FROM sessions WHERE key = ? AND length(auth_key) > 0", (key,)
+        ).fetchone() is not None
+
+    def list_sessions(self) -> List[str]:
+        """
+        Ключи всех сессий с авторизацией
+        """
+        return sorted(self.known)
+
+    def rename(self, old_key: str, new_key: str) -> None:
+        """
+        Переносит сессию под новый ключ (заменяя существующую) в одной транзакции
+        """
+        with self.transaction() as conn:
+            for table in SESSION_TABLES:
+                conn.execute(f"DELETE FROM {table} WHERE key = ?", (new_key,))
+                conn.execute(f"UPDATE {table} SET key = ? WHERE key = ?", (new_key, old_key))
+        if old_key in self.known:
+            self.known.discard(old_key)
+            self.known.add(new_key)
+        else:
+            self.known.discard(new_key)
+
+    def delete(self, key: str) -> None:
+        """
+        Удаляет сессию и все ее данные
+        """
+        self.known.discard(key)
+        with self.transaction() as conn:
+            for table in SESSION_TABLES:
+                conn.execute(f"DELETE FROM {table} WHERE key = ?", (key,))
+
+    def close(self) -> None:
+        # Дожидаемся записей из очереди
+        self.executor.shutdown(wait=True)
+        self.writer.close()
+        self.conn.close()
+        if self.maintenance_lock is not None:
+            self.maintenance_lock.close()
+            self.maintenance_lock = None
+
+    def check_directory(self) -> bool:
+        """
+        Проверяет существование директории сессий и права на запись в нее
+
+        Returns:
+            bool: True, если директория доступна для записи
+        """
+        self.dir_exists = os.path.isdir(self.legacy_dir)
+        try:
+            test_file = os.path.join(self.legacy_dir, "test_write_permission.tmp")
+            with open(test_file, 'w') as f:
+                f.write("test")
+            os.remove(test_file)
+            self.dir_writable = True
+        except Exception as e:
+            logger.error(f"Нет прав на запись в директорию сессий: {str(e)}")
+            self.dir_writable = False
+        logger.info(f"Директория сессий доступна для записи: {self.dir_writable}")
+        return self.dir_writable
+
+    def purge_temporary(self) -> int:
+        """
+        Удаляет временные сессии (temp_user_*) и их старые файлы
+
+        Незавершенные входы живут только в памяти процесса, поэтому при
+        запуске все временные сессии брошены.
+
+        Returns:
+            int: Количество удаленных сессий
+        """
+        keys = [
+            row[0] for row in
+            self.writer.execute("SELECT DISTINCT key FROM sessions WHERE key LIKE 'temp_user_%'").fetchall()
+        ]
+        for key in keys:
+            self.delete(key)
+        try:
+            files = [f for f in os.listdir(self.legacy_dir) if f.startswith("temp_user_") and ".session" in f]
+        except OSError as e:
+            logger.error(f"Ошибка при чтении директории сессий: {e}")
+            files = []
+        for name in files:
+            try:
+                os.remove(os.path.join(self.legacy_dir, name))
+            except OSError as e:
+                logger.warning(f"Не удалось удалить временный файл сессии {name}: {e}")
+        if keys or files:
+            logger.info(f"Удалено временных сессий: {len(keys)}, файлов: {len(files)}")
+        return len(keys)
+
+    def migrate_legacy(self) -> int:
+        """
+        Переносит в базу сессии из всех старых файлов .session
+
+        Returns:
+            int: Количество перенесенных сессий
+        """
+        try:
+            files = [
+                f for f in os.listdir(self.legacy_dir)
+                if f.endswith(".session") and not f.startswith("temp_user_")
+            ]
+        except OSError as e:
+            logger.error(f"Ошибка при чтении директории сессий: {e}")
+            return 0
+        migrated = sum(1 for f in files if self.import_legacy(f[:-len(".session")]))
+        if migrated:
+            logger.info(f"Перенесено сессий из файлов в общую базу: {migrated}")
+        return migrated
+
+    def import_legacy(self, key: str) -> bool:
+        """
+        Переносит в базу сессию из старого файла {key}.session, если он есть
+
+        Returns:
+            bool: True, если сессия перенесена
+        """
+        path = os.path.join(self.legacy_dir, f"{key}.session")
+        if not os.path.exists(path):
+            return False
+
+        try:
+            legacy = sqlite3.connect(path)
+            try:
+                session = legacy.execute("SELECT dc_id, server_address, port, auth_key, takeout_id FROM sessions").fetchone()
+                entities = legacy.execute("SELECT id, hash, username, phone, name, date FROM entities").fetchall()
+                update_state = legacy.execute("SELECT id, pts, qts, date, seq FROM update_state").fetchall()
+            finally:
+                legacy.close()
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка при чтении файла сессии {path}: {e}")
+            return False
+
+        if session is None:
+            return False
+
+        # Сессия в базе новее файла (файл не удалось переименовать при прошлом переносе)
+        if self.writer.execute("SELECT 1 FROM sessions WHERE key = ?", (key,)).fetchone():
+            logger.warning(f"Сессия {key} уже есть в общей базе, файл {path} пропущен")
+            return False
+
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key,) + tuple(session) + (time.time(),)
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO entities VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(key,) + tuple(row) for row in entities]
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO update_state VALUES (?, ?, ?, ?, ?, ?)",
+                [(key,) + tuple(row) for row in update_state]
+            )
+        # Файл больше не нужен: переименовываем, чтобы не перенести сессию повторно
+        # после ее удаления из базы
+        try:
+            os.replace(path, f"{path}.migrated")
+        except OSError as e:
+            logger.warning(f"Не удалось переименовать перенесенный файл сессии {path}: {e}")
+        if session[3]:
+            self.known.add(key)
+        logger.info(f"Сессия {key} перенесена из файла {path} в общую базу")
+        return True
+
+
+class SharedSession(MemorySession):
+    """
+    Сессия Telethon, хранящаяся в общей базе под ключом key
+
+    Повторяет SQLiteSession, но все таблицы общие и различаются колонкой
+    key, а соединения одни на процесс. Чтение выполняется сразу, запись
+    ставится в очередь потока хранилища (см. SessionDatabase). Пока запись
+    не выполнена, ее строки лежат в pending и чтение находит их там.
+    """
+
+    def __init__(self, db: SessionDatabase, key: str):
+        super().__init__()
+        self.db = db
+        self.key = key
+        self.save_entities = True
+        # Еще не записанные строки: таблица -> первичный ключ строки (без key) -> строка
+        self.pending: Dict[str, Dict[Any, Any]] = {"entities": {}, "update_state": {}, "sent_files": {}}
+        self.pending_lock = threading.Lock()
+
+        row = db.execute(
+            "SELECT dc_id, server_address, port, auth_key, takeout_id FROM sessions WHERE key = ?",
+            key
+        )
+        if row:
+            self._dc_id, self._server_address, self._port, auth_key, self._takeout_id = row
+            self._auth_key = AuthKey(data=auth_key) if auth_key else None
+
+    def clone(self, to_instance=None):
+        cloned = super().clone(to_instance)
+        cloned.save_entities = self.save_entities
+        return cloned
+
+    def set_dc(self, dc_id, server_address, port):
+        super().set_dc(dc_id, server_address, port)
+        self._update_session_table()
+
+    @MemorySession.auth_key.setter
+    def auth_key(self, value):
+        self._auth_key = value
+        self._update_session_table()
+
+    @MemorySession.takeout_id.setter
+    def takeout_id(self, value):
+        self._takeout_id = value
+        self._update_session_table()
+
+    def _update_session_table(self):
+        if self._auth_key:
+            self.db.known.add(self.key)
+        row = (
+            self._dc_id,
+            self._server_address,
+            self._port,
+            self._auth_key.key if self._auth_key else b'',
+            self._takeout_id,
+            time.time()
+        )
+        self.db.submit(self._write, "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?, ?, ?)", [row])
+
+    def _queue(self, table: str, rows: Dict[Any, tuple], statement: str) -> None:
+        """
+        Ставит строки в очередь записи и держит их в pending, пока запись не выполнена
+        """
+        with self.pending_lock:
+            self.pending[table].update(rows)
+        self.db.submit(self._write, statement, list(rows.values()), table, rows)
+
+    def _write(self, statement: str, rows: List[tuple], table: Optional[str] = None,
+               written: Optional[Dict[Any, tuple]] = None) -> None:
+        # Выполняется в потоке хранилища. Ключ берется в момент записи: после
+        # rehome строки из очереди попадают уже под новый ключ
+        try:
+            self.db.executemany(statement, [(self.key,) + tuple(row) for row in rows])
+        finally:
+            if table is not None:
+                with self.pending_lock:
+                    pending = self.pending[table]
+                    for row_key, row in written.items():
+                        # Строку могли заменить более новой, ее запись еще в очереди
+                        if pending.get(row_key) is row:
+                            del pending[row_key]
+
+    def _pending_rows(self, table: str) -> List[Any]:
+        with self.pending_lock:
+            return list(self.pending[table].values())
+
+    def get_update_state(self, entity_id):
+        with self.pending_lock:
+            row = self.pending["update_state"].get(entity_id)
+        if row is None:
+            row = self.db.execute(
+                "SELECT id, pts, qts, date, seq FROM update_state WHERE key = ? AND id = ?",
+                self.key, entity_id
+            )
+        if row:
+            return self._state(row)
+
+    def set_update_state(self, entity_id, state):
+        row = (entity_id, state.pts, state.qts, state.date.timestamp(), state.seq)
+        self._queue("update_state", {entity_id: row}, "INSERT OR REPLACE INTO update_state VALUES (?, ?, ?, ?, ?, ?)")
+
+    def get_update_states(self):
+        rows = {row[0]: row for row in self.db.fetchall("SELECT id, pts, qts, date, seq FROM update_state WHERE key = ?", self.key)}
+        rows.update((row[0], row) for row in self._pending_rows("update_state"))
+        return ((entity_id, self._state(row)) for entity_id, row in rows.items())
+
+    @staticmethod
+    def _state(row: tuple):
+        return types.updates.State(
+            pts=row[1],
+            qts=row[2],
+            date=datetime.datetime.fromtimestamp(row[3], tz=datetime.timezone.utc),
+            seq=row[4],
+            unread_count=0
+        )
+
+    def rehome(self, new_key: str) -> None:
+        """
+        Переносит сессию под новый ключ и продолжает работать с ним
+
+        Выполняется в потоке хранилища (см. SessionDatabase.run), как и все
+        записи сессии, поэтому запись, сделанная клиентом в это время, не
+        останется под старым ключом.
+        """
+        self.db.rename(self.key, new_key)
+        self.key = new_key
+
+    def save(self):
+        # Записи фиксируются сразу (см. SessionDatabase)
+        pass
+
+    def close(self):
+        # Соединения общие и не держат транзакций - закрывать нечего
+        pass
+
+    def delete(self):
+        self.db.known.discard(self.key)
+        self.db.submit(self.db.delete, self.key)
+        return True
+
+    def process_entities(self, tlo):
+        if not self.save_entities:
+            return
+        rows = self._entities_to_rows(tlo)
+        if not rows:
+            return
+        now = int(time.time())
+        self._queue(
+            "entities",
+            {row[0]: tuple(row) + (now,) for row in rows},
+            "INSERT OR REPLACE INTO entities VALUES (?, ?, ?, ?, ?, ?, ?)"
+        )
+
+    def _find_pending_entity(self, column: int, value) -> Optional[tuple]:
+        # Строки entities: id, hash, username, phone, name, date. Телефон
+        # бывает и строкой, и числом (в базе колонка INTEGER) - сравниваем строки
+        rows = [
+            row for row in self._pending_rows("entities")
+            if row[column] is not None and str(row[column]) == str(value)
+        ]
+        if not rows:
+            return None
+        row = max(rows, key=lambda r: r[5] or 0)
+        return row[0], row[1]
+
+    def get_entity_rows_by_phone(self, phone):
+        return (
+            self._find_pending_entity(3, phone)
+            or self.db.execute("SELECT id, hash FROM entities WHERE key = ? AND phone = ?", self.key, phone)
+        )
+
+    def get_entity_rows_by_username(self, username):
+        pending = self._find_pending_entity(2, username)
+        if pending:
+            return pending
+        results = self.db.fetchall("SELECT id, hash, date FROM entities WHERE key = ? AND username = ?", self.key, username)
+        if not results:
+            return None
+        # Если имя пользователя встречается несколько раз, оставляем самую свежую запись
+        if len(results) > 1:
+            results.sort(key=lambda t: t[2] or 0)
+            self.db.submit(
+                self.db.executemany,
+                "UPDATE entities SET username = NULL WHERE key = ? AND id = ?",
+                [(self.key, t[0]) for t in results[:-1]]
+            )
+        return results[-1][0], results[-1][1]
+
+    def get_entity_rows_by_name(self, name):
+        return (
+            self._find_pending_entity(4, name)
+            or self.db.execute("SELECT id, hash FROM entities WHERE key = ? AND name = ?", self.key, name)
+        )
+
+    def get_entity_rows_by_id(self, id, exact=True):
+        if exact:
+            ids = (id,)
+        else:
+            ids = (utils.get_peer_id(PeerUser(id)), utils.get_peer_id(PeerChat(id)), utils.get_peer_id(PeerChannel(id)))
+        with self.pending_lock:
+            pending = self.pending["entities"]
+            for entity_id in ids:
+                if entity_id in pending:
+                    return pending[entity_id][0], pending[entity_id][1]
+        if exact:
+            return self.db.execute("SELECT id, hash FROM entities WHERE key = ? AND id = ?", self.key, id)
+        return self.db.execute("SELECT id, hash FROM entities WHERE key = ? AND id IN (?, ?, ?)", self.key, *ids)
+
+    def get_file(self, md5_digest, file_size, cls):
+        file_type = _SentFileType.from_type(cls).value
+        with self.pending_lock:
+            row = self.pending["sent_files"].get((md5_digest, file_size, file_type))
+        if row:
+            return cls(row[3], row[4])
+        row = self.db.execute(
+            "SELECT id, hash FROM sent_files WHERE key = ? AND md5_digest = ? AND file_size = ? AND type = ?",
+            self.key, md5_digest, file_size, file_type
+        )
+        if row:
+            return cls(row[0], row[1])
+
+    def cache_file(self, md5_digest, file_size, instance):
+        if not isinstance(instance, (InputDocument, InputPhoto)):
+            raise TypeError(f"Нельзя кэшировать {type(instance)}")
+        file_type = _SentFileType.from_type(type(instance)).value
+        self._queue(
+            "sent_files",
+            {(md5_digest, file_size, file_type): (md5_digest, file_size, file_type, instance.id, instance.access_hash)},
+            "INSERT OR REPLACE INTO sent_files VALUES (?, ?, ?, ?, ?, ?)"
+        )
+
+
+session_db = SessionDatabase(SESSIONS_DB_PATH, settings.SESSIONS_DIR)
+
+
+def open_session(key: str) -> SharedSession:
+    """
+    Сессия Telethon для ключа (user_{id} или temp_user_{id})
+    """
+    return SharedSession(session_db, key)
@@ -0,0 +1,90 @@
+"""
+Распределение пользователей по процессам-шардам (согласованное хеширование)
+"""
+import os
+import re
+import bisect
+import hashlib
+import logging
+from typing import List, Tuple
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def _point(key: str) -> int:
+    # Хеш не зависит от процесса (в отличие от hash() с PYTHONHASHSEED)
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+def phone_key(phone_number: str) -> str:
+    """
+    Ключ входа по номеру телефона: один номер в любой записи попадает на один шард
+    """
+    return f"phone:{re.sub(r'[^0-9]', '', phone_number)}"
+
+
+def user_key(user_id: int) -> str:
+    return f"user:{user_id}"
+
+
+class ShardRing:
+    """
+    Кольцо согласованного хеширования: ключ -> номер шарда
+
+    Каждый шард занимает virtual_nodes точек кольца, ключ принадлежит шарду
+    первой точки за его хешем. При изменении числа шардов переезжает только
+    доля пользователей, приходящаяся на добавленные или убранные шарды, а
+    не почти все, как при user_id % count.
+    """
+
+    def __init__(self, count: int, virtual_nodes: int):
+        self.count = max(count, 1)
+        points: List[Tuple[int, int]] = sorted(
+            (_point(f"shard:{shard}:{node}"), shard)
+            for shard in range(self.count)
+            for node in range(virtual_nodes)
+        )
+        self.points = [point for point, _ in points]
+        self.shards = [shard for _, shard in points]
+
+    def shard_for(self, key: str) -> int:
+        """
+        Номер шарда, которому принадлежит ключ
+        """
+        if self.count == 1:
+            return 0
+        index = bisect.bisect(self.points, _point(key)) % len(self.points)
+        return self.shards[index]
+
+    def shard_for_user(self, user_id: int) -> int:
+        return self.shard_for(user_key(user_id))
+
+
+def socket_path(shard: int) -> str:
+    """
+    Путь к Unix-сокету шарда
+    """
+    return os.path.join(settings.SHARD_SOCKET_DIR, f"shard-{shard}.sock")
+
+
+def is_sharded() -> bool:
+    return settings.SHARD_COUNT > 1
+
+
+def owns(user_id: int) -> bool:
+    """
+    Обслуживает ли этот процесс клиента пользователя
+    """
+    return not is_sharded() or shard_ring.shard_for_user(int(user_id)) == settings.SHARD_INDEX
+
+
+def share_of(total: float) -> float:
+    """
+    Доля общего для всех шардов лимита, приходящаяся на этот процесс
+    """
+    return total / settings.SHARD_COUNT if is_sharded() else total
+
+
+shard_ring = ShardRing(settings.SHARD_COUNT, settings.SHARD_VIRTUAL_NODES)
@@ -0,0 +1,330 @@
+"""
+Общий для воркеров кэш второго уровня в Redis и рассылка инвалидаций
+"""
+import json
+import time
+import uuid
+import asyncio
+import logging
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple, Union
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Виды записей, об изменении которых сообщается другим воркерам
+# (аватары адресуются по photo_id и не меняются)
+INVALIDATED_KINDS = ("dialogs", "messages")
+
+# Значение для записи: готовая строка или функция, сериализующая текущее
+# значение в момент записи (None - записи в L1 уже нет, пропускаем)
+PendingValue = Union[str, Callable[[], Optional[str]]]
+
+
+class MemoryRedis:
+    """
+    Redis в памяти процесса (REDIS_URL=memory://имя)
+
+    Поддерживает только команды, которые использует SharedCache. Клиенты с
+    одинаковым именем видят общие данные и каналы, поэтому несколько
+    экземпляров SharedCache в одном процессе ведут себя как воркеры с
+    общим redis-server.
+    """
+
+    servers: Dict[str, "MemoryRedis"] = {}
+
+    def __init__(self):
+        self.data: Dict[str, Tuple[str, Optional[float]]] = {}
+        self.subscribers: Dict[str, List[asyncio.Queue]] = {}
+
+    @classmethod
+    def from_url(cls, url: str) -> "MemoryRedis":
+        name = url[len("memory://"):]
+        if name not in cls.servers:
+            cls.servers[name] = cls()
+        return cls.servers[name]
+
+    async def get(self, name: str) -> Optional[str]:
+        item = self.data.get(name)
+        if item is None:
+            return None
+        value, expires_at = item
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self.data[name]
+            return None
+        return value
+
+    async def set(self, name: str, value: str, ex: Optional[float] = None) -> bool:
+        self.data[name] = (value, time.monotonic() + ex if ex else None)
+        return True
+
+    async def delete(self, *names: str) -> int:
+        return sum(self.data.pop(name, None) is not None for name in names)
+
+    async def publish(self, channel: str, message: str) -> int:
+        queues = self.subscribers.get(channel, [])
+        for queue in queues:
+            queue.put_nowait({"type": "message", "channel": channel, "data": message})
+        return len(queues)
+
+    def pipeline(self, transaction: bool = True) -> "MemoryPipeline":
+        return MemoryPipeline(self)
+
+    def pubsub(self, ignore_subscribe_messages: bool = False) -> "MemoryPubSub":
+        return MemoryPubSub(self)
+
+    async def aclose(self) -> None:
+        pass
+
+
+class MemoryPipeline:
+    """
+    Пакет команд MemoryRedis
+    """
+
+    def __init__(self, server: MemoryRedis):
+        self.server = server
+        self.commands: List[Tuple[str, tuple, dict]] = []
+
+    def __getattr__(self, command: str) -> Callable[..., "MemoryPipeline"]:
+        def queue(*args, **kwargs) -> "MemoryPipeline":
+            self.commands.append((command, args, kwargs))
+            return self
+        return queue
+
+    async def execute(self) -> List[Any]:
+        commands, self.commands = self.commands, []
+        return [await getattr(self.server, command)(*args, **kwargs) for command, args, kwargs in commands]
+
+
+class MemoryPubSub:
+    """
+    Подписка на каналы MemoryRedis
+    """
+
+    def __init__(self, server: MemoryRedis):
+        self.server = server
+        self.channels: List[str] = []
+        self.queue: asyncio.Queue = asyncio.Queue()
+
+    async def subscribe(self, *channels: str) -> None:
+        for channel in channels:
+            self.server.subscribers.setdefault(channel, []).append(self.queue)
+            self.channels.append(channel)
+
+    async def listen(self):
+        while True:
+            yield await self.queue.get()
+
+    async def aclose(self) -> None:
+        for channel in self.channels:
+            self.server.subscribers[channel].remove(self.queue)
+        self.channels = []
+
+
+class SharedCache:
+    """
+    Кэш второго уровня (L2) в Redis поверх кэшей процесса (L1, BoundedCache)
+
+    Записи хранятся сериализованными в JSON. Изменения копятся в pending и
+    записываются одним пакетом: новые значения после загрузки из Telegram -
+    сразу, правки на месте (обновления Telegram) - не чаще раза в
+    flush_interval. Вместе с записью в канал публикуется сообщение об
+    изменении, по которому остальные воркеры удаляют запись из своего L1 и
+    при следующем обращении читают ее из L2.
+
+    Если REDIS_URL не задан, кэш выключен и все методы ничего не делают.
+    """
+
+    def __init__(self, url: str, prefix: str, ttl: float, flush_interval: float):
+        self.url = url
+        self.prefix = prefix
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.channel = f"{prefix}:invalidate"
+        self.worker_id = uuid.uuid4().hex
+        self.redis: Any = None
+        self.pubsub: Any = None
+        self.pending: Dict[Tuple[str, Hashable], PendingValue] = {}
+        self.handlers: Dict[str, Callable[[str], None]] = {}
+        self.wakeup: Optional[asyncio.Event] = None
+        self.tasks: List[asyncio.Task] = []
+        self.stats: Dict[str, int] = {
+            "hits": 0,
+            "misses": 0,
+            "writes": 0,
+            "errors": 0,
+            "published": 0,
+            "invalidated": 0
+        }
+
+    @property
+    def enabled(self) -> bool:
+        return self.redis is not None
+
+    async def start(self) -> None:
+        """
+        Подключается к Redis, подписывается на инвалидации и запускает запись пакетами
+        """
+        if not self.url or self.enabled:
+            return
+        if self.url.startswith("memory://"):
+            self.redis = MemoryRedis.from_url(self.url)
+        else:
+            import redis.asyncio as redis
+            self.redis = redis.from_url(self.url, decode_responses=True)
+        self.pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        await self.pubsub.subscribe(self.channel)
+        self.wakeup = asyncio.Event()
+        self.tasks = [asyncio.ensure_future(self._listen()), asyncio.ensure_future(self._flush_loop())]
+        logger.info(f"Общий кэш подключен: {self.url.split('@')[-1]}, воркер {self.worker_id}")
+
+    async def shutdown(self) -> None:
+        """
+        Записывает накопленные изменения и отключается от Redis
+        """
+        if not self.enabled:
+            return
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        await self.flush()
+        await self.pubsub.aclose()
+        await self.redis.aclose()
+        self.redis = None
+
+    def on_invalidate(self, kind: str, handler: Callable[[str], None]) -> None:
+        """
+        Регистрирует обработчик изменения записи вида kind другим воркером
+        """
+        self.handlers[kind] = handler
+
+    async def get(self, kind: str, key: Hashable) -> Optional[Any]:
+        """
+        Читает запись из L2
+
+        Returns:
+            Optional[Any]: Десериализованное значение или None (нет записи, кэш выключен или ошибка)
+        """
+        if not self.enabled:
+            return None
+        try:
+            data = await self.redis.get(self._name(kind, key))
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.warning(f"Ошибка при чтении из общего кэша {kind}:{key}: {e}")
+            return None
+        if data is None:
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        return json.loads(data)
+
+    def put(self, kind: str, key: Hashable, data: str, wake: bool = True) -> None:
+        """
+        Ставит в очередь запись уже сериализованного значения
+
+        Args:
+            kind: Вид записи
+            key: Ключ
+            data: Значение в JSON
+            wake: Записать сразу, не дожидаясь flush_interval
+        """
+        if not self.enabled:
+            return
+        self.pending[(kind, key)] = data
+        if wake:
+            self.wakeup.set()
+
+    def mark_dirty(self, kind: str, key: Hashable, dump: Callable[[], Optional[str]]) -> None:
+        """
+        Отмечает запись, измененную на месте: dump сериализует ее при следующей записи пакета
+        """
+        if not self.enabled:
+            return
+        # Функция сериализует текущее значение - оно не старее уже ожидающего
+        self.pending[(kind, key)] = dump
+
+    async def flush(self) -> int:
+        """
+        Записывает накопленные изменения одним пакетом и сообщает о них другим воркерам
+
+        Returns:
+            int: Количество записанных записей
+        """
+        if not self.pending:
+            return 0
+        pending, self.pending = self.pending, {}
+        pipe = self.redis.pipeline(transaction=False)
+        written = 0
+        for (kind, key), value in pending.items():
+            data = value() if callable(value) else value
+            if data is None:
+                continue
+            pipe.set(self._name(kind, key), data, ex=int(self.ttl))
+            written += 1
+            if kind in INVALIDATED_KINDS:
+                pipe.publish(self.channel, json.dumps({"worker": self.worker_id, "kind": kind, "key": str(key)}))
+                self.stats["published"] += 1
+        try:
+            await pipe.execute()
+            self.stats["writes"] += written
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.error(f"Ошибка при записи в общий кэш ({written} записей): {e}")
+        return written
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        Счетчики и число записей, ожидающих записи
+        """
+        return dict(self.stats, enabled=self.enabled, pending=len(self.pending))
+
+    def _name(self, kind: str, key: Hashable) -> str:
+        return f"{self.prefix}:{kind}:{key}"
+
+    async def _flush_loop(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка при записи в общий кэш: {e}")
+
+    async def _listen(self) -> None:
+        while True:
+            try:
+                async for message in self.pubsub.listen():
+                    self._handle(message)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка подписки на инвалидации общего кэша: {e}")
+                await asyncio.sleep(1.0)
+
+    def _handle(self, message: Dict[str, Any]) -> None:
+        if message.get("type") != "message":
+            return
+        try:
+            event = json.loads(message["data"])
+            if event["worker"] == self.worker_id:
+                return
+            handler = self.handlers.get(event["kind"])
+            if handler is not None:
+                handler(event["key"])
+                self.stats["invalidated"] += 1
+        except Exception as e:
+            logger.warning(f"Ошибка при обработке инвалидации общего кэша: {e}")
+
+
+shared_cache = SharedCache(
+    settings.REDIS_URL,
+    settings.SHARED_CACHE_PREFIX,
+    settings.SHARED_CACHE_TTL,
+    settings.SHARED_CACHE_FLUSH_INTERVAL
+)
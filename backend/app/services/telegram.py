@@ -1,96 +1,74 @@
-import os
+import json
 import logging
 import asyncio
-from typing import Dict, List, Any, Optional, Tuple
-from telethon import TelegramClient
-from telethon.errors import SessionPasswordNeededError, PhoneCodeInvalidError, FloodWaitError, UserDeactivatedBanError
+from typing import Dict, List, Any, Optional, Tuple, Set, Union
+from telethon import TelegramClient, events, utils
+from telethon.tl.types import User
+from telethon.errors import SessionPasswordNeededError, PhoneCodeInvalidError, UserDeactivatedBanError, UnauthorizedError, AuthKeyError
 from datetime import datetime, timedelta
 import random
 import time
 
 from app.core.config import settings
+from app.services.avatars import get_avatar_url, register_avatar_source, download_avatar, is_avatar_cached
+from app.services.media import get_media_info
+from app.services.cache import BoundedCache, CacheEntry
+from app.services.message_store import MessageStore
+from app.services.inflight import coalesce
+from app.services.local_store import TRANSIENT_FIELDS, local_store
+from app.services.client_pool import client_pool
+from app.services.session_store import session_db, open_session
+from app.services.pending_auth import PendingAuth, pending_auth
+from app.services.rate_limit import rate_limiter
+from app.services.flood import RetryAfterError, flood_control
+from app.services.priority import PREFETCH, MAINTENANCE, lane, priority_scheduler
+from app.services.fair import outbound_scheduler, cpu_scheduler
+from app.services.shared_cache import shared_cache
+from app.services.shards import owns
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Словарь для хранения клиентов
-clients: Dict[int, TelegramClient] = {}
+# Время жизни кэша (в секундах)
+CACHE_TTL = 3600.0  # 1 час
 
-# Словарь для отслеживания времени последнего запроса
-last_request_time: Dict[int, float] = {}
+# Кэш диалогов: user_id -> dialogs
+# Записи живут до DIALOGS_MAX_STALE: после CACHE_TTL они отдаются как устаревшие
+# и обновляются в фоне (stale-while-revalidate)
+dialogs_cache = BoundedCache("dialogs", settings.DIALOGS_MAX_STALE, settings.CACHE_MAX_BYTES, settings.CACHE_USER_MAX_BYTES)
 
-# Кэш диалогов: user_id -> (dialogs, timestamp)
-dialogs_cache: Dict[int, Tuple[List[Dict[str, Any]], float]] = {}
+# Кэш сообщений: (user_id, dialog_id) -> MessageStore
+messages_cache = BoundedCache("messages", CACHE_TTL, settings.CACHE_MAX_BYTES, settings.CACHE_USER_MAX_BYTES)
 
-# Кэш сообщений: (user_id, dialog_id) -> (messages, timestamp)
-messages_cache: Dict[Tuple[int, int], Tuple[List[Dict[str, Any]], float]] = {}
+# Семафоры загрузки аватаров: user_id -> semaphore
+avatar_semaphores: Dict[int, asyncio.Semaphore] = {}
 
-# Минимальный интервал между запросами (в секундах)
-MIN_REQUEST_INTERVAL = 0.1
+# Фоновые задачи, которые должны пережить запрос (храним ссылки, чтобы их не собрал GC)
+background_tasks: Set[asyncio.Task] = set()
 
-# Время жизни кэша (в секундах)
-CACHE_TTL = 3600.0  # 1 час
+# Кэш InputPeer диалогов: user_id -> {dialog_id -> InputPeer}
+# Заполняется из списка диалогов, чтобы открытие чата не тратило запрос на поиск сущности
+input_peers: Dict[int, Dict[int, Any]] = {}
 
-def ensure_sessions_dir():
-    """
-    Проверяет и создает директорию для сессий, если она не существует.
-    Также проверяет права на запись.
-    
-    Returns:
-        bool: True, если директория существует и доступна для записи, иначе False
-    """
-    try:
-        # Проверяем существование директории сессий
-        if not os.path.exists(settings.SESSIONS_DIR):
-            try:
-                os.makedirs(settings.SESSIONS_DIR, exist_ok=True)
-                logger.info(f"Создана директория сессий: {settings.SESSIONS_DIR}")
-            except Exception as e:
-                logger.error(f"Ошибка при создании директории сессий: {str(e)}")
-                return False
-        
-        # Проверяем права на запись в директорию сессий
-        try:
-            test_file = os.path.join(settings.SESSIONS_DIR, "test_write_permission.tmp")
-            with open(test_file, 'w') as f:
-                f.write("test")
-            os.remove(test_file)
-            logger.info(f"Проверка прав на запись в директорию сессий успешна")
-            return True
-        except Exception as e:
-            logger.error(f"Нет прав на запись в директорию сессий: {str(e)}")
-            return False
-    except Exception as e:
-        logger.error(f"Ошибка при проверке директории сессий: {str(e)}")
-        return False
+# Статистика кэша InputPeer
+peer_cache_stats: Dict[str, int] = {"hits": 0, "misses": 0}
+
+# Время последнего полного обхода диалогов: user_id -> timestamp
+dialogs_full_sync: Dict[int, float] = {}
+
+# Счетчики синхронизации списка диалогов
+dialog_sync_stats: Dict[str, int] = {"full": 0, "incremental": 0, "fetched": 0}
+
+# Счетчики обновлений, примененных к кэшам
+update_stats: Dict[str, int] = {"new": 0, "edited": 0, "deleted": 0, "read": 0, "dialogs_stale": 0}
 
-# Проверяем директорию сессий при запуске
-sessions_dir_writable = ensure_sessions_dir()
-logger.info(f"Директория сессий доступна для записи: {sessions_dir_writable}")
 if settings.IS_RAILWAY:
     logger.info(f"Приложение запущено на Railway. Путь к сессиям: {settings.SESSIONS_DIR}")
     if settings.RAILWAY_VOLUME_MOUNT_PATH:
         logger.info(f"Используется Railway Volume: {settings.RAILWAY_VOLUME_NAME}")
         logger.info(f"Путь монтирования: {settings.RAILWAY_VOLUME_MOUNT_PATH}")
 
-async def wait_for_request_limit(user_id: int):
-    """
-    Ожидает, если необходимо, чтобы соблюсти ограничения на частоту запросов
-    
-    Args:
-        user_id: ID пользователя
-    """
-    current_time = time.time()
-    if user_id in last_request_time:
-        elapsed = current_time - last_request_time[user_id]
-        if elapsed < MIN_REQUEST_INTERVAL:
-            wait_time = MIN_REQUEST_INTERVAL - elapsed
-            logger.info(f"Ожидаем {wait_time:.2f} секунд перед следующим запросом для пользователя {user_id}")
-            await asyncio.sleep(wait_time)
-    
-    last_request_time[user_id] = time.time()
-
 async def get_client(user_id: int) -> TelegramClient:
     """
     Получает или создает клиент Telegram для пользователя
@@ -103,126 +81,67 @@ async def get_client(user_id: int) -> TelegramClient:
     """
     logger.info(f"Запрос на получение клиента для пользователя {user_id}")
     
-    # Соблюдаем ограничения на частоту запросов
-    await wait_for_request_limit(user_id)
+    # Клиент пользователя живет только в его шарде (см. app.shards)
+    if not owns(user_id):
+        raise ValueError(f"Пользователь {user_id} обслуживается другим шардом")
     
-    # Проверяем, есть ли клиент в кэше
-    if user_id in clients:
-        logger.info(f"Клиент для пользователя {user_id} найден в кэше")
-        client = clients[user_id]
+    # Проверяем, есть ли клиент в пуле
+    client = client_pool.get(user_id)
+    if client is not None:
+        logger.info(f"Клиент для пользователя {user_id} найден в пуле")
         
-        # Проверяем, подключен ли клиент
+        # Авторизация проверена при создании клиента, ее перепроверяют фоновая
+        # проверка пула и ошибки авторизации (см. drop_client_on_auth_error)
         try:
             if not client.is_connected():
                 logger.info(f"Клиент не подключен, подключаемся")
                 await client.connect()
-                
-            # Проверяем авторизацию
-            if await client.is_user_authorized():
-                logger.info(f"Клиент авторизован, возвращаем его")
-                return client
-            else:
-                logger.warning(f"Клиент не авторизован, создаем новый")
-                # Если клиент не авторизован, удаляем его из кэша
-                del clients[user_id]
+            return client
         except Exception as e:
             logger.error(f"Ошибка при проверке клиента: {str(e)}")
-            # Если произошла ошибка, удаляем клиент из кэша
-            del clients[user_id]
+            # Если произошла ошибка, удаляем клиент из пула
+            await client_pool.remove(user_id)
     
-    # Проверяем существование директории сессий
-    if not os.path.exists(settings.SESSIONS_DIR):
-        try:
-            os.makedirs(settings.SESSIONS_DIR, exist_ok=True)
-            logger.info(f"Создана директория сессий: {settings.SESSIONS_DIR}")
-        except Exception as e:
-            logger.error(f"Ошибка при создании директории сессий: {str(e)}")
-            raise ValueError(f"Не удалось создать директорию сессий: {str(e)}")
-    
-    # Создаем путь к файлу сессии
-    session_file = os.path.join(settings.SESSIONS_DIR, f"user_{user_id}")
-    logger.info(f"Путь к файлу сессии: {session_file}")
-    logger.info(f"Полный путь к директории сессий: {os.path.abspath(settings.SESSIONS_DIR)}")
+    # Создаем клиент под блокировкой пользователя, чтобы одновременные
+    # запросы не подключили два клиента
+    async with client_pool.lock(user_id):
+        client = client_pool.get(user_id)
+        if client is not None:
+            logger.info(f"Клиент для пользователя {user_id} создан параллельным запросом")
+            return client
+        return await create_client(user_id)
+
+
+async def create_client(user_id: int) -> TelegramClient:
+    """
+    Создает, подключает и добавляет в пул клиент Telegram для пользователя
     
-    # Проверяем существование файла сессии
-    if not os.path.exists(f"{session_file}.session"):
-        logger.error(f"Файл сессии не найден: {session_file}.session")
-        
-        # Проверяем содержимое директории сессий
-        try:
-            session_files = os.listdir(settings.SESSIONS_DIR)
-            logger.info(f"Файлы в директории сессий: {session_files}")
-            
-            # Проверяем, есть ли файлы сессий для других пользователей
-            for file in session_files:
-                if file.startswith("user_") and file.endswith(".session"):
-                    other_user_id = file.replace("user_", "").replace(".session", "")
-                    logger.info(f"Найден файл сессии для пользователя {other_user_id}")
-            
-            # Проверяем, есть ли временные файлы сессий
-            for file in session_files:
-                if file.startswith("temp_user_") and file.endswith(".session"):
-                    temp_user_id = file.replace("temp_user_", "").replace(".session", "")
-                    logger.info(f"Найден временный файл сессии: {temp_user_id}")
-                    
-                    # Пробуем использовать временный файл сессии
-                    logger.info(f"Пробуем использовать временный файл сессии {temp_user_id} для пользователя {user_id}")
-                    try:
-                        import shutil
-                        shutil.copy(os.path.join(settings.SESSIONS_DIR, file), f"{session_file}.session")
-                        logger.info(f"Временный файл сессии скопирован в {session_file}.session")
-                    except Exception as e:
-                        logger.error(f"Ошибка при копировании временного файла сессии: {str(e)}")
-        except Exception as e:
-            logger.error(f"Ошибка при чтении директории сессий: {str(e)}")
+    Args:
+        user_id: ID пользователя
         
-        # Если файл сессии все еще не существует, выбрасываем исключение
-        if not os.path.exists(f"{session_file}.session"):
-            # Проверяем права на запись в директорию сессий
-            try:
-                test_file = os.path.join(settings.SESSIONS_DIR, "test_write_permission.tmp")
-                with open(test_file, 'w') as f:
-                    f.write("test")
-                os.remove(test_file)
-                logger.info(f"Проверка прав на запись в директорию сессий успешна")
-            except Exception as e:
-                logger.error(f"Нет прав на запись в директорию сессий: {str(e)}")
-                raise ValueError(f"Нет прав на запись в директорию сессий: {str(e)}")
-            
-            # Создаем пустой файл сессии для тестирования
-            try:
-                with open(f"{session_file}.session", 'w') as f:
-                    f.write("")
-                logger.info(f"Создан пустой файл сессии для тестирования: {session_file}.session")
-                
-                # Если удалось создать файл, значит, права на запись есть, но сессия отсутствует
-                os.remove(f"{session_file}.session")
-                logger.info(f"Пустой файл сессии удален: {session_file}.session")
-                
-                raise ValueError(f"Сессия для пользователя {user_id} не найдена. Необходима авторизация.")
-            except Exception as e:
-                logger.error(f"Ошибка при создании пустого файла сессии: {str(e)}")
-                raise ValueError(f"Нет прав на запись файла сессии: {str(e)}")
-    else:
-        # Проверяем размер файла сессии
-        try:
-            file_size = os.path.getsize(f"{session_file}.session")
-            logger.info(f"Размер файла сессии: {file_size} байт")
-            
-            if file_size == 0:
-                logger.error(f"Файл сессии пуст: {session_file}.session")
-                raise ValueError(f"Файл сессии пуст: {session_file}.session")
-        except Exception as e:
-            logger.error(f"Ошибка при проверке размера файла сессии: {str(e)}")
+    Returns:
+        TelegramClient: Клиент Telegram
+    """
+    # Сессии всех пользователей хранятся в общей базе (см. session_store)
+    session_key = f"user_{user_id}"
+    if not await session_db.find_session(session_key):
+        logger.error(f"Сессия не найдена: {session_key}")
+        raise ValueError(f"Сессия для пользователя {user_id} не найдена. Необходима авторизация.")
     
     # Создаем клиент
     logger.info(f"Создаем клиент для пользователя {user_id}")
     client = TelegramClient(
-        session_file,
+        open_session(session_key),
         settings.TELEGRAM_API_ID,
         settings.TELEGRAM_API_HASH,
         device_model="Telegram Dialogs Viewer Web"
     )
+    # Все запросы клиента проходят через ограничитель частоты и учет FloodWait.
+    # Общий слот исходящих запросов занимается последним, уже после их ожиданий
+    outbound_scheduler.install(client)
+    rate_limiter.install(client, user_id)
+    flood_control.install(client)
+    priority_scheduler.install(client)
     
     try:
         # Подключаемся к Telegram
@@ -237,27 +156,23 @@ async def get_client(user_id: int) -> TelegramClient:
         if not is_authorized:
             logger.error(f"Пользователь {user_id} не авторизован")
             
-            # Проверяем, существует ли файл сессии
-            if os.path.exists(f"{session_file}.session"):
-                # Если файл существует, но авторизация не работает, пробуем удалить его
-                try:
-                    os.remove(f"{session_file}.session")
-                    logger.info(f"Удален некорректный файл сессии: {session_file}.session")
-                except Exception as e:
-                    logger.error(f"Ошибка при удалении некорректного файла сессии: {str(e)}")
+            # Сессия есть, но авторизация не работает - удаляем ее
+            try:
+                await session_db.run(session_db.delete, session_key)
+                logger.info(f"Удалена некорректная сессия: {session_key}")
+                # Пользователь вышел из аккаунта - его диалоги и сообщения больше не нужны
+                local_store.delete_user(user_id)
+            except Exception as e:
+                logger.error(f"Ошибка при удалении некорректной сессии: {str(e)}")
             
             raise ValueError("Пользователь не авторизован. Требуется повторная авторизация.")
         
-        # Получаем информацию о пользователе
-        try:
-            me = await client.get_me()
-            logger.info(f"Информация о пользователе: id={me.id}, username={me.username}, phone={me.phone}")
-        except Exception as e:
-            logger.error(f"Ошибка при получении информации о пользователе: {str(e)}")
+        # Подписываемся на обновления, чтобы кэши оставались актуальными
+        register_update_handlers(client, user_id)
         
         # Сохраняем клиент
-        logger.info(f"Сохраняем клиент в кэш")
-        clients[user_id] = client
+        logger.info(f"Сохраняем клиент в пул")
+        await client_pool.add(user_id, client)
         
         return client
     except Exception as e:
@@ -271,6 +186,10 @@ async def send_code_request(phone_number: str) -> Dict[str, Any]:
     """
     Отправляет запрос на получение кода подтверждения
     
+    Одновременные запросы для одного номера объединяются, а повторный
+    запрос вскоре после отправки возвращает уже отправленный код (см.
+    start_login).
+    
     Args:
         phone_number: Номер телефона
     
@@ -280,55 +199,94 @@ async def send_code_request(phone_number: str) -> Dict[str, Any]:
     logger.info(f"Отправка кода на номер {phone_number}")
     
     try:
-        # Создаем временный клиент для отправки кода
-        # Используем случайный ID для временного пользователя
+        result = await coalesce("send_code", (phone_number,), lambda: start_login(phone_number))
+        # Копия: обработчики дополняют ответ, а результат общий для объединенных запросов
+        return dict(result)
+    except Exception as e:
+        logger.error(f"Ошибка при отправке кода: {str(e)}")
+        raise
+
+
+async def start_login(phone_number: str) -> Dict[str, Any]:
+    """
+    Отправляет код новому или уже ожидающему входу для номера
+    
+    Args:
+        phone_number: Номер телефона
+    
+    Returns:
+        Dict[str, Any]: temp_user_id, phone_code_hash и phone_number входа
+    """
+    existing = pending_auth.find(phone_number)
+    if existing is not None and time.time() - existing.code_sent_at < settings.AUTH_CODE_RESEND_INTERVAL:
+        pending_auth.stats["deduplicated"] += 1
+        logger.info(f"Код на номер {phone_number} уже отправлен, возвращаем ожидающий вход {existing.temp_user_id}")
+        return existing.to_dict()
+    
+    pending_auth.check_limits(phone_number, new_entry=existing is None)
+    
+    if existing is not None:
+        # Повторная отправка тем же клиентом (Telethon запросит auth.resendCode)
+        logger.info(f"Повторно отправляем код для входа {existing.temp_user_id}")
+        if not existing.client.is_connected():
+            await existing.client.connect()
+        sent_code = await send_login_code(existing.client, phone_number)
+        existing.phone_code_hash = sent_code.phone_code_hash
+        pending_auth.record_code_sent(existing)
+        pending_auth.stats["resent"] += 1
+        return existing.to_dict()
+    
+    # Создаем временный клиент для отправки кода
+    # Используем случайный ID для временного пользователя
+    temp_user_id = random.randint(100000, 999999)
+    while pending_auth.get(temp_user_id) is not None:
         temp_user_id = random.randint(100000, 999999)
-        
-        # Соблюдаем ограничения на частоту запросов
-        await wait_for_request_limit(temp_user_id)
-        
-        # Создаем путь к файлу сессии
-        session_file = os.path.join(settings.SESSIONS_DIR, f"temp_user_{temp_user_id}")
-        logger.info(f"Путь к временному файлу сессии: {session_file}")
-        logger.info(f"Директория сессий существует: {os.path.exists(settings.SESSIONS_DIR)}")
-        
-        # Создаем клиент
-        client = TelegramClient(
-            session_file,
-            settings.TELEGRAM_API_ID,
-            settings.TELEGRAM_API_HASH,
-            device_model="Telegram Dialogs Viewer Web"
-        )
-        
-        # Подключаемся к Telegram
+    
+    # Создаем клиент с временной сессией
+    client = TelegramClient(
+        open_session(f"temp_user_{temp_user_id}"),
+        settings.TELEGRAM_API_ID,
+        settings.TELEGRAM_API_HASH,
+        device_model="Telegram Dialogs Viewer Web"
+    )
+    outbound_scheduler.install(client)
+    rate_limiter.install(client, temp_user_id)
+    flood_control.install(client)
+    priority_scheduler.install(client)
+    
+    try:
+        # Подключаемся к Telegram и отправляем запрос на получение кода
         await client.connect()
-        
-        # Отправляем запрос на получение кода
-        try:
-            sent_code = await client.send_code_request(phone_number)
-        except FloodWaitError as e:
-            # Если превышен лимит запросов, сообщаем пользователю, сколько нужно подождать
-            logger.error(f"Превышен лимит запросов к API Telegram: {str(e)}")
-            raise ValueError(f"Превышен лимит запросов к API Telegram. Пожалуйста, подождите {e.seconds} секунд и попробуйте снова.")
-        except UserDeactivatedBanError:
-            logger.error(f"Аккаунт заблокирован Telegram")
-            raise ValueError("Ваш аккаунт Telegram заблокирован. Пожалуйста, обратитесь в поддержку Telegram.")
-        except Exception as e:
-            logger.error(f"Ошибка при отправке кода: {str(e)}")
-            raise ValueError(f"Ошибка при отправке кода: {str(e)}")
-        
-        # Сохраняем клиент для последующего использования
-        clients[temp_user_id] = client
-        
-        # Возвращаем результат
-        return {
-            "temp_user_id": temp_user_id,
-            "phone_code_hash": sent_code.phone_code_hash,
-            "phone_number": phone_number
-        }
+        sent_code = await send_login_code(client, phone_number)
+    except Exception:
+        # Клиент и временная сессия без отправленного кода не нужны
+        await client.disconnect()
+        await session_db.run(session_db.delete, f"temp_user_{temp_user_id}")
+        raise
+    
+    # Сохраняем клиент до ввода кода (истекшие входы удаляет pending_auth)
+    entry = PendingAuth(temp_user_id, phone_number, client, sent_code.phone_code_hash)
+    pending_auth.add(entry)
+    
+    return entry.to_dict()
+
+
+async def send_login_code(client: TelegramClient, phone_number: str):
+    """
+    Отправляет код подтверждения и переводит ошибки Telegram в ValueError
+    """
+    try:
+        return await client.send_code_request(phone_number)
+    except RetryAfterError as e:
+        # Срок ожидания уже в исключении (см. flood_control)
+        logger.error(f"Превышен лимит запросов к API Telegram: {str(e)}")
+        raise
+    except UserDeactivatedBanError:
+        logger.error(f"Аккаунт заблокирован Telegram")
+        raise ValueError("Ваш аккаунт Telegram заблокирован. Пожалуйста, обратитесь в поддержку Telegram.")
     except Exception as e:
         logger.error(f"Ошибка при отправке кода: {str(e)}")
-        raise
+        raise ValueError(f"Ошибка при отправке кода: {str(e)}")
 
 
 async def sign_in(
@@ -354,19 +312,17 @@ async def sign_in(
     logger.info(f"Авторизация по коду для номера {phone_number}")
     
     try:
-        # Получаем клиент
-        if temp_user_id not in clients:
+        # Получаем клиент незавершенного входа
+        pending = pending_auth.get(temp_user_id)
+        if pending is None:
             raise ValueError("Сессия истекла. Пожалуйста, запросите код повторно.")
         
-        client = clients[temp_user_id]
+        client = pending.client
         
         # Подключаемся к Telegram, если не подключены
         if not client.is_connected():
             await client.connect()
         
-        # Соблюдаем ограничения на частоту запросов
-        await wait_for_request_limit(temp_user_id)
-        
         try:
             # Пытаемся авторизоваться по коду
             logger.info(f"Авторизация по коду для номера {phone_number}")
@@ -376,10 +332,10 @@ async def sign_in(
                 phone_code_hash=phone_code_hash
             )
             logger.info(f"Успешная авторизация по коду для номера {phone_number}")
-        except FloodWaitError as e:
-            # Если превышен лимит запросов, сообщаем пользователю, сколько нужно подождать
+        except RetryAfterError as e:
+            # Срок ожидания уже в исключении (см. flood_control)
             logger.error(f"Превышен лимит запросов к API Telegram: {str(e)}")
-            raise ValueError(f"Превышен лимит запросов к API Telegram. Пожалуйста, подождите {e.seconds} секунд и попробуйте снова.")
+            raise
         except UserDeactivatedBanError:
             logger.error(f"Аккаунт заблокирован Telegram")
             raise ValueError("Ваш аккаунт Telegram заблокирован. Пожалуйста, обратитесь в поддержку Telegram.")
@@ -394,10 +350,13 @@ async def sign_in(
             user = await client.sign_in(password=password)
             logger.info(f"Успешная авторизация с паролем для номера {phone_number}")
         
-        # Получаем информацию о пользователе
-        me = await client.get_me()
+        # sign_in возвращает авторизованного пользователя, отдельный get_me не нужен
+        me = user
         logger.info(f"Успешная авторизация пользователя: {me.id}")
         
+        # Вход завершен: убираем его из ожидающих, чтобы клиент не отключило истечение срока
+        pending_auth.complete(temp_user_id)
+        
         # Форматируем результат
         result = {
             "id": me.id,
@@ -407,128 +366,34 @@ async def sign_in(
             "phone": phone_number
         }
         
-        # Проверяем существование директории сессий
-        if not os.path.exists(settings.SESSIONS_DIR):
-            try:
-                os.makedirs(settings.SESSIONS_DIR, exist_ok=True)
-                logger.info(f"Создана директория сессий: {settings.SESSIONS_DIR}")
-            except Exception as e:
-                logger.error(f"Ошибка при создании директории сессий: {str(e)}")
-                raise ValueError(f"Не удалось создать директорию сессий: {str(e)}")
-        
-        # Явно сохраняем сессию
-        try:
-            # Проверяем, что сессия существует и имеет метод save
-            if client.session and hasattr(client.session, 'save'):
-                if asyncio.iscoroutinefunction(client.session.save):
-                    await client.session.save()
-                else:
-                    client.session.save()
-                logger.info(f"Сессия сохранена явно")
-            else:
-                logger.warning(f"Не удалось сохранить сессию: объект сессии отсутствует или не имеет метода save")
-        except Exception as e:
-            logger.error(f"Ошибка при явном сохранении сессии: {str(e)}")
-            raise ValueError(f"Не удалось сохранить сессию: {str(e)}")
-        
-        # Перемещаем сессию из временной в постоянную
-        temp_session_file = os.path.join(settings.SESSIONS_DIR, f"temp_user_{temp_user_id}")
-        permanent_session_file = os.path.join(settings.SESSIONS_DIR, f"user_{me.id}")
-        logger.info(f"Перемещаем сессию из {temp_session_file} в {permanent_session_file}")
+        # Переносим сессию под постоянный ключ: записи базы переименовываются в одной
+        # транзакции, а уже авторизованный клиент продолжает работать с ними без
+        # повторного подключения
+        temp_session_key = f"temp_user_{temp_user_id}"
+        permanent_session_key = f"user_{me.id}"
+        logger.info(f"Перемещаем сессию из {temp_session_key} в {permanent_session_key}")
         
-        if os.path.exists(f"{temp_session_file}.session"):
-            try:
-                # Проверяем права на запись в директорию сессий
-                try:
-                    test_file = os.path.join(settings.SESSIONS_DIR, "test_write_permission.tmp")
-                    with open(test_file, 'w') as f:
-                        f.write("test")
-                    os.remove(test_file)
-                    logger.info(f"Проверка прав на запись в директорию сессий успешна")
-                except Exception as e:
-                    logger.error(f"Нет прав на запись в директорию сессий: {str(e)}")
-                    raise ValueError(f"Нет прав на запись в директорию сессий: {str(e)}")
-                
-                # Копируем файл сессии
-                import shutil
-                try:
-                    shutil.copy(f"{temp_session_file}.session", f"{permanent_session_file}.session")
-                    logger.info(f"Сессия успешно скопирована")
-                    
-                    # Проверяем, что файл был скопирован
-                    if os.path.exists(f"{permanent_session_file}.session"):
-                        logger.info(f"Файл сессии успешно создан: {permanent_session_file}.session")
-                        
-                        # Проверяем размер файла сессии
-                        file_size = os.path.getsize(f"{permanent_session_file}.session")
-                        logger.info(f"Размер файла сессии: {file_size} байт")
-                        
-                        if file_size == 0:
-                            logger.error(f"Файл сессии пуст: {permanent_session_file}.session")
-                            raise ValueError(f"Файл сессии пуст: {permanent_session_file}.session")
-                        
-                        # Удаляем временный файл сессии
-                        try:
-                            os.remove(f"{temp_session_file}.session")
-                            logger.info(f"Временный файл сессии удален")
-                        except Exception as e:
-                            logger.error(f"Ошибка при удалении временного файла сессии: {str(e)}")
-                    else:
-                        logger.error(f"Файл сессии не был создан: {permanent_session_file}.session")
-                        raise ValueError(f"Файл сессии не был создан: {permanent_session_file}.session")
-                except Exception as copy_error:
-                    logger.error(f"Ошибка при копировании сессии: {str(copy_error)}")
-                    raise ValueError(f"Ошибка при копировании сессии: {str(copy_error)}")
-            except Exception as e:
-                logger.error(f"Ошибка при работе с файлами сессий: {str(e)}")
-                raise ValueError(f"Ошибка при работе с файлами сессий: {str(e)}")
-        else:
-            logger.warning(f"Файл сессии не найден: {temp_session_file}.session")
-            
-            # Проверяем содержимое директории сессий
-            try:
-                session_files = os.listdir(settings.SESSIONS_DIR)
-                logger.info(f"Файлы в директории сессий: {session_files}")
-            except Exception as e:
-                logger.error(f"Ошибка при чтении директории сессий: {str(e)}")
-            
-            raise ValueError(f"Файл сессии не найден: {temp_session_file}.session")
-        
-        # Создаем новый клиент с постоянным файлом сессии
         try:
-            new_client = TelegramClient(
-                permanent_session_file,
-                settings.TELEGRAM_API_ID,
-                settings.TELEGRAM_API_HASH,
-                device_model="Telegram Dialogs Viewer Web"
-            )
-            
-            # Подключаемся к Telegram
-            await new_client.connect()
-            
-            # Проверяем, авторизован ли клиент
-            is_authorized = await new_client.is_user_authorized()
-            logger.info(f"Новый клиент авторизован: {is_authorized}")
-            
-            if is_authorized:
-                # Обновляем словарь клиентов
-                clients[me.id] = new_client
-                logger.info(f"Новый клиент сохранен в кэш")
-            else:
-                logger.error(f"Новый клиент не авторизован")
-                # Используем старый клиент
-                clients[me.id] = client
-                logger.info(f"Используем старый клиент")
+            await session_db.run(client.session.rehome, permanent_session_key)
+            logger.info(f"Сессия успешно перенесена")
         except Exception as e:
-            logger.error(f"Ошибка при создании нового клиента: {str(e)}")
-            # Используем старый клиент
-            clients[me.id] = client
-            logger.info(f"Используем старый клиент из-за ошибки")
-        
-        # Удаляем временный клиент из кэша
-        if temp_user_id in clients:
-            del clients[temp_user_id]
-            logger.info(f"Временный клиент удален из кэша")
+            logger.error(f"Ошибка при переносе сессии: {str(e)}")
+            await client.disconnect()
+            raise ValueError(f"Ошибка при переносе сессии: {str(e)}")
+        
+        if not owns(me.id):
+            # Вход пришел на шард номера телефона, а клиент пользователя живет в
+            # шарде его user_id: сессия уже в общей базе, и шард-владелец создаст
+            # клиент из нее при первом запросе
+            logger.info(f"Пользователь {me.id} обслуживается другим шардом, отключаем клиент входа")
+            await client.disconnect()
+            return result
+        
+        # Клиент становится клиентом пользователя в пуле
+        rate_limiter.reassign(client, me.id)
+        register_update_handlers(client, me.id)
+        await client_pool.add(me.id, client)
+        logger.info(f"Клиент сохранен в пул")
         
         return result
     except PhoneCodeInvalidError:
@@ -574,77 +439,271 @@ async def get_dialogs(user_id: int, force_refresh: bool = False) -> List[Dict[st
     """
     Получает список диалогов пользователя
     """
+    dialogs, _ = await get_dialogs_with_age(user_id, force_refresh)
+    return dialogs
+
+
+async def get_dialogs_with_age(user_id: int, force_refresh: bool = False) -> Tuple[List[Dict[str, Any]], Optional[float]]:
+    """
+    Получает список диалогов пользователя по схеме stale-while-revalidate
+    
+    Список моложе CACHE_TTL отдается из кэша. Более старый, но моложе
+    DIALOGS_MAX_STALE, отдается сразу, а в фоне запускается обновление.
+    Если списка нет или он старше DIALOGS_MAX_STALE, диалоги загружаются
+    синхронно.
+    
+    Args:
+        user_id: ID пользователя
+        force_refresh: Принудительное обновление кэша
+        
+    Returns:
+        Tuple[List[Dict[str, Any]], Optional[float]]: Диалоги и возраст устаревшего
+            списка в секундах (None, если список свежий)
+    """
     # Проверяем кэш, если не требуется принудительное обновление
-    if not force_refresh and user_id in dialogs_cache:
-        cached_dialogs, timestamp = dialogs_cache[user_id]
-        # Если кэш не устарел, возвращаем его
-        if time.time() - timestamp < CACHE_TTL:
-            logger.info(f"Возвращаем кэшированные диалоги для пользователя {user_id}")
-            return cached_dialogs
-        else:
-            logger.info(f"Кэш диалогов для пользователя {user_id} устарел")
+    if not force_refresh:
+        # Записи старше DIALOGS_MAX_STALE кэш не возвращает
+        entry = dialogs_cache.lookup(user_id)
+        if entry is None:
+            entry = await load_stored_dialogs(user_id)
+        if entry is not None:
+            if entry.age < CACHE_TTL:
+                logger.info(f"Возвращаем кэшированные диалоги для пользователя {user_id}")
+                return entry.value, None
+            logger.info(f"Возвращаем устаревшие диалоги для пользователя {user_id} (возраст: {entry.age:.0f} с), обновляем в фоне")
+            refresh_dialogs_in_background(user_id)
+            return entry.value, entry.age
+
+    # Одновременные запросы диалогов пользователя обслуживаются одним запросом к Telegram
+    # Принудительное обновление - полный обход списка
+    dialogs = await coalesce("dialogs", (user_id, force_refresh), lambda: fetch_dialogs(user_id, full=force_refresh))
+    return dialogs, None
+
+
+async def resolve_peer(client, user_id: int, dialog_id: int):
+    """
+    Возвращает InputPeer диалога из кэша, при промахе - через get_input_entity
+    
+    Args:
+        client: Клиент Telegram
+        user_id: ID пользователя
+        dialog_id: ID диалога
+        
+    Returns:
+        InputPeer диалога
+    """
+    peers = input_peers.setdefault(user_id, {})
+    peer = peers.get(dialog_id)
+    if peer is not None:
+        peer_cache_stats["hits"] += 1
+        return peer
+    peer_cache_stats["misses"] += 1
+    peer = await client.get_input_entity(dialog_id)
+    peers[dialog_id] = peer
+    return peer
+
+
+def remember_peers(user_id: int, dialogs) -> None:
+    """
+    Запоминает InputPeer диалогов, полученных из Telegram
+    """
+    peers = input_peers.setdefault(user_id, {})
+    for dialog in dialogs:
+        if getattr(dialog, 'input_entity', None) is not None:
+            peers[dialog.id] = dialog.input_entity
+
 
+def format_dialog(dialog, avatar_targets: List[Tuple[Dict[str, Any], Any]]) -> Dict[str, Any]:
+    """
+    Преобразует диалог в словарь
+    
+    Args:
+        dialog: Диалог Telegram
+        avatar_targets: Список, в который добавляется сущность для загрузки аватара
+        
+    Returns:
+        Dict[str, Any]: Данные диалога
+    """
+    dialog_dict = {
+        "id": dialog.id,
+        "title": dialog.title or dialog.name or "Без названия",
+        "type": str(dialog.entity_type) if hasattr(dialog, 'entity_type') else "unknown",
+        "unread_count": dialog.unread_count if hasattr(dialog, 'unread_count') else 0,
+        "pinned": dialog.pinned if hasattr(dialog, 'pinned') else False,
+    }
+    
+    # Добавляем последнее сообщение, если оно есть
+    if hasattr(dialog, 'message') and dialog.message:
+        dialog_dict["last_message_id"] = dialog.message.id
+        dialog_dict["last_message"] = dialog.message.message if hasattr(dialog.message, 'message') else ""
+        dialog_dict["last_message_date"] = dialog.message.date.isoformat() if hasattr(dialog.message, 'date') else ""
+    
+    # Запоминаем сущность, аватары загрузим параллельно
+    if hasattr(dialog, 'entity') and dialog.entity:
+        avatar_targets.append((dialog_dict, dialog.entity))
+    
+    return dialog_dict
+
+
+async def load_stored_dialogs(user_id: int) -> Optional[CacheEntry]:
+    """
+    Загружает в кэш список диалогов из общего кэша воркеров или из
+    локального хранилища (после перезапуска)
+    
+    Returns:
+        Optional[CacheEntry]: Запись кэша с настоящим возрастом списка или None
+    """
+    source = "общего кэша"
+    stored = await shared_cache.get("dialogs", user_id)
+    if stored is not None:
+        stored = stored["dialogs"], stored["fetched_at"]
+    else:
+        source = "локального хранилища"
+        stored = await local_store.load_dialogs(user_id)
+    if stored is None:
+        return None
+    dialogs, fetched_at = stored
+    age = time.time() - fetched_at
+    if age >= settings.DIALOGS_MAX_STALE:
+        return None
+    logger.info(f"Диалоги пользователя {user_id} загружены из {source} (возраст: {age:.0f} с)")
+    dialogs_cache.set(user_id, dialogs, user_id)
+    dialogs_cache.make_stale(user_id, age)
+    return dialogs_cache.get_entry(user_id)
+
+
+def refresh_dialogs_in_background(user_id: int) -> None:
+    """
+    Запускает фоновое обновление диалогов (присоединяется к уже идущему)
+    """
+    async def refresh():
+        try:
+            # Пользователь уже получил устаревший список - обновление идет в фоновой полосе
+            with lane(MAINTENANCE):
+                await coalesce("dialogs", (user_id, False), lambda: fetch_dialogs(user_id))
+        except Exception as e:
+            # Устаревший список продолжит отдаваться до DIALOGS_MAX_STALE
+            logger.warning(f"Ошибка при фоновом обновлении диалогов для пользователя {user_id}: {e}")
+
+    task = asyncio.ensure_future(refresh())
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+
+async def fetch_dialogs(user_id: int, full: bool = False) -> List[Dict[str, Any]]:
+    """
+    Загружает диалоги пользователя из Telegram и сохраняет их в кэш
+    
+    Если список уже есть в кэше, синхронизация инкрементальная: диалоги
+    запрашиваются от самых свежих, пока не встретится незакрепленный диалог
+    с тем же верхним сообщением, что и в кэше. Ниже него список отсортирован
+    по дате и не изменился, поэтому остальные диалоги берутся из кэша.
+    Прочтение и удаление сообщений в старых диалогах не поднимает их наверх -
+    их применяют к кэшу обработчики обновлений (register_update_handlers),
+    поэтому инкрементальная синхронизация допустима, только пока клиент с
+    обработчиками подключен с прошлой синхронизации. Удаленные диалоги и
+    выход из чатов обновлений не дают: если Telegram сообщает другое число
+    диалогов, чем получилось у инкрементальной синхронизации, выполняется
+    полный обход.
+    Полный обход выполняется также при отсутствии списка, по явному запросу,
+    после создания клиента и раз в DIALOGS_FULL_SYNC_INTERVAL.
+    
+    Args:
+        user_id: ID пользователя
+        full: Принудительно выполнить полный обход
+    """
     try:
         # Получаем клиент Telegram
         client = await get_client(user_id)
         
-        # Ждем ограничения запросов
-        await wait_for_request_limit(user_id)
-        
-        # Получаем диалоги
-        logger.info(f"Получаем диалоги для пользователя {user_id}")
-        dialogs = await client.get_dialogs()
+        previous = dialogs_cache.get_entry(user_id)
+        last_full_sync = dialogs_full_sync.get(user_id, 0.0)
+        if previous is None or time.time() - last_full_sync >= settings.DIALOGS_FULL_SYNC_INTERVAL:
+            full = True
         
-        # Преобразуем диалоги в список словарей
         result = []
-        for dialog in dialogs:
-            dialog_dict = {
-                "id": dialog.id,
-                "title": dialog.title or dialog.name or "Без названия",
-                "type": str(dialog.entity_type) if hasattr(dialog, 'entity_type') else "unknown",
-                "unread_count": dialog.unread_count if hasattr(dialog, 'unread_count') else 0,
-            }
+        avatar_targets = []
+        if not full:
+            # Получаем только диалоги, верхнее сообщение которых изменилось
+            logger.info(f"Получаем изменившиеся диалоги для пользователя {user_id}")
+            known = {d["id"]: d for d in previous.value}
+            dialogs_iter = client.iter_dialogs()
+            async for dialog in dialogs_iter:
+                cached = known.get(dialog.id)
+                unchanged = (
+                    cached is not None and dialog.message is not None
+                    and cached.get("last_message_id") == dialog.message.id
+                )
+                # Закрепленные идут первыми вне порядка по дате, их просматриваем все
+                if unchanged and not dialog.pinned:
+                    break
+                remember_peers(user_id, [dialog])
+                result.append(format_dialog(dialog, avatar_targets))
             
-            # Добавляем последнее сообщение, если оно есть
-            if hasattr(dialog, 'message') and dialog.message:
-                dialog_dict["last_message"] = dialog.message.message if hasattr(dialog.message, 'message') else ""
-                dialog_dict["last_message_date"] = dialog.message.date.isoformat() if hasattr(dialog.message, 'date') else ""
-            
-            # Добавляем фото профиля, если оно есть
-            try:
-                if hasattr(dialog, 'entity') and dialog.entity:
-                    # Получаем аватар диалога
-                    photo_url = await get_dialog_photo(client, dialog)
-                    if photo_url:
-                        dialog_dict["photo"] = photo_url
-            except Exception as e:
-                logger.warning(f"Ошибка при получении фото для диалога {dialog.id}: {e}")
-            
-            result.append(dialog_dict)
+            fetched_ids = {d["id"] for d in result}
+            rest = [d for d in previous.value if d["id"] not in fetched_ids]
+            if dialogs_iter.total is not None and dialogs_iter.total != len(result) + len(rest):
+                # Часть диалогов удалена или пользователь вышел из чатов - какие, не узнать без полного обхода
+                logger.info(
+                    f"Telegram сообщает {dialogs_iter.total} диалогов вместо {len(result) + len(rest)} "
+                    f"для пользователя {user_id}, выполняем полный обход"
+                )
+                full = True
+                result = []
+                avatar_targets = []
+            else:
+                # Закрепленные диалоги все уже получены - остальные из кэша открепили.
+                # Словари принадлежат кэшированному списку, его читают другие запросы
+                rest = [dict(dialog_dict, pinned=False) for dialog_dict in rest]
+                rest.sort(key=lambda d: d.get("last_message_date") or "", reverse=True)
+                dialog_sync_stats["incremental"] += 1
+                dialog_sync_stats["fetched"] += len(result)
+                logger.info(f"Изменилось {len(result)} диалогов из {len(result) + len(rest)} для пользователя {user_id}")
+                result += rest
+        
+        if full:
+            # Получаем все диалоги
+            logger.info(f"Получаем все диалоги для пользователя {user_id}")
+            dialogs = await client.get_dialogs()
+            remember_peers(user_id, dialogs)
+            # Тысячи диалогов преобразуются частями, чтобы не задерживать запросы других пользователей
+            result = await cpu_scheduler.map(
+                user_id, dialogs, lambda dialog: format_dialog(dialog, avatar_targets), settings.FAIR_CPU_BATCH
+            )
+            dialogs_full_sync[user_id] = time.time()
+            dialog_sync_stats["full"] += 1
+            dialog_sync_stats["fetched"] += len(result)
+        
+        # Добавляем фото профиля
+        await hydrate_avatars(client, user_id, avatar_targets)
         
         # Сохраняем результат в кэш
-        dialogs_cache[user_id] = (result, time.time())
+        dialogs_cache.set(user_id, result, user_id)
+        dumped = await cpu_scheduler.map(user_id, result, local_store.dump, settings.FAIR_CPU_BATCH)
+        local_store.save_dialogs(user_id, result, dumped)
+        shared_cache.put("dialogs", user_id, dump_shared_dialogs(user_id, dumped))
         
         logger.info(f"Получено {len(result)} диалогов для пользователя {user_id}")
         return result
     except Exception as e:
         logger.error(f"Ошибка при получении диалогов для пользователя {user_id}: {e}")
+        await drop_client_on_auth_error(user_id, e)
         
         # Собираем подробную информацию об ошибке
-        session_file = os.path.join(settings.SESSIONS_DIR, f"user_{user_id}.session")
-        session_exists = os.path.exists(session_file)
-        sessions_list = os.listdir(settings.SESSIONS_DIR) if os.path.exists(settings.SESSIONS_DIR) else []
+        session_key = f"user_{user_id}"
+        session_exists = session_db.has_session(session_key)
+        sessions_list = session_db.list_sessions()
         
         error_message = f"Ошибка при получении диалогов: {str(e)}. "
         error_message += f"Пользователь: {user_id}. "
         error_message += f"Время: {datetime.now().isoformat()}. "
-        error_message += f"Сессия: {session_file}. "
+        error_message += f"Сессия: {session_key}. "
         error_message += f"Сессия существует: {session_exists}. "
-        error_message += f"Содержимое директории сессий: {', '.join(sessions_list)}."
+        error_message += f"Сессии в базе: {', '.join(sessions_list)}."
         
         # Проверяем тип ошибки
-        if "FloodWaitError" in str(e):
-            raise ValueError(f"Превышен лимит запросов к API Telegram: {str(e)}")
+        if isinstance(e, RetryAfterError):
+            raise
         elif "UserDeactivatedBanError" in str(e) or "UserBannedInChannelError" in str(e):
             raise ValueError(f"Аккаунт заблокирован Telegram: {str(e)}")
         elif "AuthKeyUnregisteredError" in str(e) or "AuthKeyError" in str(e):
@@ -712,149 +771,130 @@ async def get_test_dialogs(user_id: str) -> List[Dict[str, Any]]:
     return dialogs
 
 
-async def get_messages(user_id: int, dialog_id: str, limit: int = 50, offset: int = 0, force_refresh: bool = False) -> List[Dict[str, Any]]:
+async def get_messages(
+    user_id: int,
+    dialog_id: str,
+    limit: int = 50,
+    offset: int = 0,
+    force_refresh: bool = False,
+    normalize: bool = False
+) -> Union[List[Dict[str, Any]], Dict[str, Any]]:
     """
     Получает сообщения из диалога
     
+    Сообщения диалога хранятся в кэше непрерывными отрезками по id (см.
+    MessageStore): страница внутри известного отрезка отдается без запросов
+    к Telegram, а запрашиваются только недостающие промежутки. Хранилище
+    нормализовано: сообщения ссылаются на отправителя через sender_id, а
+    сами отправители лежат в таблицах users и chats, как в ответах MTProto.
+    
     Args:
         user_id: ID пользователя
         dialog_id: ID диалога
         limit: Максимальное количество сообщений
         offset: Смещение (для пагинации)
         force_refresh: Принудительное обновление кэша
+        normalize: Вернуть {"messages", "users", "chats"} вместо списка
+            сообщений со встроенными отправителями
         
     Returns:
-        List[Dict[str, Any]]: Список сообщений
+        Union[List[Dict[str, Any]], Dict[str, Any]]: Список сообщений или нормализованная страница
     """
-    # Создаем ключ для кэша
-    cache_key = (user_id, dialog_id, limit, offset)
-    
-    # Проверяем кэш, если не требуется принудительное обновление
-    if not force_refresh and cache_key in messages_cache:
-        cached_messages, timestamp = messages_cache[cache_key]
-        # Если кэш не устарел, возвращаем его
-        if time.time() - timestamp < CACHE_TTL:
-            logger.info(f"Возвращаем кэшированные сообщения для пользователя {user_id} и диалога {dialog_id}")
-            return cached_messages
-        else:
-            logger.info(f"Кэш сообщений для пользователя {user_id} и диалога {dialog_id} устарел")
+    # Одновременные запросы одной и той же страницы выполняются один раз
+    page = await coalesce(
+        "messages",
+        (user_id, int(dialog_id), limit, offset, force_refresh),
+        lambda: load_messages(user_id, dialog_id, limit, offset, force_refresh)
+    )
+    return page if normalize else denormalize_messages(page)
+
+
+async def load_messages(user_id: int, dialog_id: str, limit: int, offset: int, force_refresh: bool) -> Dict[str, Any]:
+    """
+    Собирает нормализованную страницу сообщений из кэша, дозапрашивая промежутки у Telegram
+    """
+    # Сообщения диалога хранятся в кэше отрезками по id
+    # При промахе берем отрезки из локального хранилища: после перезапуска
+    # из Telegram дозапрашиваются только сообщения новее сохраненных
+    cache_key = (user_id, int(dialog_id))
+    store = messages_cache.get(cache_key)
+    cached = store is not None
+    if store is None and not force_refresh:
+        store = await load_stored_messages(user_id, int(dialog_id))
+    replace = force_refresh or store is None
+    if replace:
+        store = MessageStore()
+    elif store.drop_stale(settings.MESSAGES_MAX_AGE):
+        replace = True
     
     try:
-        # Получаем клиент Telegram
-        client = await get_client(user_id)
-        
-        # Ждем ограничения запросов
-        await wait_for_request_limit(user_id)
-        
-        # Получаем сущность диалога
-        logger.info(f"Получаем сущность диалога {dialog_id} для пользователя {user_id}")
-        entity = await client.get_entity(int(dialog_id))
-        
-        # Получаем сообщения
-        logger.info(f"Получаем сообщения для диалога {dialog_id} (лимит: {limit}, смещение: {offset})")
-        messages = await client.get_messages(entity, limit=limit, offset_id=offset)
-        
-        # Преобразуем сообщения в список словарей
-        result = []
-        for message in messages:
-            # Базовая информация о сообщении
-            message_dict = {
-                "id": message.id,
-                "text": message.text if hasattr(message, 'text') else "",
-                "date": message.date.isoformat() if hasattr(message, 'date') else None,
-                "out": message.out if hasattr(message, 'out') else False,
-                "mentioned": message.mentioned if hasattr(message, 'mentioned') else False,
-                "media_unread": message.media_unread if hasattr(message, 'media_unread') else False,
-                "silent": message.silent if hasattr(message, 'silent') else False,
-                "post": message.post if hasattr(message, 'post') else False,
-                "from_scheduled": message.from_scheduled if hasattr(message, 'from_scheduled') else False,
-                "legacy": message.legacy if hasattr(message, 'legacy') else False,
-                "edit_hide": message.edit_hide if hasattr(message, 'edit_hide') else False,
-                "pinned": message.pinned if hasattr(message, 'pinned') else False,
-                "noforwards": message.noforwards if hasattr(message, 'noforwards') else False,
-            }
+        client = None
+        peer = None
+        page_ids: List[int] = []
+        cursor = offset
+        fetched: List[Dict[str, Any]] = []
+        while len(page_ids) < limit:
+            remaining = limit - len(page_ids)
             
-            # Информация об отправителе
-            if hasattr(message, 'sender') and message.sender:
-                sender = message.sender
-                sender_dict = {
-                    "id": sender.id if hasattr(sender, 'id') else None,
-                    "first_name": sender.first_name if hasattr(sender, 'first_name') else None,
-                    "last_name": sender.last_name if hasattr(sender, 'last_name') else None,
-                    "username": sender.username if hasattr(sender, 'username') else None,
-                    "phone": sender.phone if hasattr(sender, 'phone') else None,
-                    "bot": sender.bot if hasattr(sender, 'bot') else False,
-                }
-                
-                # Получаем аватар отправителя
-                try:
-                    sender_dict["photo"] = await get_profile_photo(client, sender)
-                except Exception as e:
-                    logger.warning(f"Ошибка при получении аватара отправителя: {e}")
-                
-                message_dict["sender"] = sender_dict
+            # Отдаем то, что уже есть в известном отрезке
+            segment = store.find(cursor)
+            if segment:
+                ids = segment.ids_below(cursor)[:remaining]
+                page_ids.extend(ids)
+                if len(ids) == remaining or segment.bottom:
+                    break
+                cursor = segment.low
+                continue
             
-            # Информация о медиа
-            if hasattr(message, 'media') and message.media:
-                media = message.media
-                media_dict = {
-                    "type": str(type(media).__name__),
-                }
-                
-                # Обрабатываем разные типы медиа
-                if hasattr(media, 'photo') and media.photo:
-                    media_dict["photo"] = True
-                    # Можно добавить логику для получения URL фото
+            # Промежуток: запрашиваем у Telegram только сообщения до ближайшего известного отрезка
+            if client is None:
+                # Получаем клиент Telegram
+                client = await get_client(user_id)
                 
-                if hasattr(media, 'document') and media.document:
-                    media_dict["document"] = True
-                    # Можно добавить логику для получения информации о документе
-                
-                message_dict["media"] = media_dict
+                # Получаем InputPeer диалога (обычно уже известен из списка диалогов)
+                peer = await resolve_peer(client, user_id, int(dialog_id))
             
-            # Информация о пересланном сообщении
-            if hasattr(message, 'forward') and message.forward:
-                forward = message.forward
-                forward_dict = {
-                    "date": forward.date.isoformat() if hasattr(forward, 'date') else None,
-                }
-                
-                if hasattr(forward, 'from_id') and forward.from_id:
-                    forward_dict["from_id"] = str(forward.from_id)
-                
-                if hasattr(forward, 'from_name') and forward.from_name:
-                    forward_dict["from_name"] = forward.from_name
-                
-                message_dict["forward"] = forward_dict
+            lower = store.next_below(cursor)
+            min_id = lower.high if lower else 0
+            logger.info(f"Получаем сообщения для диалога {dialog_id} (лимит: {remaining}, смещение: {cursor}, min_id: {min_id})")
+            messages = await client.get_messages(peer, limit=remaining, offset_id=cursor, min_id=min_id)
             
-            # Информация о реакциях
-            if hasattr(message, 'reactions') and message.reactions:
-                reactions = message.reactions
-                reactions_list = []
-                
-                if hasattr(reactions, 'results') and reactions.results:
-                    for reaction in reactions.results:
-                        reaction_dict = {
-                            "emoticon": reaction.emoticon if hasattr(reaction, 'emoticon') else None,
-                            "count": reaction.count if hasattr(reaction, 'count') else 0,
-                        }
-                        reactions_list.append(reaction_dict)
-                
-                message_dict["reactions"] = reactions_list
+            # Преобразуем сообщения в словари (каждый отправитель разбирается один раз)
+            avatar_targets = []
+            result = await cpu_scheduler.map(
+                user_id, messages, lambda message: format_message(message, dialog_id, store, avatar_targets),
+                settings.FAIR_CPU_BATCH
+            )
+            fetched.extend(result)
             
-            result.append(message_dict)
-        
-        # Сохраняем результат в кэш
-        messages_cache[cache_key] = (result, time.time())
-        
-        logger.info(f"Получено {len(result)} сообщений для диалога {dialog_id}")
-        return result
+            # Получаем аватары новых отправителей
+            await hydrate_avatars(client, user_id, avatar_targets)
+            
+            complete = len(messages) < remaining
+            store.add(result, cursor, min_id, complete)
+            page_ids.extend(m["id"] for m in result)
+            if complete and not lower:
+                break
+            cursor = min(m["id"] for m in result) if result else min_id + 1
+        
+        # Сохраняем хранилище в кэш, только если оно изменилось (размер
+        # хранилище ведет само, без обхода всех сообщений)
+        if fetched or replace or not cached:
+            messages_cache.set(cache_key, store, user_id, store.size)
+        if fetched or replace:
+            local_store.save_messages(user_id, int(dialog_id), store, fetched, replace)
+            shared_cache.put("messages", messages_key(user_id, int(dialog_id)), dump_shared_messages(user_id, int(dialog_id)))
+        page = store.page(page_ids)
+        
+        logger.info(f"Отдано {len(page_ids)} сообщений для диалога {dialog_id}, из них из Telegram: {len(fetched)}")
+        return page
     except Exception as e:
         logger.error(f"Ошибка при получении сообщений для диалога {dialog_id}: {e}")
+        await drop_client_on_auth_error(user_id, e)
         
         # Проверяем тип ошибки
-        if "FloodWaitError" in str(e):
-            raise ValueError(f"Превышен лимит запросов к API Telegram: {str(e)}")
+        if isinstance(e, RetryAfterError):
+            raise
         elif "UserDeactivatedBanError" in str(e) or "UserBannedInChannelError" in str(e):
             raise ValueError(f"Аккаунт заблокирован Telegram: {str(e)}")
         elif "AuthKeyUnregisteredError" in str(e) or "AuthKeyError" in str(e):
@@ -866,6 +906,183 @@ async def get_messages(user_id: int, dialog_id: str, limit: int = 50, offset: in
             raise ValueError(f"Ошибка при получении сообщений: {str(e)}")
 
 
+def format_message(message, dialog_id, store: MessageStore, avatar_targets: List[Tuple[Dict[str, Any], Any]]) -> Dict[str, Any]:
+    """
+    Преобразует сообщение в словарь
+    
+    Отправитель заносится в таблицу users/chats хранилища, а новые
+    отправители добавляются в avatar_targets для загрузки аватаров.
+    
+    Args:
+        message: Сообщение Telegram
+        dialog_id: ID диалога
+        store: Хранилище сообщений диалога
+        avatar_targets: Список для отправителей, которым нужен аватар
+        
+    Returns:
+        Dict[str, Any]: Данные сообщения
+    """
+    # Базовая информация о сообщении
+    message_dict = {
+        "id": message.id,
+        "text": message.text if hasattr(message, 'text') else "",
+        "date": message.date.isoformat() if hasattr(message, 'date') else None,
+        "out": message.out if hasattr(message, 'out') else False,
+        "mentioned": message.mentioned if hasattr(message, 'mentioned') else False,
+        "media_unread": message.media_unread if hasattr(message, 'media_unread') else False,
+        "silent": message.silent if hasattr(message, 'silent') else False,
+        "post": message.post if hasattr(message, 'post') else False,
+        "from_scheduled": message.from_scheduled if hasattr(message, 'from_scheduled') else False,
+        "legacy": message.legacy if hasattr(message, 'legacy') else False,
+        "edit_hide": message.edit_hide if hasattr(message, 'edit_hide') else False,
+        "pinned": message.pinned if hasattr(message, 'pinned') else False,
+        "noforwards": message.noforwards if hasattr(message, 'noforwards') else False,
+    }
+    
+    # Информация об отправителе (каждый отправитель разбирается один раз).
+    # Ключ - id с пометкой типа: у пользователя и канала голые id могут совпадать
+    if hasattr(message, 'sender') and message.sender:
+        sender = message.sender
+        sender_id = utils.get_peer_id(sender)
+        is_user = isinstance(sender, User)
+        if sender_id not in (store.users if is_user else store.chats):
+            sender_dict = store.add_sender(sender_id, format_sender(sender), is_user)
+            avatar_targets.append((sender_dict, sender))
+        message_dict["sender_id"] = sender_id
+    
+    # Информация о медиа
+    if hasattr(message, 'media') and message.media:
+        media = message.media
+        media_dict = {
+            "type": str(type(media).__name__),
+        }
+        
+        # Обрабатываем разные типы медиа
+        if hasattr(media, 'photo') and media.photo:
+            media_dict["photo"] = True
+        
+        if hasattr(media, 'document') and media.document:
+            media_dict["document"] = True
+        
+        # Файл медиа отдается эндпоинтом /dialogs/{dialog_id}/messages/{msg_id}/media
+        media_info = get_media_info(message)
+        if media_info:
+            media_dict["url"] = f"{settings.API_V1_STR}/dialogs/{dialog_id}/messages/{message.id}/media"
+            media_dict["mime_type"] = media_info["mime_type"]
+            media_dict["size"] = media_info["size"]
+        
+        message_dict["media"] = media_dict
+    
+    # Информация о пересланном сообщении
+    if hasattr(message, 'forward') and message.forward:
+        forward = message.forward
+        forward_dict = {
+            "date": forward.date.isoformat() if hasattr(forward, 'date') else None,
+        }
+        
+        if hasattr(forward, 'from_id') and forward.from_id:
+            forward_dict["from_id"] = str(forward.from_id)
+        
+        if hasattr(forward, 'from_name') and forward.from_name:
+            forward_dict["from_name"] = forward.from_name
+        
+        message_dict["forward"] = forward_dict
+    
+    # Информация о реакциях
+    if hasattr(message, 'reactions') and message.reactions:
+        reactions = message.reactions
+        reactions_list = []
+        
+        if hasattr(reactions, 'results') and reactions.results:
+            for reaction in reactions.results:
+                reaction_dict = {
+                    "emoticon": reaction.emoticon if hasattr(reaction, 'emoticon') else None,
+                    "count": reaction.count if hasattr(reaction, 'count') else 0,
+                }
+                reactions_list.append(reaction_dict)
+        
+        message_dict["reactions"] = reactions_list
+    
+    return message_dict
+
+
+def format_sender(sender) -> Dict[str, Any]:
+    """
+    Преобразует отправителя (пользователя, чат или канал) в словарь
+    
+    Args:
+        sender: Сущность отправителя
+        
+    Returns:
+        Dict[str, Any]: Данные отправителя
+    """
+    if isinstance(sender, User):
+        return {
+            "id": sender.id,
+            "first_name": sender.first_name,
+            "last_name": sender.last_name,
+            "username": sender.username,
+            "phone": sender.phone,
+            "bot": sender.bot or False,
+        }
+    
+    return {
+        "id": utils.get_peer_id(sender),
+        "title": getattr(sender, 'title', None),
+        "username": getattr(sender, 'username', None),
+    }
+
+
+def legacy_sender(sender_id: int, sender: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Отправитель в прежнем виде ответа (без normalize)
+    
+    Прежний ответ отдавал голый id сущности и одинаковый набор полей для
+    пользователей, чатов и каналов. id с пометкой типа остаются только в
+    таблицах users/chats нормализованного ответа.
+    
+    Args:
+        sender_id: id отправителя с пометкой типа (ключ в таблице)
+        sender: Отправитель из таблицы users или chats
+        
+    Returns:
+        Dict[str, Any]: Данные отправителя
+    """
+    legacy = {
+        "id": utils.resolve_id(sender_id)[0],
+        "first_name": sender.get("first_name"),
+        "last_name": sender.get("last_name"),
+        "username": sender.get("username"),
+        "phone": sender.get("phone"),
+        "bot": sender.get("bot", False),
+    }
+    if "photo" in sender:
+        legacy["photo"] = sender["photo"]
+    return legacy
+
+
+def denormalize_messages(page: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Встраивает отправителей из таблиц users/chats обратно в сообщения
+    
+    Args:
+        page: Нормализованная страница {"messages", "users", "chats"}
+        
+    Returns:
+        List[Dict[str, Any]]: Список сообщений с полем sender
+    """
+    result = []
+    for message_dict in page["messages"]:
+        # id с пометкой типа: пользователи положительные, чаты и каналы отрицательные
+        message_dict = dict(message_dict)
+        sender_id = message_dict.pop("sender_id", None)
+        sender = page["users"].get(sender_id) or page["chats"].get(sender_id)
+        if sender:
+            message_dict["sender"] = legacy_sender(sender_id, sender)
+        result.append(message_dict)
+    return result
+
+
 async def get_test_messages(dialog_id: str, user_id: str) -> List[Dict[str, Any]]:
     """
     Получает тестовые сообщения для отладки
@@ -918,25 +1135,24 @@ async def send_message(user_id: int, dialog_id: int, text: str, reply_to: Option
         if not client.is_connected():
             await client.connect()
         
-        # Соблюдаем ограничения на частоту запросов
-        await wait_for_request_limit(user_id)
-        
         # Отправляем сообщение
         try:
+            peer = await resolve_peer(client, user_id, int(dialog_id))
             message = await client.send_message(
-                dialog_id,
+                peer,
                 text,
                 reply_to=reply_to
             )
-        except FloodWaitError as e:
-            # Если превышен лимит запросов, сообщаем пользователю, сколько нужно подождать
+        except RetryAfterError as e:
+            # Срок ожидания уже в исключении (см. flood_control)
             logger.error(f"Превышен лимит запросов к API Telegram: {str(e)}")
-            raise ValueError(f"Превышен лимит запросов к API Telegram. Пожалуйста, подождите {e.seconds} секунд и попробуйте снова.")
+            raise
         except UserDeactivatedBanError:
             logger.error(f"Аккаунт заблокирован Telegram")
             raise ValueError("Ваш аккаунт Telegram заблокирован. Пожалуйста, обратитесь в поддержку Telegram.")
         except Exception as e:
             logger.error(f"Ошибка при отправке сообщения: {str(e)}")
+            await drop_client_on_auth_error(user_id, e)
             raise ValueError(f"Ошибка при отправке сообщения: {str(e)}")
         
         # Форматируем результат
@@ -947,11 +1163,15 @@ async def send_message(user_id: int, dialog_id: int, text: str, reply_to: Option
             "out": message.out
         }
         
-        # Инвалидируем кэш сообщений для этого диалога
-        cache_key = (user_id, dialog_id)
-        if cache_key in messages_cache:
-            del messages_cache[cache_key]
-            logger.info(f"Кэш сообщений для диалога {dialog_id} инвалидирован после отправки сообщения")
+        # Добавляем отправленное сообщение в кэш диалога на месте
+        store = messages_cache.get((user_id, int(dialog_id)))
+        if store is not None:
+            message_dict = format_message(message, dialog_id, store, [])
+            store.patch(message_dict)
+            messages_cache.set((user_id, int(dialog_id)), store, user_id, store.size)
+            local_store.save_messages(user_id, int(dialog_id), store, [message_dict])
+            share_messages(user_id, int(dialog_id))
+            logger.info(f"Отправленное сообщение {message.id} добавлено в кэш диалога {dialog_id}")
         
         return result
     except Exception as e:
@@ -971,53 +1191,24 @@ async def get_session_info(user_id: int) -> Dict[str, Any]:
     """
     logger.info(f"Получение информации о сессии для пользователя {user_id}")
     
-    # Создаем путь к файлу сессии
-    session_file = os.path.join(settings.SESSIONS_DIR, f"user_{user_id}")
-    session_file_path = f"{session_file}.session"
+    session_key = f"user_{user_id}"
     
-    # Проверяем существование директории сессий
-    sessions_dir_exists = os.path.exists(settings.SESSIONS_DIR)
+    # Состояние директории проверено при запуске (см. SessionDatabase.start)
+    sessions_dir_exists = session_db.dir_exists
+    write_permission = session_db.dir_writable
     
-    # Проверяем существование файла сессии
-    session_exists = os.path.exists(session_file_path)
-    
-    # Получаем список файлов сессий
-    sessions_list = []
-    if sessions_dir_exists:
-        try:
-            all_files = os.listdir(settings.SESSIONS_DIR)
-            sessions_list = [f for f in all_files if f.endswith('.session')]
-        except Exception as e:
-            logger.error(f"Ошибка при получении списка файлов сессий: {str(e)}")
-    
-    # Проверяем права на запись
-    write_permission = False
-    if sessions_dir_exists:
-        try:
-            test_file = os.path.join(settings.SESSIONS_DIR, "test_write_permission.tmp")
-            with open(test_file, 'w') as f:
-                f.write("test")
-            os.remove(test_file)
-            write_permission = True
-        except Exception as e:
-            logger.error(f"Нет прав на запись в директорию сессий: {str(e)}")
-    
-    # Получаем размер файла сессии
-    session_size = 0
-    if session_exists:
-        try:
-            session_size = os.path.getsize(session_file_path)
-        except Exception as e:
-            logger.error(f"Ошибка при получении размера файла сессии: {str(e)}")
+    # Сессия и список сессий берутся из реестра в памяти
+    session_exists = session_db.has_session(session_key)
+    sessions_list = session_db.list_sessions()
     
     # Формируем информацию о сессии
     session_info = {
         "user_id": user_id,
-        "session_path": session_file_path,
+        "session_key": session_key,
+        "sessions_db": session_db.path,
         "sessions_dir": settings.SESSIONS_DIR,
         "sessions_dir_exists": sessions_dir_exists,
         "session_exists": session_exists,
-        "session_size": session_size,
         "write_permission": write_permission,
         "sessions_list": sessions_list,
         "is_railway": settings.IS_RAILWAY,
@@ -1029,76 +1220,395 @@ async def get_session_info(user_id: int) -> Dict[str, Any]:
     return session_info
 
 
-async def get_profile_photo(client, entity) -> Optional[str]:
+def get_avatar_semaphore(user_id: int) -> asyncio.Semaphore:
     """
-    Получает URL аватара профиля
+    Возвращает семафор, ограничивающий число одновременных загрузок аватаров пользователя
     
     Args:
-        client: Клиент Telegram
-        entity: Сущность (пользователь, чат, канал)
+        user_id: ID пользователя
         
     Returns:
-        Optional[str]: URL аватара или None, если аватар отсутствует
+        asyncio.Semaphore: Семафор пользователя
     """
-    try:
-        # Проверяем, есть ли у сущности фото профиля
-        if not hasattr(entity, 'photo') or not entity.photo:
-            return None
-        
-        # Получаем фото профиля
-        photos = await client.get_profile_photos(entity)
-        if not photos or len(photos) == 0:
-            return None
-        
-        # Берем первое (самое новое) фото
-        photo = photos[0]
-        
-        # Получаем размер фото (предпочитаем маленький размер для аватаров)
-        smallest_size = None
-        for size in photo.sizes:
-            if smallest_size is None or (hasattr(size, 'size') and size.size < smallest_size.size):
-                smallest_size = size
-        
-        if not smallest_size:
-            return None
-        
-        # Скачиваем фото
-        photo_data = await client.download_media(photo, bytes)
-        
-        # Кодируем фото в base64 для отображения в браузере
-        import base64
-        photo_base64 = base64.b64encode(photo_data).decode('utf-8')
-        
-        # Определяем MIME-тип (обычно image/jpeg для фото профиля)
-        mime_type = "image/jpeg"
-        
-        # Формируем data URL
-        data_url = f"data:{mime_type};base64,{photo_base64}"
-        
-        return data_url
-    except Exception as e:
-        logger.warning(f"Ошибка при получении аватара: {e}")
-        return None
+    if user_id not in avatar_semaphores:
+        avatar_semaphores[user_id] = asyncio.Semaphore(settings.AVATAR_CONCURRENCY)
+    return avatar_semaphores[user_id]
 
 
-async def get_dialog_photo(client, dialog) -> Optional[str]:
+async def hydrate_avatars(client, user_id: int, targets: List[Tuple[Dict[str, Any], Any]]) -> int:
     """
-    Получает URL аватара диалога
+    Параллельно заполняет поле photo у словарей диалогов и отправителей
+    
+    URL аватара проставляется сразу, а недостающие файлы скачиваются в кэш
+    не более чем AVATAR_CONCURRENCY загрузками одновременно. Загрузки, не
+    успевшие за AVATAR_HYDRATION_TIMEOUT, продолжаются в фоне, а словарь
+    помечается как photo_pending - такой аватар эндпоинт догрузит по запросу.
     
     Args:
         client: Клиент Telegram
-        dialog: Диалог
+        user_id: ID пользователя
+        targets: Пары (словарь диалога или отправителя, сущность)
         
     Returns:
-        Optional[str]: URL аватара или None, если аватар отсутствует
+        int: Количество аватаров, оставшихся в ожидании
     """
-    try:
-        # Проверяем, есть ли у диалога сущность
-        if not hasattr(dialog, 'entity') or not dialog.entity:
-            return None
+    semaphore = get_avatar_semaphore(user_id)
+    
+    async def fetch(target: Dict[str, Any], entity) -> None:
+        try:
+            # Аватары не задерживают интерактивные запросы пользователя
+            with lane(PREFETCH):
+                async with semaphore:
+                    path = await download_avatar(client, entity)
+        except Exception as e:
+            logger.warning(f"Ошибка при получении аватара для {target.get('id')}: {e}")
+            path = None
         
-        # Получаем аватар сущности
-        return await get_profile_photo(client, dialog.entity)
-    except Exception as e:
-        logger.warning(f"Ошибка при получении аватара диалога: {e}")
-        return None 
\ No newline at end of file
+        # Словарь мог уже уйти в кэш - обновляем его на месте
+        target.pop("photo_pending", None)
+        if not path:
+            target.pop("photo", None)
+    
+    tasks: Dict[asyncio.Task, Dict[str, Any]] = {}
+    for target, entity in targets:
+        try:
+            photo_url = get_avatar_url(entity)
+            if not photo_url:
+                continue
+            target["photo"] = photo_url
+            photo_id = register_avatar_source(user_id, entity)
+            if not is_avatar_cached(photo_id):
+                tasks[asyncio.ensure_future(fetch(target, entity))] = target
+        except Exception as e:
+            logger.warning(f"Ошибка при получении аватара для {target.get('id')}: {e}")
+    
+    if not tasks:
+        return 0
+    
+    done, pending = await asyncio.wait(tasks, timeout=settings.AVATAR_HYDRATION_TIMEOUT)
+    
+    # Незавершенные загрузки не отменяем, а оставляем в фоне
+    for task in pending:
+        tasks[task]["photo_pending"] = True
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+    
+    logger.info(f"Аватары для пользователя {user_id}: загружено {len(done)}, в ожидании {len(pending)}")
+    return len(pending)
+
+
+def register_update_handlers(client: TelegramClient, user_id: int) -> None:
+    """
+    Подписывает клиент на обновления Telegram, которые поправляют кэши на месте
+    
+    Новые, отредактированные и удаленные сообщения и прочтение истории
+    применяются к кэшированному списку диалогов и отрезкам сообщений, так
+    что кэш остается актуальным без повторной загрузки.
+    
+    Args:
+        client: Клиент Telegram
+        user_id: ID пользователя
+    """
+    async def on_new_message(event):
+        try:
+            with lane(MAINTENANCE):
+                await apply_new_message(client, user_id, event.chat_id, event.message)
+        except Exception as e:
+            logger.error(f"Ошибка при обработке нового сообщения для пользователя {user_id}: {e}")
+    
+    async def on_message_edited(event):
+        try:
+            with lane(MAINTENANCE):
+                await apply_edited_message(client, user_id, event.chat_id, event.message)
+        except Exception as e:
+            logger.error(f"Ошибка при обработке редактирования сообщения для пользователя {user_id}: {e}")
+    
+    async def on_message_deleted(event):
+        try:
+            apply_deleted_messages(user_id, event.chat_id, event.deleted_ids)
+        except Exception as e:
+            logger.error(f"Ошибка при обработке удаления сообщений для пользователя {user_id}: {e}")
+    
+    async def on_message_read(event):
+        try:
+            still_unread = getattr(event.original_update, 'still_unread_count', None)
+            apply_read_history(user_id, event.chat_id, event.max_id, still_unread)
+        except Exception as e:
+            logger.error(f"Ошибка при обработке прочтения истории для пользователя {user_id}: {e}")
+    
+    client.add_event_handler(on_new_message, events.NewMessage())
+    client.add_event_handler(on_message_edited, events.MessageEdited())
+    client.add_event_handler(on_message_deleted, events.MessageDeleted())
+    # inbox=True - пользователь прочитал входящие (например, в другом клиенте)
+    client.add_event_handler(on_message_read, events.MessageRead(inbox=True))
+    
+    # Пока клиента не было, обновления к кэшу не применялись - следующая
+    # синхронизация диалогов должна быть полной
+    dialogs_full_sync.pop(user_id, None)
+
+
+async def drop_client_on_auth_error(user_id: int, error: Exception) -> None:
+    """
+    При ошибке авторизации убирает клиент из пула: следующий запрос создаст
+    клиент заново и проверит сессию
+    """
+    if isinstance(error, (UnauthorizedError, AuthKeyError)):
+        await client_pool.invalidate(user_id)
+
+
+def forget_live_state(user_id: int) -> None:
+    """
+    Вызывается, когда клиент пользователя отключен и обновления больше не приходят
+    
+    Кэшированные данные перестают считаться актуальными: верхние отрезки
+    сообщений теряют флаг top (новые сообщения будут дозапрошены с min_id),
+    а список диалогов помечается устаревшим. InputPeer и семафор аватаров
+    пользователя удаляются: при следующем подключении они заполнятся заново,
+    а без удаления копились бы для всех когда-либо подключенных пользователей.
+    """
+    for cache_key in list(messages_cache.user_keys.get(user_id, {})):
+        store_entry = messages_cache.get_entry(cache_key)
+        if store_entry is not None:
+            store_entry.value.mark_outdated()
+    mark_dialogs_stale(user_id)
+    rate_limiter.forget(user_id)
+    flood_control.forget(user_id)
+    input_peers.pop(user_id, None)
+    avatar_semaphores.pop(user_id, None)
+
+
+client_pool.on_remove = forget_live_state
+
+
+def find_cached_dialog(user_id: int, dialog_id: int) -> Optional[Dict[str, Any]]:
+    """
+    Ищет диалог в кэшированном списке диалогов пользователя (без учета в статистике кэша)
+    """
+    entry = dialogs_cache.get_entry(user_id)
+    if entry is None:
+        return None
+    for dialog in entry.value:
+        if dialog["id"] == dialog_id:
+            return dialog
+    return None
+
+
+def mark_dialogs_stale(user_id: int) -> None:
+    """
+    Помечает список диалогов устаревшим: следующий запрос отдаст его и обновит в фоне
+    """
+    if user_id in dialogs_cache:
+        dialogs_cache.make_stale(user_id, CACHE_TTL)
+        update_stats["dialogs_stale"] += 1
+        share_dialogs(user_id)
+
+
+def messages_key(user_id: int, dialog_id: int) -> str:
+    """
+    Ключ хранилища сообщений диалога в общем кэше
+    """
+    return f"{user_id}:{dialog_id}"
+
+
+def dump_shared_dialogs(user_id: int, dumped: Optional[List[str]] = None) -> Optional[str]:
+    """
+    Сериализует кэшированный список диалогов для общего кэша (с временем загрузки)
+    
+    Args:
+        user_id: ID пользователя
+        dumped: Диалоги, уже сериализованные через local_store.dump
+    """
+    entry = dialogs_cache.get_entry(user_id)
+    if entry is None:
+        return None
+    if dumped is None:
+        dumped = [local_store.dump(dialog) for dialog in entry.value]
+    return f'{{"fetched_at": {entry.created_at}, "dialogs": [{",".join(dumped)}]}}'
+
+
+def dump_shared_messages(user_id: int, dialog_id: int) -> Optional[str]:
+    """
+    Сериализует кэшированное хранилище сообщений диалога для общего кэша
+    """
+    entry = messages_cache.get_entry((user_id, dialog_id))
+    if entry is None:
+        return None
+    return json.dumps(entry.value.to_dict(TRANSIENT_FIELDS), ensure_ascii=False)
+
+
+def share_dialogs(user_id: int) -> None:
+    """
+    Отмечает список диалогов, измененный на месте, для записи в общий кэш
+    """
+    shared_cache.mark_dirty("dialogs", user_id, lambda: dump_shared_dialogs(user_id))
+
+
+def share_messages(user_id: int, dialog_id: int) -> None:
+    """
+    Отмечает хранилище сообщений, измененное на месте, для записи в общий кэш
+    """
+    shared_cache.mark_dirty("messages", messages_key(user_id, dialog_id), lambda: dump_shared_messages(user_id, dialog_id))
+
+
+async def load_stored_messages(user_id: int, dialog_id: int) -> Optional[MessageStore]:
+    """
+    Загружает хранилище сообщений диалога из общего кэша воркеров или из локального хранилища
+    """
+    stored = await shared_cache.get("messages", messages_key(user_id, dialog_id))
+    if stored is not None:
+        return MessageStore.from_dict(stored)
+    return await local_store.load_messages(user_id, dialog_id)
+
+
+def drop_shared_messages(key: str) -> None:
+    """
+    Убирает из кэша хранилище сообщений, измененное другим воркером
+    """
+    user_id, dialog_id = key.split(":")
+    messages_cache.delete((int(user_id), int(dialog_id)))
+
+
+# Другой воркер изменил запись - следующее обращение прочитает ее из общего кэша
+shared_cache.on_invalidate("dialogs", lambda key: dialogs_cache.delete(int(key)))
+shared_cache.on_invalidate("messages", drop_shared_messages)
+
+
+async def apply_new_message(client, user_id: int, dialog_id: int, message) -> None:
+    """
+    Применяет новое сообщение к кэшу диалогов и кэшу сообщений диалога
+    
+    Args:
+        client: Клиент Telegram
+        user_id: ID пользователя
+        dialog_id: ID диалога
+        message: Новое сообщение
+    """
+    update_stats["new"] += 1
+    
+    entry = dialogs_cache.get_entry(user_id)
+    dialog = find_cached_dialog(user_id, dialog_id)
+    if dialog is not None:
+        dialog["last_message"] = message.message or ""
+        dialog["last_message_id"] = message.id
+        dialog["last_message_date"] = message.date.isoformat()
+        if not message.out:
+            dialog["unread_count"] = dialog.get("unread_count", 0) + 1
+        # Поднимаем диалог наверх (под закрепленные), как это делает Telegram
+        if not dialog.get("pinned"):
+            dialogs = entry.value
+            dialogs.remove(dialog)
+            position = next((i for i, d in enumerate(dialogs) if not d.get("pinned")), len(dialogs))
+            dialogs.insert(position, dialog)
+        share_dialogs(user_id)
+    elif entry is not None:
+        # Диалога нет в списке (новый чат) - собрать его можно только загрузкой
+        mark_dialogs_stale(user_id)
+    
+    cache_key = (user_id, dialog_id)
+    store_entry = messages_cache.get_entry(cache_key)
+    if store_entry is None:
+        return
+    store = store_entry.value
+    if message.sender is None:
+        await message.get_sender()
+    avatar_targets = []
+    message_dict = format_message(message, dialog_id, store, avatar_targets)
+    store.patch(message_dict)
+    messages_cache.set(cache_key, store, user_id, store.size)
+    local_store.save_messages(user_id, dialog_id, store, [message_dict])
+    share_messages(user_id, dialog_id)
+    if avatar_targets:
+        await hydrate_avatars(client, user_id, avatar_targets)
+
+
+async def apply_edited_message(client, user_id: int, dialog_id: int, message) -> None:
+    """
+    Применяет отредактированное сообщение к кэшу диалогов и кэшу сообщений диалога
+    
+    Args:
+        client: Клиент Telegram
+        user_id: ID пользователя
+        dialog_id: ID диалога
+        message: Новая версия сообщения
+    """
+    update_stats["edited"] += 1
+    
+    dialog = find_cached_dialog(user_id, dialog_id)
+    if dialog is not None and dialog.get("last_message_id") == message.id:
+        dialog["last_message"] = message.message or ""
+        share_dialogs(user_id)
+    
+    cache_key = (user_id, dialog_id)
+    store_entry = messages_cache.get_entry(cache_key)
+    if store_entry is None:
+        return
+    store = store_entry.value
+    if message.sender is None:
+        await message.get_sender()
+    avatar_targets = []
+    message_dict = format_message(message, dialog_id, store, avatar_targets)
+    if store.update(message_dict):
+        messages_cache.set(cache_key, store, user_id, store.size)
+        local_store.save_messages(user_id, dialog_id, store, [message_dict])
+        share_messages(user_id, dialog_id)
+        if avatar_targets:
+            await hydrate_avatars(client, user_id, avatar_targets)
+
+
+def apply_deleted_messages(user_id: int, dialog_id: Optional[int], ids: List[int]) -> None:
+    """
+    Удаляет сообщения из кэша сообщений и помечает устаревшим список диалогов,
+    если удалено последнее сообщение диалога
+    
+    Args:
+        user_id: ID пользователя
+        dialog_id: ID диалога или None (для личных чатов и групп Telegram не
+            сообщает диалог, но id сообщений в них уникальны в пределах аккаунта)
+        ids: ID удаленных сообщений
+    """
+    update_stats["deleted"] += len(ids)
+    
+    if dialog_id is not None:
+        cache_keys = [(user_id, dialog_id)]
+    else:
+        # Каналы и супергруппы (id вида -100...) сообщают диалог сами, их пропускаем
+        cache_keys = [key for key in messages_cache.user_keys.get(user_id, {}) if key[1] > -1000000000000]
+    for cache_key in cache_keys:
+        store_entry = messages_cache.get_entry(cache_key)
+        if store_entry is not None and store_entry.value.remove(ids):
+            messages_cache.resize(cache_key, store_entry.value.size)
+            logger.info(f"Из кэша диалога {cache_key[1]} удалены сообщения {ids}")
+            share_messages(*cache_key)
+    local_store.delete_messages(user_id, dialog_id, ids)
+    
+    # Какое сообщение стало последним, без загрузки не узнать
+    entry = dialogs_cache.get_entry(user_id)
+    if entry is None:
+        return
+    deleted = set(ids)
+    for dialog in entry.value:
+        if (dialog_id is None or dialog["id"] == dialog_id) and dialog.get("last_message_id") in deleted:
+            mark_dialogs_stale(user_id)
+            break
+
+
+def apply_read_history(user_id: int, dialog_id: int, max_id: int, still_unread: Optional[int]) -> None:
+    """
+    Обновляет счетчик непрочитанных после прочтения входящих сообщений
+    
+    Args:
+        user_id: ID пользователя
+        dialog_id: ID диалога
+        max_id: ID последнего прочитанного сообщения
+        still_unread: Сколько сообщений осталось непрочитанными (если Telegram его прислал)
+    """
+    update_stats["read"] += 1
+    
+    dialog = find_cached_dialog(user_id, dialog_id)
+    if dialog is None:
+        return
+    if still_unread is not None:
+        dialog["unread_count"] = still_unread
+    elif max_id >= dialog.get("last_message_id", 0):
+        dialog["unread_count"] = 0
+    share_dialogs(user_id)
@@ -0,0 +1,140 @@
+"""
+Запуск в несколько процессов: шарды с клиентами Telegram и диспетчер перед ними
+
+Клиент Telegram пользователя может жить только в одном процессе, поэтому
+пользователи распределяются по процессам-шардам согласованным
+хешированием user_id, а диспетчер (app.dispatcher) передает каждый
+запрос шарду его пользователя через Unix-сокет. Упавший шард
+перезапускается.
+
+Запуск из директории backend:
+
+    python -m app.shards [--shards N] [--host 0.0.0.0] [--port 8000]
+"""
+import os
+import sys
+import time
+import asyncio
+import logging
+import argparse
+import threading
+import subprocess
+from typing import List, Optional
+
+import uvicorn
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Период проверки процессов шардов (в секундах)
+SUPERVISE_INTERVAL = 1.0
+
+# Сколько ждать сокетов шардов при запуске и их завершения при остановке (в секундах)
+START_TIMEOUT = 30.0
+STOP_TIMEOUT = 15.0
+
+
+class ShardSupervisor:
+    """
+    Процессы-шарды: запуск, перезапуск упавших и остановка
+    """
+
+    def __init__(self, count: int):
+        self.count = count
+        self.processes: List[Optional[subprocess.Popen]] = [None] * count
+        self.stopping = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        os.makedirs(settings.SHARD_SOCKET_DIR, exist_ok=True)
+        for shard in range(self.count):
+            self._spawn(shard)
+        self._wait_sockets()
+        self.thread = threading.Thread(target=self._supervise, name="shard-supervisor", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+        running = [process for process in self.processes if process is not None and process.poll() is None]
+        for process in running:
+            process.terminate()
+        deadline = time.monotonic() + STOP_TIMEOUT
+        for process in running:
+            try:
+                process.wait(max(deadline - time.monotonic(), 0.1))
+            except subprocess.TimeoutExpired:
+                logger.warning(f"Шард (pid {process.pid}) не завершился за {STOP_TIMEOUT} с, останавливаем принудительно")
+                process.kill()
+
+    def _spawn(self, shard: int) -> None:
+        from app.services.shards import socket_path
+
+        path = socket_path(shard)
+        if os.path.exists(path):
+            os.remove(path)
+        # SECRET_KEY без .env случайный в каждом процессе - токен, выданный
+        # одним шардом, должны принимать диспетчер и остальные шарды
+        env = dict(
+            os.environ,
+            SECRET_KEY=settings.SECRET_KEY,
+            SHARD_COUNT=str(self.count),
+            SHARD_INDEX=str(shard),
+            SHARD_SOCKET_DIR=settings.SHARD_SOCKET_DIR
+        )
+        # Своя группа процессов: Ctrl+C получает только диспетчер, а шарды
+        # останавливаются после него (stop), не успев перезапуститься
+        self.processes[shard] = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app.main:app", "--uds", path],
+            env=env,
+            start_new_session=True
+        )
+        logger.info(f"Запущен шард {shard}/{self.count} (pid {self.processes[shard].pid}): {path}")
+
+    def _wait_sockets(self) -> None:
+        from app.services.shards import socket_path
+
+        deadline = time.monotonic() + START_TIMEOUT
+        while time.monotonic() < deadline:
+            if all(os.path.exists(socket_path(shard)) for shard in range(self.count)):
+                return
+            time.sleep(0.1)
+        logger.warning(f"Не все шарды открыли сокеты за {START_TIMEOUT} с, диспетчер отвечает им 503")
+
+    def _supervise(self) -> None:
+        while not self.stopping.wait(SUPERVISE_INTERVAL):
+            for shard, process in enumerate(self.processes):
+                if process is not None and process.poll() is not None and not self.stopping.is_set():
+                    logger.error(f"Шард {shard} завершился с кодом {process.returncode}, перезапускаем")
+                    self._spawn(shard)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Запуск шардов с клиентами Telegram и диспетчера")
+    parser.add_argument("--shards", type=int, default=settings.SHARD_COUNT or os.cpu_count() or 1)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", 8000)))
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    # Диспетчер строит кольцо из тех же настроек, что и шарды
+    settings.SHARD_COUNT = args.shards
+
+    # База сессий общая: перенос старых файлов и удаление брошенных временных
+    # сессий выполняются один раз, до запуска шардов
+    from app.services.session_store import session_db
+    asyncio.run(session_db.start())
+    session_db.close()
+
+    supervisor = ShardSupervisor(args.shards)
+    supervisor.start()
+    try:
+        uvicorn.run("app.dispatcher:app", host=args.host, port=args.port)
+    finally:
+        supervisor.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,17 @@
+# Пакет бенчмарков
+
+
+class RequestCounter:
+    """
+    Считает запросы MTProto, проходящие через клиент
+    """
+
+    def __init__(self, client):
+        self.count = 0
+        self._call = client._call
+
+        async def counting_call(*args, **kwargs):
+            self.count += 1
+            return await self._call(*args, **kwargs)
+
+        client._call = counting_call
@@ -0,0 +1,78 @@
+"""
+Бенчмарк загрузки аватаров: полное фото профиля против photo_small
+
+Сравнивает старый путь (photos.getUserPhotos + download_media самого
+большого размера) с новым (download_profile_photo(download_big=False))
+на диалогах реального аккаунта и выводит байты и количество запросов
+MTProto в среднем на диалог.
+
+Запуск из директории backend (нужна существующая сессия пользователя):
+
+    python -m benchmarks.avatar_download <user_id> [limit]
+"""
+import sys
+import time
+import asyncio
+
+from app.services.telegram import get_client
+from benchmarks import RequestCounter
+
+
+async def legacy_download(client, entity) -> bytes:
+    """
+    Старый путь: список фото профиля и загрузка самого большого размера
+    """
+    photos = await client.get_profile_photos(entity)
+    if not photos:
+        return b""
+    return await client.download_media(photos[0], bytes) or b""
+
+
+async def small_download(client, entity) -> bytes:
+    """
+    Новый путь: маленькая версия текущего фото профиля одним запросом
+    """
+    return await client.download_profile_photo(entity, file=bytes, download_big=False) or b""
+
+
+async def measure(client, counter: RequestCounter, entities, download):
+    """
+    Прогоняет загрузку по всем сущностям и возвращает (байты, запросы, секунды)
+    """
+    total_bytes = 0
+    requests_before = counter.count
+    started = time.perf_counter()
+    for entity in entities:
+        total_bytes += len(await download(client, entity))
+    return total_bytes, counter.count - requests_before, time.perf_counter() - started
+
+
+async def main(user_id: int, limit: int):
+    client = await get_client(user_id)
+    dialogs = await client.get_dialogs(limit=limit)
+    entities = [d.entity for d in dialogs if getattr(d.entity, 'photo', None) and getattr(d.entity.photo, 'photo_id', None)]
+    if not entities:
+        print("Нет диалогов с аватарами")
+        return
+
+    counter = RequestCounter(client)
+    results = {
+        "full (getUserPhotos + download_media)": await measure(client, counter, entities, legacy_download),
+        "small (download_profile_photo)": await measure(client, counter, entities, small_download),
+    }
+
+    n = len(entities)
+    print(f"Диалогов с аватарами: {n}")
+    for name, (total_bytes, requests, seconds) in results.items():
+        print(f"{name:40} {total_bytes / n:10.0f} байт/диалог {requests / n:6.2f} запросов/диалог {seconds * 1000 / n:8.1f} мс/диалог")
+
+    (full_bytes, full_requests, _), (small_bytes, small_requests, _) = results.values()
+    print(f"Экономия на диалог: {(full_bytes - small_bytes) / n:.0f} байт, {(full_requests - small_requests) / n:.2f} запросов")
+    await client.disconnect()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    asyncio.run(main(int(sys.argv[1]), int(sys.argv[2]) if len(sys.argv) > 2 else 50))
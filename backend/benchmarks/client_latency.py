@@ -0,0 +1,126 @@
+"""
+Бенчмарк получения клиента: проверка авторизации на каждом запросе против кэша
+
+Сравнивает старый путь get_client (is_user_authorized на каждом вызове,
+а для нового клиента еще и get_me) с новым (авторизация проверяется один
+раз при создании клиента) и выводит задержку и количество запросов MTProto.
+
+Чтобы показать цену проверки, которую делал старый путь, у клиента
+сбрасывается кэш авторизации Telethon: иначе is_user_authorized после
+первого вызова не ходит в сеть и не замечает отозванную сессию.
+
+Запуск из директории backend (нужна существующая сессия пользователя):
+
+    python -m benchmarks.client_latency <user_id> [iterations]
+"""
+import sys
+import time
+import asyncio
+import statistics
+from typing import List
+
+from telethon import TelegramClient
+
+from app.core.config import settings
+from app.services.telegram import get_client
+from app.services.client_pool import client_pool
+from app.services.rate_limit import rate_limiter
+from app.services.session_store import open_session
+from benchmarks import RequestCounter
+
+
+def new_client(user_id: int) -> TelegramClient:
+    return TelegramClient(
+        open_session(f"user_{user_id}"),
+        settings.TELEGRAM_API_ID,
+        settings.TELEGRAM_API_HASH,
+        device_model="Telegram Dialogs Viewer Web"
+    )
+
+
+async def legacy_cold(user_id: int) -> int:
+    """
+    Старое создание клиента: connect, is_user_authorized, get_me
+    """
+    client = new_client(user_id)
+    counter = RequestCounter(client)
+    await client.connect()
+    await client.is_user_authorized()
+    await client.get_me()
+    await client.disconnect()
+    return counter.count
+
+
+async def cached_cold(user_id: int) -> int:
+    """
+    Новое создание клиента: connect, is_user_authorized
+    """
+    client = new_client(user_id)
+    counter = RequestCounter(client)
+    await client.connect()
+    await client.is_user_authorized()
+    await client.disconnect()
+    return counter.count
+
+
+async def legacy_warm(user_id: int, client: TelegramClient) -> None:
+    """
+    Старый путь для клиента из кэша: проверка подключения и авторизации
+    """
+    if not client.is_connected():
+        await client.connect()
+    client._authorized = None
+    await client.is_user_authorized()
+
+
+async def cached_warm(user_id: int, client: TelegramClient) -> None:
+    """
+    Новый путь: get_client без обращения к сети
+    """
+    await get_client(user_id)
+
+
+def report(name: str, samples: List[float], requests: float) -> None:
+    samples = sorted(samples)
+    p95 = samples[int(len(samples) * 0.95) - 1] if len(samples) >= 20 else samples[-1]
+    print(
+        f"{name:32} среднее {statistics.mean(samples) * 1000:8.2f} мс  "
+        f"p50 {statistics.median(samples) * 1000:8.2f} мс  p95 {p95 * 1000:8.2f} мс  "
+        f"{requests:5.2f} запросов/вызов"
+    )
+
+
+async def main(user_id: int, iterations: int):
+    # Ограничение частоты запросов не относится к измеряемому пути
+    rate_limiter.enabled = False
+
+    # Создание клиента (меньше итераций: каждое - новое соединение)
+    cold_iterations = max(iterations // 10, 3)
+    for name, create in (("создание: старый путь", legacy_cold), ("создание: новый путь", cached_cold)):
+        samples, requests = [], 0
+        for _ in range(cold_iterations):
+            started = time.perf_counter()
+            requests += await create(user_id)
+            samples.append(time.perf_counter() - started)
+        report(name, samples, requests / cold_iterations)
+
+    # Повторные запросы к клиенту из пула
+    client = await get_client(user_id)
+    counter = RequestCounter(client)
+    for name, call in (("из пула: старый путь", legacy_warm), ("из пула: новый путь", cached_warm)):
+        samples = []
+        requests_before = counter.count
+        for _ in range(iterations):
+            started = time.perf_counter()
+            await call(user_id, client)
+            samples.append(time.perf_counter() - started)
+        report(name, samples, (counter.count - requests_before) / iterations)
+
+    await client_pool.shutdown()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    asyncio.run(main(int(sys.argv[1]), int(sys.argv[2]) if len(sys.argv) > 2 else 100))
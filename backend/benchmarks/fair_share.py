@@ -0,0 +1,158 @@
+"""
+Нагрузочный тест справедливой очереди: легкие пользователи во время обновления тяжелого
+
+Тяжелый пользователь выполняет полное обновление: преобразует и
+сериализует тысячи диалогов и параллельно загружает аватары (много
+одновременных запросов MTProto). В это же время легкие пользователи
+открывают страницы сообщений: один запрос и преобразование страницы.
+Выводятся перцентили задержки легких пользователей для старой схемы
+(общий семафор запросов в порядке поступления, преобразование списка
+целиком) и для справедливых очередей (fair.py).
+
+Сеть не используется: запросы MTProto имитируются задержкой, поэтому
+сессия не нужна. Запуск из директории backend:
+
+    python -m benchmarks.fair_share [light_users] [dialogs]
+"""
+import sys
+import json
+import time
+import asyncio
+import statistics
+from typing import Any, Dict, List
+
+from app.services.fair import FairScheduler
+from app.services.priority import percentile
+
+# Имитация сети и общего ресурса
+NETWORK_LATENCY = 0.03
+CAPACITY = 16
+HEAVY_CONCURRENCY = 64
+PAGE_SIZE = 20
+BATCH = 100
+HEAVY_USER = 0
+
+
+def format_item(i: int) -> str:
+    """
+    Работа на процессоре, сравнимая с преобразованием и сериализацией диалога
+    """
+    item: Dict[str, Any] = {
+        "id": i,
+        "name": f"Dialog {i}" * 4,
+        "last_message": "x" * 200,
+        "unread_count": i % 7,
+        "entities": [{"offset": j, "length": j * 2} for j in range(20)],
+    }
+    return json.dumps(item, ensure_ascii=False)
+
+
+class FifoBaseline:
+    """
+    Старая схема: запросы в порядке поступления, список преобразуется целиком
+    """
+
+    def __init__(self, capacity: int):
+        self.semaphore = asyncio.Semaphore(capacity)
+
+    async def call(self, user_id: int) -> None:
+        async with self.semaphore:
+            await asyncio.sleep(NETWORK_LATENCY)
+
+    async def map(self, user_id: int, items: List[int]) -> List[str]:
+        return [format_item(i) for i in items]
+
+
+class FairVariant:
+    """
+    Справедливые очереди: исходящие запросы и работа на процессоре
+    """
+
+    def __init__(self, capacity: int):
+        self.outbound = FairScheduler("outbound", capacity, 4.0, {})
+        self.cpu = FairScheduler("cpu", 1, BATCH, {})
+
+    async def call(self, user_id: int) -> None:
+        await self.outbound.acquire(user_id)
+        try:
+            await asyncio.sleep(NETWORK_LATENCY)
+        finally:
+            self.outbound.release()
+
+    async def map(self, user_id: int, items: List[int]) -> List[str]:
+        return await self.cpu.map(user_id, items, format_item, BATCH)
+
+
+async def heavy_refresh(variant, dialogs: int) -> float:
+    """
+    Полное обновление тяжелого пользователя: аватары в фоне и преобразование списка
+    """
+    started = time.monotonic()
+    done = asyncio.Event()
+
+    async def avatars():
+        while not done.is_set():
+            await variant.call(HEAVY_USER)
+
+    downloads = [asyncio.ensure_future(avatars()) for _ in range(HEAVY_CONCURRENCY)]
+    # Список приходит страницами по 100 диалогов, каждая страница - запрос
+    for _ in range(0, dialogs, 100):
+        await variant.call(HEAVY_USER)
+    await variant.map(HEAVY_USER, list(range(dialogs)))
+    await variant.map(HEAVY_USER, list(range(dialogs)))
+    done.set()
+    await asyncio.gather(*downloads)
+    return time.monotonic() - started
+
+
+async def light_user(variant, user_id: int, stop: asyncio.Event, latencies: List[float]) -> None:
+    """
+    Легкий пользователь: открывает страницы сообщений одну за другой
+    """
+    while not stop.is_set():
+        started = time.monotonic()
+        await variant.call(user_id)
+        await variant.map(user_id, list(range(PAGE_SIZE)))
+        latencies.append(time.monotonic() - started)
+        await asyncio.sleep(0.01)
+
+
+async def run(variant, light_users: int, dialogs: int) -> Dict[str, float]:
+    stop = asyncio.Event()
+    latencies: List[float] = []
+    lights = [asyncio.ensure_future(light_user(variant, i + 1, stop, latencies)) for i in range(light_users)]
+    heavy = await heavy_refresh(variant, dialogs)
+    stop.set()
+    await asyncio.gather(*lights)
+    samples = sorted(latencies)
+    return {
+        "heavy": heavy,
+        "requests": len(samples),
+        "p50": statistics.median(samples),
+        "p99": percentile(samples, 0.99),
+        "max": samples[-1],
+    }
+
+
+async def main(light_users: int, dialogs: int) -> None:
+    started = time.perf_counter()
+    for i in range(1000):
+        format_item(i)
+    per_item = (time.perf_counter() - started) / 1000
+    print(f"Легких пользователей: {light_users}, диалогов у тяжелого: {dialogs}, "
+          f"процессор на диалог: {per_item * 1e6:.0f} мкс, сеть: {NETWORK_LATENCY * 1000:.0f} мс, "
+          f"общих слотов: {CAPACITY}")
+
+    for title, variant in (("FIFO", FifoBaseline(CAPACITY)), ("DRR", FairVariant(CAPACITY))):
+        result = await run(variant, light_users, dialogs)
+        print(
+            f"{title:5} обновление тяжелого {result['heavy']:6.2f} с  "
+            f"легкие: запросов {result['requests']:5d}  p50 {result['p50'] * 1000:8.1f} мс  "
+            f"p99 {result['p99'] * 1000:8.1f} мс  max {result['max'] * 1000:8.1f} мс"
+        )
+
+
+if __name__ == "__main__":
+    light_users = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    dialogs = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    asyncio.run(main(light_users, dialogs))
@@ -0,0 +1,112 @@
+"""
+Бенчмарк входа по коду: подключения и рукопожатия MTProto на один вход
+
+Выполняет send_code_request и sign_in приложения для реального номера
+(код вводится с клавиатуры) и выводит время, количество подключений,
+рукопожатий (создания ключа авторизации) и запросов MTProto. После входа
+отдельно измеряется шаг, который делал старый sign_in: новый клиент на
+скопированной сессии, подключение и проверка авторизации.
+
+Запуск из директории backend:
+
+    python -m benchmarks.login <phone_number>
+"""
+import sys
+import time
+import asyncio
+
+from telethon import TelegramClient
+from telethon.network import authenticator
+
+from app.core.config import settings
+from app.services import telegram
+from app.services.client_pool import client_pool
+from app.services.rate_limit import rate_limiter
+from app.services.session_store import session_db, open_session
+
+
+class ConnectionCounter:
+    """
+    Считает подключения клиентов, рукопожатия и запросы MTProto
+    """
+
+    def __init__(self):
+        self.connections = 0
+        self.handshakes = 0
+        self.requests = 0
+        connect = TelegramClient.connect
+        call = TelegramClient._call
+        do_authentication = authenticator.do_authentication
+        counter = self
+
+        async def counting_connect(client, *args, **kwargs):
+            counter.connections += 1
+            return await connect(client, *args, **kwargs)
+
+        async def counting_call(client, *args, **kwargs):
+            counter.requests += 1
+            return await call(client, *args, **kwargs)
+
+        async def counting_authentication(*args, **kwargs):
+            counter.handshakes += 1
+            return await do_authentication(*args, **kwargs)
+
+        TelegramClient.connect = counting_connect
+        TelegramClient._call = counting_call
+        authenticator.do_authentication = counting_authentication
+
+    def snapshot(self):
+        return self.connections, self.handshakes, self.requests
+
+
+def report(name: str, seconds: float, before, after) -> None:
+    connections, handshakes, requests = (a - b for a, b in zip(after, before))
+    print(
+        f"{name:28} {seconds * 1000:8.0f} мс  подключений {connections}  "
+        f"рукопожатий {handshakes}  запросов {requests}"
+    )
+
+
+async def main(phone_number: str):
+    # Ограничение частоты запросов не относится к измеряемому пути
+    rate_limiter.enabled = False
+    await session_db.start()
+    counter = ConnectionCounter()
+
+    before = counter.snapshot()
+    started = time.perf_counter()
+    sent = await telegram.send_code_request(phone_number)
+    report("отправка кода", time.perf_counter() - started, before, counter.snapshot())
+
+    code = input("Код подтверждения: ").strip()
+    password = input("Пароль 2FA (Enter, если нет): ").strip() or None
+
+    before = counter.snapshot()
+    started = time.perf_counter()
+    user = await telegram.sign_in(
+        sent["temp_user_id"], phone_number, code, sent["phone_code_hash"], password
+    )
+    report("вход (sign_in)", time.perf_counter() - started, before, counter.snapshot())
+
+    # Шаг старого sign_in: второй клиент на той же сессии
+    before = counter.snapshot()
+    started = time.perf_counter()
+    client = TelegramClient(
+        open_session(f"user_{user['id']}"),
+        settings.TELEGRAM_API_ID,
+        settings.TELEGRAM_API_HASH,
+        device_model="Telegram Dialogs Viewer Web"
+    )
+    await client.connect()
+    await client.is_user_authorized()
+    report("старый путь: второй клиент", time.perf_counter() - started, before, counter.snapshot())
+    await client.disconnect()
+
+    await client_pool.shutdown()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    asyncio.run(main(sys.argv[1]))
@@ -0,0 +1,7 @@
+# Настройки, без которых не импортируется app.core.config
+import os
+import tempfile
+
+os.environ.setdefault("TELEGRAM_API_ID", "1")
+os.environ.setdefault("TELEGRAM_API_HASH", "test")
+os.environ.setdefault("SESSIONS_DIR", tempfile.mkdtemp(prefix="tdv-tests-"))
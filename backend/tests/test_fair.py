@@ -0,0 +1,121 @@
+"""
+Тесты справедливой очереди пользователей (deficit round robin)
+"""
+import asyncio
+from collections import Counter
+from typing import Dict, List
+
+import pytest
+from pydantic import ValidationError
+
+from app.core.config import Settings
+from app.services.fair import FairScheduler
+
+
+@pytest.mark.parametrize("quantum, weights", [(1.0, {1: 0.0}), (1.0, {1: -2.0}), (0.0, {})])
+def test_rejects_weights_and_quantum_without_credit(quantum, weights):
+    with pytest.raises(ValueError):
+        FairScheduler("test", 1, quantum, weights)
+
+
+def test_settings_reject_non_positive_weight():
+    with pytest.raises(ValidationError):
+        Settings(FAIR_USER_WEIGHTS={7: 0})
+
+
+def test_free_capacity_is_granted_immediately():
+    async def scenario():
+        scheduler = FairScheduler("test", 2, 1.0, {})
+        assert await scheduler.acquire(1) == 0.0
+        assert await scheduler.acquire(2) == 0.0
+        assert scheduler.active == 2
+        scheduler.release()
+        scheduler.release()
+        assert scheduler.active == 0
+
+    asyncio.run(scenario())
+
+
+async def drain(scheduler: FairScheduler, backlog: Dict[int, int], grants: int) -> List[int]:
+    """
+    Ставит в очередь backlog[user_id] запросов каждого пользователя при
+    занятом ресурсе и возвращает порядок, в котором первые grants получили единицу
+    """
+    await scheduler.acquire("blocker")
+    order: List[int] = []
+
+    async def request(user_id: int) -> None:
+        await scheduler.acquire(user_id)
+        order.append(user_id)
+        scheduler.release()
+
+    tasks = [asyncio.ensure_future(request(user_id)) for user_id, count in backlog.items() for _ in range(count)]
+    await asyncio.sleep(0)
+    scheduler.release()
+    while len(order) < grants:
+        await asyncio.sleep(0)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return order[:grants]
+
+
+def test_heavy_user_does_not_delay_light_user():
+    async def scenario():
+        scheduler = FairScheduler("test", 1, 1.0, {})
+        order = await drain(scheduler, {1: 1000, 2: 1}, 4)
+        # Единственный запрос второго пользователя - не дальше одного прохода
+        assert order.index(2) <= 1
+
+    asyncio.run(scenario())
+
+
+def test_weighted_share_within_tolerance():
+    async def scenario():
+        scheduler = FairScheduler("test", 1, 1.0, {1: 3.0})
+        order = await drain(scheduler, {1: 500, 2: 500, 3: 500}, 500)
+        counts = Counter(order)
+        # Доли 3:1:1 от 500 единиц
+        assert counts[1] == pytest.approx(300, abs=6)
+        assert counts[2] == pytest.approx(100, abs=6)
+        assert counts[3] == pytest.approx(100, abs=6)
+
+    asyncio.run(scenario())
+
+
+def test_cost_is_charged_against_credit():
+    async def scenario():
+        scheduler = FairScheduler("test", 1, 4.0, {})
+        await scheduler.acquire("blocker")
+        order: List[str] = []
+
+        async def request(name: str, user_id: int, cost: float) -> None:
+            await scheduler.acquire(user_id, cost)
+            order.append(name)
+            scheduler.release()
+
+        tasks = [asyncio.ensure_future(request(f"big{i}", 1, 4.0)) for i in range(2)]
+        tasks += [asyncio.ensure_future(request(f"small{i}", 2, 1.0)) for i in range(8)]
+        await asyncio.sleep(0)
+        scheduler.release()
+        await asyncio.gather(*tasks)
+        # За проход пользователь тратит quantum: один пакет из 4 или 4 одиночных запроса
+        assert order == ["big0"] + [f"small{i}" for i in range(4)] + ["big1"] + [f"small{i}" for i in range(4, 8)]
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_leaves_queue():
+    async def scenario():
+        scheduler = FairScheduler("test", 1, 1.0, {})
+        await scheduler.acquire(1)
+        waiter = asyncio.ensure_future(scheduler.acquire(2))
+        await asyncio.sleep(0)
+        assert scheduler.get_stats()["users_waiting"] == 1
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert scheduler.queues == {} and scheduler.deficits == {}
+        scheduler.release()
+        assert scheduler.active == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,118 @@
+"""
+Тесты учета FloodWait и ответа 429 с Retry-After
+"""
+import time
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+from telethon.errors import FloodWaitError
+
+from app.core.security import create_access_token
+from app.services.flood import FloodControl, RetryAfterError
+
+
+def flood_wait(seconds: int) -> FloodWaitError:
+    return FloodWaitError(request=None, capture=seconds)
+
+
+class Sender:
+    """
+    Запрос, который сначала отвечает заданными FloodWait, потом результатом
+    """
+
+    def __init__(self, *errors: FloodWaitError):
+        self.errors = list(errors)
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "ok"
+
+
+def test_short_flood_wait_is_retried():
+    async def scenario():
+        control = FloodControl(retry_max_wait=5, max_retries=2)
+        send = Sender(flood_wait(0), flood_wait(0))
+        assert await control.call(1, "GetHistoryRequest", send) == "ok"
+        assert send.calls == 3
+        assert control.stats["retried"] == 2
+        assert control.events == {"GetHistoryRequest": 2}
+
+    asyncio.run(scenario())
+
+
+def test_retries_wait_until_deadline():
+    async def scenario():
+        control = FloodControl(retry_max_wait=5, max_retries=1)
+        control.record(1, "GetHistoryRequest", 0.05)
+        started = time.monotonic()
+        assert await control.call(1, "GetHistoryRequest", Sender()) == "ok"
+        assert time.monotonic() - started >= 0.04
+        # Истекший срок удаляется при проверке
+        assert control.remaining(1, "GetHistoryRequest") == 0.0
+        assert control.deadlines == {}
+
+    asyncio.run(scenario())
+
+
+def test_long_flood_wait_records_deadline_and_fails_fast():
+    async def scenario():
+        control = FloodControl(retry_max_wait=5, max_retries=2)
+        with pytest.raises(RetryAfterError) as error:
+            await control.call(1, "SendMessageRequest", Sender(flood_wait(30)))
+        assert error.value.seconds == 30
+        assert control.stats["rejected"] == 1
+        assert 29 < control.remaining(1, "SendMessageRequest") <= 30
+
+        # Пока срок не истек, запрос не уходит в Telegram
+        send = Sender()
+        with pytest.raises(RetryAfterError) as error:
+            await control.call(1, "SendMessageRequest", send)
+        assert send.calls == 0
+        assert 29 <= error.value.seconds <= 30
+        assert control.stats["failed_fast"] == 1
+
+        # Другие методы и пользователи не заблокированы
+        assert await control.call(1, "GetHistoryRequest", Sender()) == "ok"
+        assert await control.call(2, "SendMessageRequest", Sender()) == "ok"
+
+    asyncio.run(scenario())
+
+
+def test_gives_up_after_max_retries():
+    async def scenario():
+        control = FloodControl(retry_max_wait=5, max_retries=1)
+        send = Sender(flood_wait(0), flood_wait(0), flood_wait(0))
+        with pytest.raises(RetryAfterError):
+            await control.call(1, "GetHistoryRequest", send)
+        assert send.calls == 2
+        assert (control.stats["retried"], control.stats["rejected"]) == (1, 1)
+
+    asyncio.run(scenario())
+
+
+def test_retry_after_error_is_value_error():
+    # Обработчики, которые ловят ValueError, продолжают его получать
+    error = RetryAfterError(12)
+    assert isinstance(error, ValueError)
+    assert "12" in str(error)
+
+
+def test_endpoints_answer_429_with_retry_after(monkeypatch):
+    from app.main import app
+    from app.api import dialogs
+
+    async def blocked(*args, **kwargs):
+        raise RetryAfterError(7)
+
+    monkeypatch.setattr(dialogs, "get_dialogs_with_age", blocked)
+    monkeypatch.setattr(dialogs, "get_messages", blocked)
+    headers = {"Authorization": f"Bearer {create_access_token({'sub': '1'})}"}
+    client = TestClient(app)
+    for path in ("/api/v1/dialogs/", "/api/v1/dialogs/1/messages"):
+        response = client.get(path, headers=headers)
+        assert response.status_code == 429
+        assert response.headers["Retry-After"] == "7"
@@ -0,0 +1,67 @@
+"""
+Тесты локального хранилища диалогов и сообщений
+"""
+import os
+import time
+import asyncio
+import tempfile
+
+from app.services.local_store import LocalStore
+from app.services.message_store import MessageStore
+
+
+def make_store(dialog_id: int, count: int, fetched_at: float) -> MessageStore:
+    store = MessageStore()
+    messages = [{"id": i, "sender_id": 7, "text": f"{dialog_id}:{i}"} for i in range(count, 0, -1)]
+    store.add(messages, cursor=0, min_id=0, complete=True)
+    store.add_sender(7, {"id": 7, "first_name": "A"}, is_user=True)
+    for segment in store.segments:
+        segment.fetched_at = fetched_at
+    return store
+
+
+def open_store() -> LocalStore:
+    directory = tempfile.mkdtemp(prefix="tdv-local-")
+    return LocalStore(os.path.join(directory, "local_store.db"))
+
+
+def test_prune_drops_stale_and_oldest_over_limit():
+    async def scenario():
+        local = open_store()
+        now = time.time()
+        for dialog_id, age in ((1, 100.0), (2, 50.0), (3, 10.0), (4, 100.0)):
+            store = make_store(dialog_id, 5, now - age)
+            local.save_messages(1, dialog_id, store, [m for s in store.segments for m in s.messages.values()])
+
+        # Диалог 4 устарел, но открыт в памяти - остается
+        assert await local.prune(60.0, 10 ** 9, live={(1, 4)}) == 1
+        assert await local.load_messages(1, 1) is None
+        assert await local.load_messages(1, 4) is not None
+
+        # Лимит меньше двух диалогов - удаляется самый давно обновленный
+        one_dialog = len("".join(LocalStore.dump(m) for m in make_store(3, 5, now).segments[0].messages.values()))
+        assert await local.prune(3600.0, one_dialog * 2, live={(1, 4)}) == 1
+        assert await local.load_messages(1, 2) is None
+        restored = await local.load_messages(1, 3)
+        assert sorted(restored.segments[0].messages) == [1, 2, 3, 4, 5]
+        assert 7 in restored.users
+        local.close()
+
+    asyncio.run(scenario())
+
+
+def test_delete_user_removes_all_rows():
+    async def scenario():
+        local = open_store()
+        store = make_store(1, 3, time.time())
+        local.save_dialogs(1, [{"id": 1}])
+        local.save_messages(1, 1, store, [], replace=True)
+        local.save_dialogs(2, [{"id": 1}])
+
+        local.delete_user(1)
+        assert await local.load_dialogs(1) is None
+        assert await local.load_messages(1, 1) is None
+        assert (await local.load_dialogs(2))[0] == [{"id": 1}]
+        local.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,55 @@
+"""
+Тесты подписанных ссылок на медиа и кэша медиа на диске
+"""
+import os
+import time
+import asyncio
+import tempfile
+
+from fastapi.testclient import TestClient
+
+from app.core.security import create_access_token, sign_media
+from app.services.media import MediaCache
+
+
+def test_signed_media_url_opens_without_authorization(monkeypatch):
+    from app.main import app
+    from app.api import media
+
+    path = os.path.join(tempfile.mkdtemp(prefix="tdv-media-"), "file.mp4")
+    with open(path, "wb") as f:
+        f.write(b"0123456789")
+    monkeypatch.setattr(media, "get_cached_media", lambda key: (path, "video/mp4"))
+
+    client = TestClient(app)
+    headers = {"Authorization": f"Bearer {create_access_token({'sub': '1'})}"}
+    url = client.get("/api/v1/dialogs/5/messages/7/media/url", headers=headers).json()["url"]
+
+    response = client.get(url, headers={"Range": "bytes=2-4"})
+    assert response.status_code == 206
+    assert response.content == b"234"
+
+    # Ссылка подписана для одного сообщения
+    assert client.get(url.replace("/messages/7/", "/messages/8/")).status_code == 403
+    expired = int(time.time()) - 1
+    stale = f"/api/v1/dialogs/5/messages/7/media?user=1&expires={expired}&sig={sign_media(1, 5, 7, expired)}"
+    assert client.get(stale).status_code == 403
+    assert client.get("/api/v1/dialogs/5/messages/7/media").status_code == 401
+
+
+def test_cache_put_evicts_least_recently_used():
+    async def scenario():
+        cache = MediaCache(tempfile.mkdtemp(prefix="tdv-media-"), max_bytes=10)
+        paths = []
+        for key in ("a", "b", "c"):
+            tmp_path = cache.temp_path(key)
+            with open(tmp_path, "wb") as f:
+                f.write(b"x" * 4)
+            paths.append(await cache.put(key, ".bin", tmp_path))
+
+        assert list(cache.entries) == ["b", "c"]
+        assert cache.total_bytes == 8
+        assert not os.path.exists(paths[0])
+        assert cache.stats["evictions"] == 1
+
+    asyncio.run(scenario())
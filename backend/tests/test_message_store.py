@@ -0,0 +1,150 @@
+"""
+Тесты хранилища сообщений диалога (отрезки по id)
+"""
+import time
+import random
+from typing import Dict, List
+
+from app.services.message_store import MessageStore
+
+
+def make_message(message_id: int, sender_id: int = 1) -> Dict:
+    return {"id": message_id, "sender_id": sender_id, "text": f"сообщение {message_id}"}
+
+
+def history(ids: List[int], cursor: int, min_id: int, limit: int) -> List[Dict]:
+    """
+    Ответ messages.getHistory: id в (min_id, cursor), от новых к старым
+    """
+    found = [i for i in sorted(ids, reverse=True) if (not cursor or i < cursor) and i > min_id]
+    return [make_message(i) for i in found[:limit]]
+
+
+def check_invariants(store: MessageStore, ids: List[int]) -> None:
+    segments = sorted(store.segments, key=lambda s: s.low)
+    for segment in segments:
+        assert segment.low <= segment.high
+        # Отрезок полон: в нем все существующие сообщения своего диапазона и только они
+        expected = {i for i in ids if segment.low <= i <= segment.high}
+        assert set(segment.messages) == expected
+    for lower, upper in zip(segments, segments[1:]):
+        # Не пересекаются и не соприкасаются - соседние сливаются
+        assert lower.high + 1 < upper.low
+    assert sum(s.top for s in segments) <= 1
+    # Размер, который ведется по изменениям, совпадает с полным пересчетом
+    size = store.size
+    assert size == store.recount()
+
+
+def test_random_adds_leave_no_gaps_or_overlaps():
+    rng = random.Random(7)
+    for _ in range(50):
+        # Часть id удалена, как в настоящей истории
+        ids = sorted(rng.sample(range(1, 400), 150))
+        store = MessageStore()
+        for _ in range(30):
+            limit = rng.randint(1, 40)
+            cursor = rng.choice([0, rng.randint(2, 410)])
+            # Как get_messages: запрос доходит до ближайшего известного отрезка ниже
+            lower = store.next_below(cursor)
+            min_id = lower.high if lower and rng.random() < 0.7 else 0
+            messages = history(ids, cursor, min_id, limit)
+            store.add(messages, cursor, min_id, complete=len(messages) < limit)
+            check_invariants(store, ids)
+            if rng.random() < 0.1:
+                # Перезапуск без обновлений: новые сообщения дозапрашиваются с min_id
+                store.mark_outdated()
+
+
+def test_full_history_becomes_one_segment():
+    ids = list(range(1, 101))
+    store = MessageStore()
+    cursor = 0
+    while True:
+        messages = history(ids, cursor, 0, 30)
+        store.add(messages, cursor, 0, complete=len(messages) < 30)
+        if len(messages) < 30:
+            break
+        cursor = messages[-1]["id"]
+
+    assert len(store.segments) == 1
+    segment = store.segments[0]
+    assert (segment.low, segment.high, segment.top, segment.bottom) == (1, 100, True, True)
+    assert store.find(0) is segment
+    assert store.find(50) is segment
+    assert segment.ids_below(4) == [3, 2, 1]
+
+
+def test_find_and_next_below_around_gap():
+    ids = list(range(1, 101))
+    store = MessageStore()
+    store.add(history(ids, 0, 0, 20), 0, 0, complete=False)
+    store.add(history(ids, 41, 0, 20), 41, 0, complete=False)
+
+    assert [(s.low, s.high) for s in store.segments] == [(81, 100), (21, 40)]
+    # Ниже 81 до 40 - промежуток, его нужно запрашивать
+    assert store.find(81) is None
+    assert store.next_below(81).high == 40
+    assert store.find(35).low == 21
+
+
+def test_patch_extends_top_or_opens_new_top_segment():
+    store = MessageStore()
+    store.add([make_message(i) for i in (10, 9, 8)], 0, 0, complete=False)
+
+    store.patch(make_message(11))
+    assert [(s.low, s.high, s.top) for s in store.segments] == [(8, 11, True)]
+
+    # Между 11 и 15 мог быть пропуск - старый отрезок перестает быть верхним
+    store.patch(make_message(15))
+    assert sorted((s.low, s.high, s.top) for s in store.segments) == [(8, 11, False), (15, 15, True)]
+    size = store.size
+    assert size == store.recount()
+
+
+def test_patch_update_and_remove_keep_size():
+    store = MessageStore()
+    store.add([make_message(i) for i in (5, 4, 3)], 0, 0, complete=True)
+    store.add_sender(1, {"id": 1, "first_name": "A"}, is_user=True)
+
+    store.patch(dict(make_message(4), text="правка через patch"))
+    assert store.update(dict(make_message(5), text="отредактировано" * 10))
+    assert not store.update(make_message(50))
+    assert store.segments[0].messages[5]["text"].startswith("отредактировано")
+    size = store.size
+    assert size == store.recount()
+
+    assert store.remove([3, 4, 99]) == 2
+    assert set(store.segments[0].messages) == {5}
+    # Границы отрезка не меняются: удаленных сообщений в нем больше нет
+    assert (store.segments[0].low, store.segments[0].high) == (1, 5)
+    removed_size = store.size
+    assert removed_size == store.recount() < size
+
+
+def test_drop_stale_removes_old_segments_and_unused_senders():
+    store = MessageStore()
+    store.add([make_message(i, sender_id=1) for i in (50, 49)], 0, 0, complete=False)
+    store.add([make_message(i, sender_id=2) for i in (10, 9)], 20, 0, complete=False)
+    store.add_sender(1, {"id": 1}, is_user=True)
+    store.add_sender(2, {"id": 2}, is_user=True)
+    old = next(s for s in store.segments if s.low == 9)
+    old.fetched_at = time.time() - 100
+
+    assert store.drop_stale(60)
+    assert [(s.low, s.high) for s in store.segments] == [(49, 50)]
+    assert set(store.users) == {1}
+    size = store.size
+    assert size == store.recount()
+    assert not store.drop_stale(60)
+
+
+def test_to_dict_round_trip_drops_top():
+    store = MessageStore()
+    store.add([make_message(i) for i in (3, 2, 1)], 0, 0, complete=True)
+    store.add_sender(1, {"id": 1, "photo_pending": True}, is_user=True)
+
+    restored = MessageStore.from_dict(store.to_dict(exclude=("photo_pending",)))
+    segment = restored.segments[0]
+    assert (segment.low, segment.high, segment.top, segment.bottom) == (1, 3, False, True)
+    assert restored.users == {1: {"id": 1}}
@@ -0,0 +1,157 @@
+"""
+Тесты полос приоритета запросов пользователя
+"""
+import asyncio
+from typing import List
+
+from app.services.inflight import coalesce, coalescing_stats
+from app.services.priority import (
+    INTERACTIVE, MAINTENANCE, PREFETCH, PriorityScheduler, current_lane, holding_slot, in_background, lane
+)
+
+
+class FakeClient:
+    """
+    Клиент с _call, который ждет сигнала, и фоновыми циклами Telethon
+    """
+
+    def __init__(self, user_id: int):
+        self.owner_user_id = user_id
+        self.release = asyncio.Event()
+        self.order: List[str] = []
+        self.loop_state = None
+
+    async def _call(self, sender, request, *args, **kwargs):
+        self.order.append(request)
+        await self.release.wait()
+        return request
+
+    async def _update_loop(self):
+        self.loop_state = (current_lane.get(), holding_slot.get())
+
+    async def _keepalive_loop(self):
+        pass
+
+
+def test_interactive_overtakes_queued_prefetch():
+    async def scenario():
+        scheduler = PriorityScheduler(slots=1, reserved=0)
+        client = FakeClient(1)
+        scheduler.install(client)
+
+        async def call(name: str, lane_name: str):
+            with lane(lane_name):
+                return await client._call(None, name)
+
+        first = asyncio.ensure_future(call("prefetch-0", PREFETCH))
+        await asyncio.sleep(0)
+        queued = [asyncio.ensure_future(call(f"prefetch-{i}", PREFETCH)) for i in range(1, 4)]
+        queued.append(asyncio.ensure_future(call("maintenance", MAINTENANCE)))
+        await asyncio.sleep(0)
+        queued.append(asyncio.ensure_future(call("interactive", INTERACTIVE)))
+        await asyncio.sleep(0)
+
+        client.release.set()
+        await asyncio.gather(first, *queued)
+        assert client.order == ["prefetch-0", "interactive", "prefetch-1", "prefetch-2", "prefetch-3", "maintenance"]
+        assert scheduler.get_stats()["lanes"][INTERACTIVE]["preempted"] == 1
+        assert scheduler.queues == {}
+
+    asyncio.run(scenario())
+
+
+def test_reserved_slots_stay_free_for_interactive():
+    async def scenario():
+        scheduler = PriorityScheduler(slots=3, reserved=1)
+        assert scheduler.limit(PREFETCH) == 2
+        assert await scheduler.acquire(1, PREFETCH) == 0.0
+        assert await scheduler.acquire(1, MAINTENANCE) == 0.0
+
+        background = asyncio.ensure_future(scheduler.acquire(1, PREFETCH))
+        await asyncio.sleep(0)
+        assert not background.done()
+        # Третий слот зарезервирован: интерактивный запрос получает его сразу
+        assert await scheduler.acquire(1, INTERACTIVE) == 0.0
+
+        # Пока занят зарезервированный слот, фоновым достается не больше двух
+        scheduler.release(1)
+        await asyncio.sleep(0)
+        assert not background.done()
+        scheduler.release(1)
+        await asyncio.sleep(0)
+        assert background.done()
+        for _ in range(2):
+            scheduler.release(1)
+        assert scheduler.queues == {}
+
+    asyncio.run(scenario())
+
+
+def test_nested_call_of_slot_holder_skips_queue():
+    async def scenario():
+        scheduler = PriorityScheduler(slots=1, reserved=0)
+        client = FakeClient(1)
+        client.release.set()
+        scheduler.install(client)
+        inner = client._call
+
+        async def outer_call(sender, request, *args, **kwargs):
+            # Вложенный запрос той же задачи (например, разрешение сущности)
+            if request == "outer":
+                await inner(sender, "nested")
+            return request
+
+        client._call = outer_call
+        scheduler.install(client)
+        assert await asyncio.wait_for(client._call(None, "outer"), 1.0) == "outer"
+
+    asyncio.run(scenario())
+
+
+def test_client_loops_run_in_maintenance_without_slot():
+    async def scenario():
+        scheduler = PriorityScheduler(slots=1, reserved=0)
+        client = FakeClient(1)
+        scheduler.install(client)
+        holding_slot.set(asyncio.current_task())
+        with lane(INTERACTIVE):
+            await asyncio.ensure_future(client._update_loop())
+        assert client.loop_state == (MAINTENANCE, None)
+
+        @in_background
+        async def job():
+            return current_lane.get()
+
+        with lane(PREFETCH):
+            assert await job() == MAINTENANCE
+        assert current_lane.get() == INTERACTIVE
+
+    asyncio.run(scenario())
+
+
+def test_coalesced_task_promoted_for_interactive_caller():
+    async def scenario():
+        lanes: List[str] = []
+        release = asyncio.Event()
+
+        async def fetch():
+            lanes.append(current_lane.get())
+            assert holding_slot.get() is None
+            await release.wait()
+            return len(lanes)
+
+        holding_slot.set(asyncio.current_task())
+        with lane(PREFETCH):
+            background = [asyncio.ensure_future(coalesce("priority-test", (1,), fetch)) for _ in range(2)]
+        await asyncio.sleep(0)
+        # Интерактивный запрос не ждет за загрузкой полосы PREFETCH
+        interactive = [asyncio.ensure_future(coalesce("priority-test", (1,), fetch)) for _ in range(2)]
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(*background, *interactive)
+
+        assert lanes == [PREFETCH, INTERACTIVE]
+        stats = coalescing_stats["priority-test"]
+        assert (stats["executions"], stats["coalesced"], stats["promoted"]) == (2, 2, 1)
+
+    asyncio.run(scenario())
@@ -0,0 +1,113 @@
+"""
+Тесты ограничителя частоты запросов MTProto (корзины токенов)
+"""
+import time
+import asyncio
+
+import pytest
+from telethon.tl.functions.auth import SendCodeRequest
+from telethon.tl.functions.messages import GetHistoryRequest, SendMessageRequest
+from telethon.tl.functions.upload import GetFileRequest
+
+from app.services.rate_limit import RateLimiter, TokenBucket, classify
+
+
+def make_limiter(read: float = 1000.0, global_rate: float = 1000.0, burst_seconds: float = 1.0) -> RateLimiter:
+    return RateLimiter({"read": read, "send": 1.0}, burst_seconds, global_rate, api_id=1)
+
+
+def test_bucket_allows_burst_then_spaces_reservations():
+    bucket = TokenBucket(rate=10.0, capacity=3.0)
+    now = bucket.updated
+    assert [bucket.reserve(1, now) for _ in range(3)] == [0.0, 0.0, 0.0]
+    # Дальше каждый токен - через 1/rate после предыдущего, в порядке вызова
+    assert bucket.reserve(1, now) == pytest.approx(0.1)
+    assert bucket.reserve(1, now) == pytest.approx(0.2)
+
+
+def test_bucket_refills_up_to_capacity():
+    bucket = TokenBucket(rate=10.0, capacity=2.0)
+    now = bucket.updated
+    bucket.reserve(2, now)
+    assert not bucket.idle(now)
+    assert bucket.reserve(1, now + 0.1) == 0.0
+    # Баланс не превышает capacity, сколько бы корзина ни простаивала
+    assert bucket.idle(now + 100)
+    bucket.reserve(0, now + 100)
+    assert bucket.tokens == 2.0
+
+
+def test_bucket_refund_returns_tokens():
+    bucket = TokenBucket(rate=1.0, capacity=1.0)
+    now = bucket.updated
+    bucket.reserve(1, now)
+    assert bucket.reserve(1, now) == pytest.approx(1.0)
+    bucket.refund(1)
+    assert bucket.reserve(1, now) == pytest.approx(1.0)
+
+
+def test_classify_by_namespace_and_method():
+    assert classify(SendCodeRequest("+10000000000", 1, "x", None)) == "auth"
+    assert classify(GetFileRequest(None, 0, 1024)) == "download"
+    assert classify(SendMessageRequest("me", "hi")) == "send"
+    assert classify(GetHistoryRequest("me", 0, None, 0, 10, 0, 0, 0)) == "read"
+
+
+def test_acquire_waits_for_token_and_counts_delay():
+    async def scenario():
+        limiter = make_limiter(read=20.0, burst_seconds=0.05)
+        assert await limiter.acquire(1, "read") == 0.0
+        started = time.monotonic()
+        waited = await limiter.acquire(1, "read")
+        assert waited == pytest.approx(0.05, abs=0.01)
+        assert time.monotonic() - started >= 0.04
+        stats = limiter.get_stats()["classes"]["read"]
+        assert (stats["calls"], stats["delayed"], stats["queued"]) == (2, 1, 0)
+
+    asyncio.run(scenario())
+
+
+def test_users_have_separate_buckets_but_share_global():
+    async def scenario():
+        limiter = make_limiter(read=1.0, global_rate=1000.0, burst_seconds=1.0)
+        assert await limiter.acquire(1, "read") == 0.0
+        # Корзина первого пользователя пуста, у второго своя
+        assert await limiter.acquire(2, "read") == 0.0
+        assert limiter.bucket(1, "read").reserve(1, time.monotonic()) > 0.5
+
+        shared = make_limiter(read=1000.0, global_rate=1.0, burst_seconds=1.0)
+        assert await shared.acquire(1, "read") == 0.0
+        # Общая корзина API_ID пуста для всех пользователей
+        assert shared.global_bucket.reserve(1, time.monotonic()) > 0.5
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_wait_refunds_tokens():
+    async def scenario():
+        limiter = make_limiter(read=1.0, burst_seconds=1.0)
+        await limiter.acquire(1, "read")
+        waiter = asyncio.ensure_future(limiter.acquire(1, "read", 3))
+        await asyncio.sleep(0.01)
+        assert limiter.get_stats()["queued"] == 1
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        # Отмененный запрос не отодвигает следующих
+        assert limiter.bucket(1, "read").reserve(1, time.monotonic()) == pytest.approx(1.0, abs=0.05)
+        assert limiter.get_stats()["queued"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_forget_drops_only_full_buckets():
+    async def scenario():
+        limiter = make_limiter(read=0.001, burst_seconds=1000.0)
+        await limiter.acquire(1, "read")
+        limiter.bucket(2, "read")
+        limiter.forget(1)
+        limiter.forget(2)
+        # Корзина с потраченными токенами остается: иначе переподключение обнулило бы лимит
+        assert list(limiter.buckets) == [(1, "read")]
+
+    asyncio.run(scenario())
@@ -0,0 +1,48 @@
+"""
+Тесты общей базы сессий
+"""
+import os
+import asyncio
+import tempfile
+
+from telethon.crypto import AuthKey
+
+from app.services.session_store import SessionDatabase, SharedSession
+
+
+def test_has_session_finds_login_of_other_process():
+    directory = tempfile.mkdtemp(prefix="tdv-sessions-")
+    path = os.path.join(directory, "sessions.db")
+    first = SessionDatabase(path, directory)
+    second = SessionDatabase(path, directory)
+    try:
+        assert not asyncio.run(second.find_session("user_1"))
+
+        session = SharedSession(first, "user_1")
+        session.auth_key = AuthKey(b"k" * 256)
+        # Дожидаемся записи из очереди потока хранилища
+        first.executor.submit(lambda: None).result()
+
+        assert not second.has_session("user_1")
+        assert asyncio.run(second.find_session("user_1"))
+        # Найденная в базе сессия попадает в реестр в памяти
+        assert second.has_session("user_1")
+        assert "user_1" in second.list_sessions()
+    finally:
+        first.close()
+        second.close()
+
+
+def test_only_one_process_maintains_database():
+    directory = tempfile.mkdtemp(prefix="tdv-sessions-")
+    path = os.path.join(directory, "sessions.db")
+    first = SessionDatabase(path, directory)
+    second = SessionDatabase(path, directory)
+    try:
+        assert first.claim_maintenance()
+        assert not second.claim_maintenance()
+        first.close()
+        # Блокировка освобождается вместе с базой
+        assert second.claim_maintenance()
+    finally:
+        second.close()
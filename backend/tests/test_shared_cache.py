@@ -0,0 +1,186 @@
+"""
+Тесты общего кэша на Redis в памяти процесса (REDIS_URL=memory://имя)
+"""
+import json
+import uuid
+import asyncio
+
+from app.services.shared_cache import MemoryRedis, SharedCache
+
+
+def memory_url() -> str:
+    # Серверы MemoryRedis общие для процесса - у каждого теста свой
+    return f"memory://{uuid.uuid4().hex}"
+
+
+async def start_workers(url: str, count: int):
+    workers = [SharedCache(url, "test", 60.0, 60.0) for _ in range(count)]
+    for worker in workers:
+        await worker.start()
+    return workers
+
+
+async def settle() -> None:
+    # Даем задачам подписки разобрать опубликованные сообщения
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_memory_redis_get_set_delete():
+    async def scenario():
+        redis = MemoryRedis.from_url(memory_url())
+        assert await redis.get("a") is None
+        await redis.set("a", "1")
+        assert await redis.get("a") == "1"
+        assert await redis.delete("a", "b") == 1
+        assert await redis.get("a") is None
+
+    asyncio.run(scenario())
+
+
+def test_memory_redis_expires_keys():
+    async def scenario():
+        redis = MemoryRedis.from_url(memory_url())
+        await redis.set("a", "1", ex=0.01)
+        assert await redis.get("a") == "1"
+        await asyncio.sleep(0.02)
+        assert await redis.get("a") is None
+        assert "a" not in redis.data
+
+    asyncio.run(scenario())
+
+
+def test_memory_redis_same_name_shares_data():
+    url = memory_url()
+    assert MemoryRedis.from_url(url) is MemoryRedis.from_url(url)
+    assert MemoryRedis.from_url(url) is not MemoryRedis.from_url(memory_url())
+
+
+def test_memory_redis_pipeline():
+    async def scenario():
+        redis = MemoryRedis.from_url(memory_url())
+        pipe = redis.pipeline(transaction=False)
+        pipe.set("a", "1").set("b", "2")
+        pipe.get("a")
+        assert await pipe.execute() == [True, True, "1"]
+        assert pipe.commands == []
+        assert await redis.get("b") == "2"
+
+    asyncio.run(scenario())
+
+
+def test_memory_redis_pubsub():
+    async def scenario():
+        redis = MemoryRedis.from_url(memory_url())
+        pubsub = redis.pubsub(ignore_subscribe_messages=True)
+        await pubsub.subscribe("channel")
+        assert await redis.publish("channel", "hello") == 1
+        assert await redis.publish("other", "skipped") == 0
+
+        messages = pubsub.listen()
+        message = await asyncio.wait_for(messages.__anext__(), 1.0)
+        assert message == {"type": "message", "channel": "channel", "data": "hello"}
+
+        await pubsub.aclose()
+        assert await redis.publish("channel", "after close") == 0
+
+    asyncio.run(scenario())
+
+
+def test_shared_cache_disabled_without_url():
+    async def scenario():
+        cache = SharedCache("", "test", 60.0, 60.0)
+        await cache.start()
+        assert not cache.enabled
+        cache.put("dialogs", 1, "[]")
+        assert cache.pending == {}
+        assert await cache.get("dialogs", 1) is None
+
+    asyncio.run(scenario())
+
+
+def test_shared_cache_get_set_between_workers():
+    async def scenario():
+        first, second = await start_workers(memory_url(), 2)
+        try:
+            assert await second.get("dialogs", 1) is None
+            first.put("dialogs", 1, json.dumps([{"id": 5}]))
+            assert await first.flush() == 1
+            assert await second.get("dialogs", 1) == [{"id": 5}]
+            assert second.get_stats()["hits"] == 1
+            assert second.get_stats()["misses"] == 1
+        finally:
+            await first.shutdown()
+            await second.shutdown()
+
+    asyncio.run(scenario())
+
+
+def test_shared_cache_mark_dirty_serializes_on_flush():
+    async def scenario():
+        (cache,) = await start_workers(memory_url(), 1)
+        try:
+            value = {"id": 1}
+            cache.mark_dirty("messages", "1:2", lambda: json.dumps(value))
+            value["id"] = 2
+            # None - записи в L1 уже нет, в L2 ничего не пишется
+            cache.mark_dirty("messages", "1:3", lambda: None)
+            assert await cache.flush() == 1
+            assert await cache.get("messages", "1:2") == {"id": 2}
+            assert await cache.get("messages", "1:3") is None
+        finally:
+            await cache.shutdown()
+
+    asyncio.run(scenario())
+
+
+def test_shared_cache_invalidates_other_workers():
+    async def scenario():
+        first, second = await start_workers(memory_url(), 2)
+        invalidated = {"first": [], "second": []}
+        first.on_invalidate("dialogs", invalidated["first"].append)
+        second.on_invalidate("dialogs", invalidated["second"].append)
+        try:
+            first.put("dialogs", 7, "[]")
+            await first.flush()
+            await settle()
+            # Свою запись воркер не инвалидирует
+            assert invalidated == {"first": [], "second": ["7"]}
+            assert first.get_stats()["published"] == 1
+            assert second.get_stats()["invalidated"] == 1
+        finally:
+            await first.shutdown()
+            await second.shutdown()
+
+    asyncio.run(scenario())
+
+
+def test_shared_cache_does_not_publish_avatars():
+    async def scenario():
+        first, second = await start_workers(memory_url(), 2)
+        invalidated = []
+        second.on_invalidate("avatars", invalidated.append)
+        try:
+            first.put("avatars", 42, "{}")
+            await first.flush()
+            await settle()
+            assert invalidated == []
+            assert first.get_stats()["published"] == 0
+            assert await second.get("avatars", 42) == {}
+        finally:
+            await first.shutdown()
+            await second.shutdown()
+
+    asyncio.run(scenario())
+
+
+def test_shared_cache_shutdown_flushes_pending():
+    async def scenario():
+        url = memory_url()
+        (cache,) = await start_workers(url, 1)
+        cache.put("dialogs", 3, "[1]", wake=False)
+        await cache.shutdown()
+        assert not cache.enabled
+        assert await MemoryRedis.from_url(url).get("test:dialogs:3") == "[1]"
+
+    asyncio.run(scenario())